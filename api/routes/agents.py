@@ -1,15 +1,32 @@
-from api.routes.utils import DefaultErrorMessages, handle_validation_error
-from db.agents import create_agent, delete_agent, get_agent, update_agent_files, update_agent_messages, update_agent_websites
-from fastapi import APIRouter, File, Form, HTTPException, UploadFile
+from api.routes.utils import ClientDisconnected, DefaultErrorMessages, handle_validation_error, run_until_disconnected
+from db.agents import (
+    create_agent, delete_agent, delete_agent_file, delete_agent_website, get_agent, get_agent_file, get_agent_file_listing,
+    get_agent_metadata, get_agent_page, get_agent_token_total, get_agent_website, get_knowledge_prompt, replace_agent_file,
+    replace_agent_website, sync_vector_index, update_agent_files, update_agent_messages, update_agent_websites
+)
+from db.ingestions import create_ingestion, get_ingestion
+from fastapi import APIRouter, BackgroundTasks, Body, File, Form, HTTPException, Query, Request, Response, UploadFile
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import ORJSONResponse, StreamingResponse
 import json
 from langgraph_setup import LangGraphSetup
 from llm_setup import LLMSetup
-from models.agents import AgentDB, CreateAgent, File as FileModel
+from models.agents import AgentDB, AgentFileListing, AgentMetadata, CreateAgent, File as FileModel
+from models.ingestions import IngestionDB
 from models.messages import Message
 from tool_setup import ToolSetup
-from typing import Dict, List, Tuple
+from utils.context_packer import ContextPacker
+from pymongo.errors import BulkWriteError
+from typing import Dict, List, Literal, Optional, Tuple, Union
+from utils.agent_snapshot import MEDIA_TYPES, MSGPACK, SnapshotFormatError, export_agents, import_agents
 from utils.document_extractor import DocumentExtractor
+from utils.ingestion_pipeline import IngestionPipeline
+from utils.json_stream import iter_model_json
+from utils.knowledge_prompt import build_knowledge_toc, create_knowledge_prompt
+from utils.research_budget import ResearchBudget
+from utils.summarizer import DocumentSummarizer
 from utils.token_manager import TokenManager
+from utils.vector_index import vector_index_store
 import os
 import tempfile
 
@@ -17,14 +34,81 @@ router = APIRouter()
 
 token_manager = TokenManager(max_tokens=120000)
 document_extractor = DocumentExtractor(token_manager=token_manager)
+document_summarizer = DocumentSummarizer(token_manager=token_manager)
+ingestion_pipeline = IngestionPipeline(document_extractor=document_extractor, token_manager=token_manager, document_summarizer=document_summarizer)
+context_packer = ContextPacker(token_manager=token_manager)
 
-async def process_files(files: List[UploadFile], initial_tokens: int = 0) -> Tuple[List[FileModel], int]:
+# Agents with at least this many knowledge base tokens are streamed instead of encoded in one go
+STREAM_AGENT_MIN_TOKENS = int(os.getenv("STREAM_AGENT_MIN_TOKENS", "20000"))
+
+# "inline" puts the knowledge base in the system prompt, "lookup" only its table of contents
+KB_CONTEXT_MODE = os.getenv("KB_CONTEXT_MODE", "inline")
+
+def encode_knowledge_item(item: FileModel) -> dict:
+    """
+    JSON-ready dict of a file or website whose text is decompressed without being cached
+    """
+    return {**item.model_dump(mode="json", exclude={"text"}), "text": item.read_text(cache=False)}
+
+def stream_agent(agent: AgentDB) -> StreamingResponse:
+    """
+    Stream an agent as JSON, one file or website at a time
+    """
+    return StreamingResponse(
+        iter_model_json(agent, ("files", "websites"), encode_item=encode_knowledge_item),
+        media_type="application/json"
+    )
+
+def validate_file_extensions(files: List[UploadFile]):
+    """
+    Reject the upload if any file has an unsupported extension
+    """
+    for file in files:
+        if not document_extractor.is_supported_file(file.filename):
+            _, ext = os.path.splitext(file.filename.lower())
+            raise HTTPException(
+                status_code=400, 
+                detail=f"Unsupported file extension: {ext}. Supported types are: {', '.join(document_extractor.SUPPORTED_EXTENSIONS.keys())}"
+            )
+
+async def start_ingestion(
+    agent_id: str,
+    files: List[UploadFile],
+    initial_tokens: int,
+    background_tasks: BackgroundTasks,
+    summarize: bool = False
+) -> str:
+    """
+    Spool uploaded files and schedule their extraction in the background
+    
+    Args:
+        agent_id: ID of the agent the files are added to
+        files: List of uploaded files
+        initial_tokens: Tokens the agent already uses
+        background_tasks: Background tasks of the current request
+        summarize: Store a digest of files that are too large to use whole
+        
+    Returns:
+        ID of the ingestion tracking the files
+    """
+    validate_file_extensions(files)
+    
+    file_names = [file.filename for file in files]
+    spooled_paths = await ingestion_pipeline.spool(files)
+    ingestion = await create_ingestion(agent_id, file_names)
+    
+    background_tasks.add_task(ingestion_pipeline.run, str(ingestion.id), agent_id, file_names, spooled_paths, initial_tokens, summarize)
+    return str(ingestion.id)
+
+async def process_files(files: List[UploadFile], initial_tokens: int = 0, summarize: bool = False) -> Tuple[List[FileModel], int]:
     """
     Process uploaded files, extract text and calculate tokens
     
     Args:
         files: List of uploaded files
         initial_tokens: Starting token count (for adding to existing files)
+        summarize: Store a map-reduce digest of files that are too large to use whole.
+            Such files count toward the token limit at the size of their digest.
         
     Returns:
         Tuple of (list of processed file records, total token count)
@@ -46,10 +130,19 @@ async def process_files(files: List[UploadFile], initial_tokens: int = 0) -> Tup
                 )
             
             try:
-                text, tokens = document_extractor.extract_from_file(file_path)
+                text, tokens = await run_in_threadpool(document_extractor.extract_from_file, file_path)
             except Exception as e:
                 raise HTTPException(status_code=400, detail=f"Error processing file {file.filename}: {str(e)}")
             
+            if summarize and document_summarizer.should_summarize(tokens, token_manager.max_tokens - current_tokens):
+                try:
+                    file_record = await document_summarizer.create_file(file.filename, text, tokens)
+                except Exception as e:
+                    raise HTTPException(status_code=500, detail=f"Error summarizing file {file.filename}: {str(e)}")
+                tokens = file_record.tokens
+            else:
+                file_record = FileModel(name=file.filename, text=text, tokens=tokens)
+            
             would_exceed, total_tokens = token_manager.check_token_limit(current_tokens, tokens)
             if would_exceed:
                 raise HTTPException(
@@ -59,62 +152,140 @@ async def process_files(files: List[UploadFile], initial_tokens: int = 0) -> Tup
             
             current_tokens = total_tokens 
             
-            file_records.append(FileModel(
-                name=file.filename,
-                text=text,
-                tokens=tokens
-            ))
+            file_records.append(file_record)
             
     return file_records, current_tokens
 
 @router.post("/agents", status_code=201, response_model=Dict[str, str])
 async def create_agent_route(
+    background_tasks: BackgroundTasks,
     agent_post: str = Form(...),
-    files: List[UploadFile] = File([])
+    files: List[UploadFile] = File([]),
+    background: bool = False,
+    summarize: bool = False
 ):
     """
     Create a new research agent
     
     Args:
         agent: JSON string containing agent details
+        background: Accept the files and extract them in the background
+        summarize: Store a digest of files that are too large to use whole
     
     Returns:
-        Newly created agent ID
+        Newly created agent ID, and the ingestion ID when files are extracted in the background
     """
     try:
         agent_data = json.loads(agent_post)
-        file_records, _ = await process_files(files)
-        agent_data["files"] = file_records
+        if background:
+            validate_file_extensions(files)
+            agent_data["files"] = []
+        else:
+            file_records, _ = await process_files(files, summarize=summarize)
+            agent_data["files"] = file_records
         
         validated_agent = CreateAgent(**agent_data)
         
         new_agent = await create_agent(validated_agent)
-        return {"agent_id": str(new_agent.id)}
+        response = {"agent_id": str(new_agent.id)}
+        
+        if background and files:
+            response["ingestion_id"] = await start_ingestion(str(new_agent.id), files, 0, background_tasks, summarize)
+        return response
     
     except json.JSONDecodeError:
         raise handle_validation_error(ValueError(DefaultErrorMessages.INVALID_JSON_FORMAT))
     except ValueError as e:
         raise handle_validation_error(e)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=DefaultErrorMessages.INTERNAL_SERVER_ERROR)
     
-@router.get("/agents/{agent_id}", status_code=200, response_model=AgentDB)
+@router.get("/agents/export", status_code=200)
+async def export_agents_route(
+    format: Literal["msgpack", "ndjson"] = MSGPACK
+):
+    """
+    Stream every agent with its extracted knowledge base as a snapshot
+    
+    Args:
+        format: "msgpack" or "ndjson"
+    
+    Returns:
+        Snapshot that POST /agents/import restores without re-extracting anything
+    """
+    return StreamingResponse(
+        export_agents(format),
+        media_type=MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="agents.{format}"'}
+    )
+
+@router.post("/agents/import", status_code=201, response_model=Dict[str, int])
+async def import_agents_route(
+    snapshot: UploadFile,
+    format: Literal["msgpack", "ndjson"] = MSGPACK,
+    keep_ids: bool = False
+):
+    """
+    Restore agents from a snapshot produced by GET /agents/export
+    
+    Args:
+        snapshot: Snapshot file
+        format: "msgpack" or "ndjson"
+        keep_ids: Keep agent IDs from the snapshot instead of assigning new ones
+    
+    Returns:
+        Number of agents imported
+    """
+    try:
+        imported = await import_agents(snapshot.file, format, keep_ids)
+        return {"imported": imported}
+    except SnapshotFormatError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except BulkWriteError as e:
+        raise HTTPException(
+            status_code=409,
+            detail=f"Some agents already exist. Imported: {e.details.get('nInserted', 0)}, Failed: {len(e.details.get('writeErrors', []))}"
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=DefaultErrorMessages.INTERNAL_SERVER_ERROR)
+    
+@router.get("/agents/{agent_id}", status_code=200, response_model=Union[AgentDB, AgentFileListing, AgentMetadata])
 async def get_agent_route(
     agent_id: str,
+    fields: Literal["full", "files", "metadata"] = "full",
+    offset: int = Query(0, ge=0),
+    limit: Optional[int] = Query(None, ge=1)
 ):
     """
     Get a research agent by ID
 
     Args:
         agent_id: ID of the agent to retrieve
+        fields: "full" for the whole agent, "files" for file and website names and
+            token counts without their text, "metadata" for name and totals only
+        offset: Number of files (and websites) to skip
+        limit: Maximum number of files (and websites) to return
 
     Returns:
         Agent details
     """
     try:
-        agent = await get_agent(agent_id)
+        if fields == "metadata":
+            return await get_agent_metadata(agent_id) or AgentMetadata(name="")
+        if fields == "files":
+            return await get_agent_file_listing(agent_id, offset, limit) or AgentFileListing(name="")
+        
+        agent = await get_agent_page(agent_id, offset, limit)
         if not agent:
             return AgentDB(name="")
+        # Streaming depends on the size of the page being returned, not of the whole agent
+        page_tokens = sum(item.tokens for item in agent.files + agent.websites)
+        if page_tokens >= STREAM_AGENT_MIN_TOKENS:
+            return stream_agent(agent)
         return agent
     except ValueError as e:
         location = ["path", "agent_id"] if DefaultErrorMessages.INVALID_AGENT_ID in str(e) else None
@@ -155,13 +326,10 @@ async def update_agent_websites_route(
     This is part of the bonus assignment.
     """
     try:
-        agent = await get_agent(agent_id)
-        if not agent:
+        current_tokens = await get_agent_token_total(agent_id)
+        if current_tokens is None:
             return
         
-        current_tokens = sum(file.tokens for file in agent.files)
-        current_tokens += sum(website.tokens for website in agent.websites)
-        
         website_files = []
         
         for url in websites:
@@ -197,29 +365,38 @@ async def update_agent_websites_route(
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
     
-@router.put("/agents/{agent_id}/files", status_code=204)
+@router.put(
+    "/agents/{agent_id}/files",
+    status_code=204,
+    responses={202: {"model": Dict[str, str], "description": "Files accepted for background ingestion"}}
+)
 async def update_agent_files_route(
     agent_id: str,
-    files: List[UploadFile]
+    files: List[UploadFile],
+    background_tasks: BackgroundTasks,
+    background: bool = False,
+    summarize: bool = False
 ):
     """
     Extracts text from the files uploaded, populating the agent's file list.
+    With background=true the upload is accepted with 202 and an ingestion ID to poll.
+    With summarize=true files too large to use whole are stored with a digest.
     """
     try:
-        agent = await get_agent(agent_id)
-        if not agent:
+        current_tokens = await get_agent_token_total(agent_id)
+        if current_tokens is None:
             return
         
-        file_records = []
-        current_tokens = sum(file.tokens for file in agent.files)
-        current_tokens += sum(website.tokens for website in agent.websites)
+        if background:
+            ingestion_id = await start_ingestion(agent_id, files, current_tokens, background_tasks, summarize)
+            return ORJSONResponse(status_code=202, content={"ingestion_id": ingestion_id})
         
-        file_records, new_tokens = await process_files(files, current_tokens)
+        file_records, total_tokens = await process_files(files, current_tokens, summarize)
         
-        if current_tokens + new_tokens > token_manager.max_tokens:
+        if total_tokens > token_manager.max_tokens:
             raise HTTPException(
                 status_code=400,
-                detail=f"Token limit exceeded. Current: {current_tokens}, Additional: {new_tokens}, Total would be: {current_tokens + new_tokens}, Max: {token_manager.max_tokens}"
+                detail=f"Token limit exceeded. Current: {current_tokens}, Additional: {total_tokens - current_tokens}, Total would be: {total_tokens}, Max: {token_manager.max_tokens}"
             )
         
         await update_agent_files(agent_id, file_records)
@@ -228,10 +405,173 @@ async def update_agent_files_route(
     except Exception as e:
         raise HTTPException(status_code=500, detail=DefaultErrorMessages.INTERNAL_SERVER_ERROR)
 
+@router.put("/agents/{agent_id}/files/{file_id}", status_code=204)
+async def replace_agent_file_route(
+    agent_id: str,
+    file_id: str,
+    file: UploadFile,
+    summarize: bool = False
+):
+    """
+    Replace one file of the agent with a new upload. Only the new file is extracted;
+    the file keeps its ID and position and the token total is adjusted.
+    
+    Args:
+        agent_id: ID of the agent
+        file_id: ID of the file to replace
+        file: Replacement file
+        summarize: Store a digest of the file if it is too large to use whole
+    """
+    try:
+        current_tokens = await get_agent_token_total(agent_id)
+        existing = await get_agent_file(agent_id, file_id) if current_tokens is not None else None
+        if not existing:
+            raise HTTPException(status_code=404, detail="File not found")
+        
+        file_records, _ = await process_files([file], current_tokens - existing.tokens, summarize)
+        
+        if not await replace_agent_file(agent_id, file_id, file_records[0]):
+            raise HTTPException(status_code=404, detail="File not found")
+    except ValueError as e:
+        location = ["path", "agent_id"] if DefaultErrorMessages.INVALID_AGENT_ID in str(e) else None
+        raise handle_validation_error(e, location=location)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=DefaultErrorMessages.INTERNAL_SERVER_ERROR)
+
+@router.delete("/agents/{agent_id}/files/{file_id}", status_code=204)
+async def delete_agent_file_route(
+    agent_id: str,
+    file_id: str
+):
+    """
+    Delete one file of the agent and subtract its tokens from the total
+    
+    Args:
+        agent_id: ID of the agent
+        file_id: ID of the file to delete
+    """
+    try:
+        if not await delete_agent_file(agent_id, file_id):
+            raise HTTPException(status_code=404, detail="File not found")
+    except ValueError as e:
+        location = ["path", "agent_id"] if DefaultErrorMessages.INVALID_AGENT_ID in str(e) else None
+        raise handle_validation_error(e, location=location)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=DefaultErrorMessages.INTERNAL_SERVER_ERROR)
+
+@router.put("/agents/{agent_id}/websites/{website_id}", status_code=204)
+async def replace_agent_website_route(
+    agent_id: str,
+    website_id: str,
+    url: Optional[str] = Body(None, embed=True)
+):
+    """
+    Re-crawl one website of the agent, or replace it with another URL. The website
+    keeps its ID and position and the token total is adjusted.
+    
+    Args:
+        agent_id: ID of the agent
+        website_id: ID of the website to replace
+        url: New URL, defaults to the website's current URL
+    """
+    try:
+        current_tokens = await get_agent_token_total(agent_id)
+        existing = await get_agent_website(agent_id, website_id) if current_tokens is not None else None
+        if not existing:
+            raise HTTPException(status_code=404, detail="Website not found")
+        
+        url = url or existing.name
+        try:
+            if not url.startswith("https"):
+                raise ValueError("URL must start with 'https'")
+            text, tokens = document_extractor.extract_from_website(url)
+        except Exception as e:
+            raise HTTPException(
+                status_code=500,
+                detail=f"Failed to extract text from website {url}: {str(e)}"
+            )
+        
+        would_exceed, _ = token_manager.check_token_limit(current_tokens - existing.tokens, tokens)
+        if would_exceed:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Token limit exceeded. Max: {token_manager.max_tokens}"
+            )
+        
+        if not await replace_agent_website(agent_id, website_id, FileModel(name=url, text=text, tokens=tokens)):
+            raise HTTPException(status_code=404, detail="Website not found")
+    except ValueError as e:
+        location = ["path", "agent_id"] if DefaultErrorMessages.INVALID_AGENT_ID in str(e) else None
+        raise handle_validation_error(e, location=location)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=DefaultErrorMessages.INTERNAL_SERVER_ERROR)
+
+@router.delete("/agents/{agent_id}/websites/{website_id}", status_code=204)
+async def delete_agent_website_route(
+    agent_id: str,
+    website_id: str
+):
+    """
+    Delete one website of the agent and subtract its tokens from the total
+    
+    Args:
+        agent_id: ID of the agent
+        website_id: ID of the website to delete
+    """
+    try:
+        if not await delete_agent_website(agent_id, website_id):
+            raise HTTPException(status_code=404, detail="Website not found")
+    except ValueError as e:
+        location = ["path", "agent_id"] if DefaultErrorMessages.INVALID_AGENT_ID in str(e) else None
+        raise handle_validation_error(e, location=location)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=DefaultErrorMessages.INTERNAL_SERVER_ERROR)
+
+@router.get("/agents/{agent_id}/ingestions/{ingestion_id}", status_code=200, response_model=IngestionDB)
+async def get_ingestion_route(
+    agent_id: str,
+    ingestion_id: str
+):
+    """
+    Get the progress of a background ingestion
+    
+    Args:
+        agent_id: ID of the agent the files are added to
+        ingestion_id: ID returned when the upload was accepted
+    
+    Returns:
+        Overall status plus per-file stage, token counts and errors
+    """
+    try:
+        ingestion = await get_ingestion(agent_id, ingestion_id)
+        if not ingestion:
+            raise HTTPException(status_code=404, detail="Ingestion not found")
+        return ingestion
+    except ValueError as e:
+        location = ["path", "agent_id"] if DefaultErrorMessages.INVALID_AGENT_ID in str(e) else None
+        raise handle_validation_error(e, location=location)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=DefaultErrorMessages.INTERNAL_SERVER_ERROR)
+
 @router.post("/agents/{agent_id}/queries", status_code=201)
 async def send_message_route(
+    request: Request,
     agent_id: str,
-    message: Message
+    message: Message,
+    full_text: bool = False,
+    context: Optional[Literal["inline", "lookup"]] = None,
+    deadline_seconds: Optional[float] = Query(None, gt=0),
+    max_steps: Optional[int] = Query(None, ge=1)
 ):
     """
     Sends a user prompt to the Research Agent and returns the research conducted
@@ -239,9 +579,14 @@ async def send_message_route(
     Args:
         agent_id: ID of the agent to send the message to
         message: Message containing the user prompt
+        full_text: Use the full text of summarized files instead of their digest
+        context: "inline" to include the knowledge base in the prompt, "lookup" to include
+            a table of contents and let the model read sources with a tool. Defaults to KB_CONTEXT_MODE
+        deadline_seconds: Seconds the research may take. Defaults to RESEARCH_DEADLINE_SECONDS
+        max_steps: Tool-calling steps the research may take. Defaults to RESEARCH_MAX_STEPS
         
     Returns:
-        Research results
+        Research results, with whether the research was truncated and the steps it used
     """
     try:
         query = message.message
@@ -250,16 +595,36 @@ async def send_message_route(
         if not agent:
             return {"role": "system", "content": "Agent not found."}
         
+        has_summaries = any(item.summary is not None for item in [*agent.files, *agent.websites])
+        if (context or KB_CONTEXT_MODE) == "lookup":
+            knowledge_context = build_knowledge_toc(agent.files, agent.websites)
+            lookup = bool(knowledge_context)
+        else:
+            full_text = full_text and has_summaries
+            if full_text:
+                knowledge_prompt = await run_in_threadpool(create_knowledge_prompt, agent.files, agent.websites, token_manager, True)
+            else:
+                knowledge_prompt = await get_knowledge_prompt(agent)
+            knowledge_context = await run_in_threadpool(context_packer.pack, query, knowledge_prompt, agent.files, agent.websites, full_text)
+            # Sources left out of the packed context or summarized can still be read on demand
+            lookup = knowledge_context != knowledge_prompt.text or (has_summaries and not full_text)
+        
+        await sync_vector_index(agent)
+        
         llm_setup = LLMSetup()
-        tool_setup = ToolSetup()
-        langgraph_setup = LangGraphSetup(llm_setup, tool_setup, agent.files, agent.websites)
+        tool_setup = ToolSetup(agent, vector_index_store, lookup=lookup)
+        budget = ResearchBudget(deadline_seconds, max_steps)
+        langgraph_setup = LangGraphSetup(llm_setup, tool_setup, agent.files, agent.websites, knowledge_prompt=knowledge_context, budget=budget)
 
         await update_agent_messages(agent_id, query)
         
-        messages = langgraph_setup.research(query)
+        # Cancelling on disconnect also cancels the model call in flight
+        messages = await run_until_disconnected(request, langgraph_setup.aresearch(query), langgraph_setup.cancel)
             
         return messages[-1] if messages else {"role": "assistant", "content": "No response generated."}
         
+    except ClientDisconnected:
+        return Response(status_code=499)
     except ValueError as e:
         location = ["path", "agent_id"] if DefaultErrorMessages.INVALID_AGENT_ID in str(e) else None
         raise handle_validation_error(e, location=location)
@@ -0,0 +1,18 @@
+from fastapi import APIRouter
+from typing import Dict
+from utils.metrics import metrics
+from utils.text_compression import compression_stats
+
+router = APIRouter()
+
+@router.get("/metrics", status_code=200, response_model=Dict[str, object])
+async def get_metrics_route():
+    """
+    Process-local performance metrics
+    
+    Returns:
+        Counters and gauges recorded since startup, plus derived knowledge base text stats
+    """
+    values = metrics.snapshot()
+    values.update({f"kb_text.{key}": value for key, value in compression_stats().items()})
+    return values
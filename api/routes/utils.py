@@ -1,4 +1,8 @@
-from fastapi import HTTPException
+from fastapi import HTTPException, Request
+from typing import Awaitable, Callable, TypeVar
+import asyncio
+
+T = TypeVar("T")
 
 class DefaultErrorMessages:
     """Default error messages used in API routes."""
@@ -8,6 +12,9 @@ class DefaultErrorMessages:
     INVALID_JSON_FORMAT = "Invalid JSON format"
     INTERNAL_SERVER_ERROR = "Internal server error occurred"
     
+class ClientDisconnected(Exception):
+    """Raised when the client went away before its request was answered."""
+
 def handle_validation_error(error, location=None):
     """Convert a ValueError to a structured HTTPException"""
     if location:
@@ -26,4 +33,35 @@ def handle_validation_error(error, location=None):
             "msg": str(error),
             "type": "value_error"
         }]
-    )
\ No newline at end of file
+    )
+
+async def run_until_disconnected(
+    request: Request,
+    work: Awaitable[T],
+    on_disconnect: Callable[[], None],
+    poll_seconds: float = 0.5
+) -> T:
+    """
+    Await `work` while watching the client connection.
+    
+    Args:
+        request: The request being answered.
+        work: Awaitable producing the response.
+        on_disconnect: Called once if the client disconnects first, to stop the work.
+        poll_seconds: Seconds between connection checks.
+    
+    Returns:
+        The result of `work`.
+    
+    Raises:
+        ClientDisconnected: If the client disconnected before `work` finished.
+    """
+    task = asyncio.ensure_future(work)
+    while True:
+        done, _ = await asyncio.wait({task}, timeout=poll_seconds)
+        if done:
+            return task.result()
+        if await request.is_disconnected():
+            on_disconnect()
+            task.cancel()
+            raise ClientDisconnected()
\ No newline at end of file
@@ -0,0 +1,67 @@
+"""
+Agent serialization benchmark.
+
+Encodes a synthetic agent close to the knowledge base token limit with FastAPI's
+default JSON path, with orjson, and with the streamed writer used for large agents,
+reporting time and peak Python memory of each.
+
+Usage:
+    python benchmarks/agent_serialization.py [--files 40] [--chars 12000]
+"""
+import argparse
+import json
+import os
+import random
+import string
+import sys
+import time
+import tracemalloc
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT_ROOT)
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+
+from api.routes.agents import encode_knowledge_item
+from fastapi.encoders import jsonable_encoder
+from models.agents import AgentDB, File
+from utils.json_stream import iter_model_json
+import orjson
+
+def build_agent(files: int, chars: int) -> AgentDB:
+    rng = random.Random(0)
+    words = ["".join(rng.choices(string.ascii_lowercase, k=rng.randint(3, 9))) for _ in range(2000)]
+    knowledge = [
+        File(id=str(i), name=f"document_{i}.pdf", text=" ".join(rng.choices(words, k=chars // 6)), tokens=chars // 4)
+        for i in range(files)
+    ]
+    for file in knowledge:
+        # Start from the stored form, as an agent loaded from MongoDB would
+        file._text = None
+    return AgentDB.model_construct(name="Benchmark", files=knowledge, websites=[], messages=[], total_tokens=sum(f.tokens for f in knowledge))
+
+def measure(name: str, encode):
+    tracemalloc.start()
+    start = time.perf_counter()
+    size = encode()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{name:<12} {elapsed * 1000:>10.1f} {peak / 1e6:>10.1f} {size / 1e6:>10.2f}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare agent JSON serialization paths")
+    parser.add_argument("--files", type=int, default=40, help="Files in the agent")
+    parser.add_argument("--chars", type=int, default=12000, help="Characters of text per file")
+    args = parser.parse_args()
+    
+    print(f"{'path':<12} {'ms':>10} {'peak MB':>10} {'out MB':>10}")
+    for name, encode in (
+        ("default", lambda agent: len(json.dumps(jsonable_encoder(agent)).encode("utf-8"))),
+        ("orjson", lambda agent: len(orjson.dumps(agent.model_dump(mode="json", by_alias=True)))),
+        ("streamed", lambda agent: sum(len(chunk) for chunk in iter_model_json(agent, ("files", "websites"), encode_knowledge_item))),
+    ):
+        agent = build_agent(args.files, args.chars)
+        measure(name, lambda: encode(agent))
+
+if __name__ == "__main__":
+    main()
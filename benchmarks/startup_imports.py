@@ -0,0 +1,56 @@
+"""
+Startup-time benchmark.
+
+Measures, each in a fresh interpreter, how long it takes to import the FastAPI app
+and each of the Unstructured partition backends that DocumentExtractor loads lazily.
+
+Usage:
+    python benchmarks/startup_imports.py [--runs 3]
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT_ROOT)
+
+from utils.document_extractor import PARTITIONERS
+
+def time_import(module_name: str) -> float:
+    """
+    Import a module in a new interpreter and return the import time in seconds.
+    """
+    code = (
+        "import time\n"
+        "start = time.perf_counter()\n"
+        f"import {module_name}\n"
+        "print(time.perf_counter() - start)\n"
+    )
+    env = dict(os.environ)
+    env.setdefault("OPENAI_API_KEY", "benchmark")
+    result = subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=PROJECT_ROOT,
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True
+    )
+    return float(result.stdout.strip().splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure API startup and per-backend import cost")
+    parser.add_argument("--runs", type=int, default=3, help="Fresh interpreters per module")
+    args = parser.parse_args()
+    
+    modules = ["main"] + sorted({partitioner.module_name for partitioner in PARTITIONERS.values()})
+    
+    print(f"{'module':<40} {'median ms':>10} {'min ms':>10}")
+    for module_name in modules:
+        timings = [time_import(module_name) for _ in range(args.runs)]
+        print(f"{module_name:<40} {statistics.median(timings) * 1000:>10.0f} {min(timings) * 1000:>10.0f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""
+Offline Wikipedia lookup benchmark.
+
+Builds an index from a synthetic abstracts dump (or uses an existing index) and
+measures the latency of title lookups and term searches, fully offline. "common"
+searches use terms found in about 8% of the articles, the longest postings a search reads.
+
+Usage:
+    python benchmarks/wikipedia_lookup.py [--articles 100000] [--lookups 10000] [--index data/wikipedia]
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT_ROOT)
+
+from utils.wikipedia_index import WikipediaIndex, build_wikipedia_index
+
+WORDS = ["river", "company", "album", "village", "species", "football", "district", "railway", "novel", "election", "church", "island"]
+# Each abstract names 4 of these 50 topics, so every topic is in about 8% of the articles,
+# just under the index's document frequency cut-off: the longest postings a search reads
+TOPICS = [start + end for start in ("bar", "cor", "del", "fin", "gal") for end in ("ano", "ert", "ist", "ond", "ura", "ive", "ax", "um", "el", "op")]
+
+def write_dump(path: str, articles: int):
+    rng = random.Random(0)
+    with open(path, "w", encoding="utf-8") as f:
+        for i in range(articles):
+            title = f"{rng.choice(WORDS).title()} {i}"
+            abstract = " ".join(rng.choice(WORDS) for _ in range(40)) + " " + " ".join(rng.sample(TOPICS, 4)) + "."
+            f.write(json.dumps({"title": title, "url": f"https://en.wikipedia.org/wiki/{title.replace(' ', '_')}", "abstract": abstract}) + "\n")
+
+def report(name: str, seconds: list):
+    seconds = sorted(seconds)
+    print(f"{name:<8} {statistics.mean(seconds) * 1e6:>10.1f} {seconds[len(seconds) // 2] * 1e6:>10.1f} {seconds[int(len(seconds) * 0.99)] * 1e6:>10.1f}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure offline Wikipedia lookup latency")
+    parser.add_argument("--articles", type=int, default=100000, help="Articles in the synthetic dump")
+    parser.add_argument("--lookups", type=int, default=10000, help="Lookups per measurement")
+    parser.add_argument("--index", default=None, help="Existing index directory; a synthetic one is built if omitted")
+    args = parser.parse_args()
+    
+    with tempfile.TemporaryDirectory() as directory:
+        path = args.index
+        if path is None:
+            path = os.path.join(directory, "index")
+            dump = os.path.join(directory, "abstracts.jsonl")
+            write_dump(dump, args.articles)
+            start = time.perf_counter()
+            build_wikipedia_index(dump, path)
+            print(f"Built an index of {args.articles} articles in {time.perf_counter() - start:.1f}s")
+        
+        index = WikipediaIndex(path)
+        rng = random.Random(1)
+        titles = [index.article(rng.randrange(len(index)))["title"] for _ in range(args.lookups)]
+        topics = [" ".join(rng.sample(TOPICS, 2)) for _ in range(args.lookups)]
+        
+        print(f"{'lookup':<8} {'mean us':>10} {'p50 us':>10} {'p99 us':>10}")
+        for name, lookup, queries in (
+            ("title", index.get, titles),
+            ("search", lambda title: index.search(title, limit=5), titles),
+            ("common", lambda query: index.search(query, limit=5), topics),
+        ):
+            seconds = []
+            for query in queries:
+                start = time.perf_counter()
+                lookup(query)
+                seconds.append(time.perf_counter() - start)
+            report(name, seconds)
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,32 @@
 from bson.objectid import ObjectId
 from db.errors import InvalidAgentIDError
-from models.agents import AgentDB, CreateAgent, File as FileModel
-from typing import List
+from models.agents import AgentDB, AgentFileListing, AgentMetadata, CreateAgent, File as FileModel, FileListing
+from typing import List, Optional
+from utils.knowledge_prompt import create_knowledge_prompt, knowledge_version
+from utils.vector_index import vector_index_store
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+METADATA_PROJECTION = {
+    "_id": 1,
+    "name": 1,
+    "total_tokens": 1,
+    "file_count": {"$size": {"$ifNull": ["$files", []]}},
+    "website_count": {"$size": {"$ifNull": ["$websites", []]}},
+    "deduplicated_tokens": {"$ifNull": ["$knowledge_prompt.saved_tokens", 0]},
+}
+
+KNOWLEDGE_FIELDS = ("files", "websites")
+
+def _assign_item_ids(items: List[FileModel]):
+    """
+    Give files and websites that are about to be stored their stable IDs
+    """
+    for item in items:
+        if not item.id:
+            item.id = str(ObjectId())
 
 async def create_agent(new_agent: CreateAgent):
     """
@@ -14,8 +39,15 @@ async def create_agent(new_agent: CreateAgent):
         Newly created agent
     """
     try:
-        new_agent = AgentDB(name=new_agent.name, files=new_agent.files)
+        _assign_item_ids(new_agent.files)
+        new_agent = AgentDB(
+            name=new_agent.name,
+            files=new_agent.files,
+            total_tokens=sum(file.tokens for file in new_agent.files),
+            knowledge_prompt=create_knowledge_prompt(new_agent.files)
+        )
         await new_agent.insert()
+        await sync_vector_index(new_agent)
         
         return new_agent
     except:
@@ -35,6 +67,9 @@ async def get_agent(agent_id: str):
         if not ObjectId.is_valid(agent_id):
             raise InvalidAgentIDError(agent_id)
         agent = await AgentDB.get(agent_id)
+        if agent and any(item.id is None for item in agent.files + agent.websites):
+            await backfill_item_ids(agent_id)
+            agent = await AgentDB.get(agent_id)
         return agent
     except:
         raise
@@ -56,33 +91,287 @@ async def delete_agent(agent_id: str):
         if not agent:
             return None
         await agent.delete()
+        vector_index_store.drop(agent_id)
     except:
         raise
     
-async def update_agent_files(agent_id: str, new_files: List[FileModel]):
+async def backfill_item_ids(agent_id: str):
     """
-    Append agent files
+    Assign IDs to files and websites stored before items had stable IDs.
+    
+    Args:
+        agent_id: ID of the agent to update
+    """
+    try:
+        if not ObjectId.is_valid(agent_id):
+            raise InvalidAgentIDError(agent_id)
+        
+        results = await AgentDB.find(AgentDB.id == ObjectId(agent_id)).aggregate([
+            {"$project": {
+                field: {"$map": {"input": {"$ifNull": [f"${field}", []]}, "as": "item", "in": {"$ifNull": ["$$item.id", None]}}}
+                for field in KNOWLEDGE_FIELDS
+            }}
+        ]).to_list()
+        if not results:
+            return
+        
+        for field in KNOWLEDGE_FIELDS:
+            missing = [index for index, item_id in enumerate(results[0].get(field) or []) if item_id is None]
+            if not missing:
+                continue
+            # Only fill positions that still lack an ID, in case the array changed since it was read
+            await AgentDB.find_one(
+                {"_id": ObjectId(agent_id), **{f"{field}.{index}.id": {"$exists": False} for index in missing}}
+            ).update({"$set": {f"{field}.{index}.id": str(ObjectId()) for index in missing}})
+    except:
+        raise
+    
+async def refresh_agent_token_total(agent_id: str):
+    """
+    Recompute and store the token total of an agent from its files and websites.
+    Used for agents stored before the total was maintained.
     
     Args:
         agent_id: ID of the agent to update
-        new_files: List of files to append to agent files
     
     Returns:
-        Updated agent or None if agent doesn't exist
+        The token total, or None if agent doesn't exist
     """
     try:
         if not ObjectId.is_valid(agent_id):
             raise InvalidAgentIDError(agent_id)
         
-        agent = await AgentDB.get(agent_id)
+        results = await AgentDB.find(AgentDB.id == ObjectId(agent_id)).aggregate([
+            {"$project": {"file_tokens": "$files.tokens", "website_tokens": "$websites.tokens"}}
+        ]).to_list()
+        if not results:
+            return None
+        
+        total_tokens = sum(results[0].get("file_tokens") or []) + sum(results[0].get("website_tokens") or [])
+        await AgentDB.find_one(AgentDB.id == ObjectId(agent_id)).update({"$set": {"total_tokens": total_tokens}})
+        return total_tokens
+    except:
+        raise
+
+async def _find_projected(agent_id: str, projection: dict, projection_model):
+    """
+    Fetch one agent through an aggregation $project into a projection model,
+    backfilling the token total of agents stored before it was maintained
+    """
+    results = await AgentDB.find(AgentDB.id == ObjectId(agent_id)).aggregate(
+        [{"$project": projection}],
+        projection_model=projection_model
+    ).to_list()
+    if not results:
+        return None
+    
+    agent = results[0]
+    if agent.total_tokens is None:
+        agent.total_tokens = await refresh_agent_token_total(agent_id)
+    return agent
+
+async def get_agent_metadata(agent_id: str):
+    """
+    Get an agent without its knowledge base
+    
+    Args:
+        agent_id: ID of the agent to retrieve
+    
+    Returns:
+        AgentMetadata or None if not found
+    """
+    try:
+        if not ObjectId.is_valid(agent_id):
+            raise InvalidAgentIDError(agent_id)
+        
+        return await _find_projected(agent_id, METADATA_PROJECTION, AgentMetadata)
+    except:
+        raise
+
+async def get_agent_token_total(agent_id: str):
+    """
+    Get the tokens used by an agent's files and websites without loading them
+    
+    Args:
+        agent_id: ID of the agent
+    
+    Returns:
+        Token total or None if agent doesn't exist
+    """
+    metadata = await get_agent_metadata(agent_id)
+    return metadata.total_tokens if metadata else None
+
+def _page(field: str, offset: int = 0, limit: Optional[int] = None) -> dict:
+    """
+    Aggregation expression of a page of an agent's files or websites
+    """
+    items = {"$ifNull": [f"${field}", []]}
+    if offset or limit is not None:
+        # The count of the three-argument $slice must be positive, even for an empty list
+        count = limit if limit is not None else {"$max": [1, {"$size": items}]}
+        items = {"$slice": [items, offset, count]}
+    return items
+
+async def get_agent_page(agent_id: str, offset: int = 0, limit: Optional[int] = None):
+    """
+    Get an agent as the API returns it, with a page of its files and websites.
+    Only the requested items are read from MongoDB, and the precomputed knowledge
+    prompt, which the API never returns, is left out.
+    
+    Args:
+        agent_id: ID of the agent to retrieve
+        offset: Number of files (and websites) to skip
+        limit: Maximum number of files (and websites) to return, None for all
+    
+    Returns:
+        AgentDB without its knowledge prompt, or None if not found
+    """
+    try:
+        if not ObjectId.is_valid(agent_id):
+            raise InvalidAgentIDError(agent_id)
         
-        agent.files.extend(new_files)
+        projection = {"_id": 1, "name": 1, "messages": 1, "total_tokens": 1}
+        projection.update({field: _page(field, offset, limit) for field in KNOWLEDGE_FIELDS})
         
-        await agent.save()
+        agent = await _find_projected(agent_id, projection, AgentDB)
+        if agent and any(item.id is None for item in agent.files + agent.websites):
+            await backfill_item_ids(agent_id)
+            agent = await _find_projected(agent_id, projection, AgentDB)
+        return agent
+    except:
+        raise
+
+async def get_agent_file_listing(agent_id: str, offset: int = 0, limit: Optional[int] = None):
+    """
+    Get an agent with a page of its files and websites, without their text
+    
+    Args:
+        agent_id: ID of the agent to retrieve
+        offset: Number of files (and websites) to skip
+        limit: Maximum number of files (and websites) to return, None for all
+    
+    Returns:
+        AgentFileListing or None if not found
+    """
+    try:
+        if not ObjectId.is_valid(agent_id):
+            raise InvalidAgentIDError(agent_id)
+        
+        def listing(field: str):
+            return {"$map": {"input": _page(field, offset, limit), "as": "item", "in": {"id": "$$item.id", "name": "$$item.name", "tokens": "$$item.tokens"}}}
+        
+        projection = dict(METADATA_PROJECTION)
+        projection.update({field: listing(field) for field in KNOWLEDGE_FIELDS})
         
+        agent = await _find_projected(agent_id, projection, AgentFileListing)
+        if agent and any(item.id is None for item in agent.files + agent.websites):
+            await backfill_item_ids(agent_id)
+            agent = await _find_projected(agent_id, projection, AgentFileListing)
         return agent
     except:
         raise
+
+async def _append_knowledge(agent_id: str, field: str, new_items: List[FileModel]):
+    """
+    Atomically append files or websites and add their tokens to the agent's total
+    """
+    if not ObjectId.is_valid(agent_id):
+        raise InvalidAgentIDError(agent_id)
+    
+    _assign_item_ids(new_items)
+    tokens = sum(item.tokens for item in new_items)
+    push = {"$push": {field: {"$each": new_items}}}
+    
+    result = await AgentDB.find_one({"_id": ObjectId(agent_id), "total_tokens": {"$type": "number"}}).update(
+        {**push, "$inc": {"total_tokens": tokens}}
+    )
+    if result is None or not result.matched_count:
+        result = await AgentDB.find_one({"_id": ObjectId(agent_id)}).update(push)
+        if result is not None and result.matched_count:
+            await refresh_agent_token_total(agent_id)
+
+async def sync_vector_index(agent: AgentDB):
+    """
+    Embed an agent's new or replaced files and websites into its vector index, when
+    indexing is enabled. The index is derived data, so failures are logged, not raised.
+    
+    Args:
+        agent: Agent loaded with its files and websites
+    """
+    if not vector_index_store.enabled:
+        return
+    try:
+        await asyncio.to_thread(vector_index_store.sync, agent)
+    except Exception as e:
+        logger.warning(f"Failed to update the vector index of agent {agent.id}: {str(e)}")
+
+async def refresh_knowledge_prompt(agent_id: str):
+    """
+    Rebuild and store the knowledge prompt of an agent after its knowledge base changed,
+    and update its vector index
+    
+    Args:
+        agent_id: ID of the agent to update
+    
+    Returns:
+        The new KnowledgePrompt, or None if agent doesn't exist
+    """
+    try:
+        if not ObjectId.is_valid(agent_id):
+            raise InvalidAgentIDError(agent_id)
+        agent = await AgentDB.get(agent_id)
+        if not agent:
+            return None
+        
+        knowledge_prompt = create_knowledge_prompt(agent.files, agent.websites)
+        await AgentDB.find_one(AgentDB.id == agent.id).update({"$set": {"knowledge_prompt": knowledge_prompt}})
+        await sync_vector_index(agent)
+        return knowledge_prompt
+    except:
+        raise
+
+async def get_knowledge_prompt(agent: AgentDB):
+    """
+    Get the precomputed knowledge prompt of a loaded agent, rebuilding it only if
+    it is missing or was built from a different knowledge base
+    
+    Args:
+        agent: Agent loaded with its files and websites
+    
+    Returns:
+        KnowledgePrompt matching the agent's current files and websites
+    """
+    try:
+        knowledge_prompt = agent.knowledge_prompt
+        if knowledge_prompt and knowledge_prompt.version == knowledge_version(agent.files, agent.websites):
+            return knowledge_prompt
+        
+        knowledge_prompt = create_knowledge_prompt(agent.files, agent.websites)
+        await AgentDB.find_one(AgentDB.id == agent.id).update({"$set": {"knowledge_prompt": knowledge_prompt}})
+        agent.knowledge_prompt = knowledge_prompt
+        return knowledge_prompt
+    except:
+        raise
+
+async def update_agent_files(agent_id: str, new_files: List[FileModel], refresh_prompt: bool = True):
+    """
+    Append agent files
+    
+    Args:
+        agent_id: ID of the agent to update
+        new_files: List of files to append to agent files
+        refresh_prompt: Rebuild the knowledge prompt afterwards. Callers appending
+            several batches pass False and call refresh_knowledge_prompt once at the end.
+    
+    Returns:
+        None
+    """
+    try:
+        await _append_knowledge(agent_id, "files", new_files)
+        if refresh_prompt:
+            await refresh_knowledge_prompt(agent_id)
+    except:
+        raise
     
 async def update_agent_messages(agent_id: str, message: str):
     """
@@ -93,19 +382,13 @@ async def update_agent_messages(agent_id: str, message: str):
         message: Message to append to agent messages
         
     Returns:
-        Updated agent or None if agent doesn't exist
+        None
     """
     try:
         if not ObjectId.is_valid(agent_id):
             raise InvalidAgentIDError(agent_id)
         
-        agent = await AgentDB.get(agent_id)
-        
-        agent.messages.append(message)
-        
-        await agent.save()
-        
-        return agent
+        await AgentDB.find_one(AgentDB.id == ObjectId(agent_id)).update({"$push": {"messages": message}})
     except:
         raise
     
@@ -118,18 +401,201 @@ async def update_agent_websites(agent_id: str, new_websites: List[FileModel]):
         websites: List of websites to update agent websites
         
     Returns:
-        Updated agent or None if agent doesn't exist
+        None
     """
     try:
-        if not ObjectId.is_valid(agent_id):
-            raise InvalidAgentIDError(agent_id)
-        
-        agent = await AgentDB.get(agent_id)
-        
-        agent.websites.extend(new_websites)
-        
-        await agent.save()
-        
-        return agent
+        await _append_knowledge(agent_id, "websites", new_websites)
+        await refresh_knowledge_prompt(agent_id)
+    except:
+        raise
+
+async def _get_item(agent_id: str, field: str, item_id: str):
+    """
+    Get the name and tokens of one file or website without loading the others
+    """
+    if not ObjectId.is_valid(agent_id):
+        raise InvalidAgentIDError(agent_id)
+    
+    results = await AgentDB.find(AgentDB.id == ObjectId(agent_id)).aggregate([
+        {"$project": {"items": {"$filter": {
+            "input": {"$ifNull": [f"${field}", []]},
+            "as": "item",
+            "cond": {"$eq": ["$$item.id", item_id]}
+        }}}}
+    ]).to_list()
+    if not results or not results[0].get("items"):
+        return None
+    
+    item = results[0]["items"][0]
+    return FileListing(id=item["id"], name=item["name"], tokens=item.get("tokens", 0))
+
+async def _delete_item(agent_id: str, field: str, item_id: str):
+    """
+    Atomically remove one file or website and subtract its tokens from the agent's total
+    """
+    if await get_agent_token_total(agent_id) is None:
+        return None
+    item = await _get_item(agent_id, field, item_id)
+    if not item:
+        return None
+    
+    # Matching on the tokens read above keeps the total consistent if the item was replaced meanwhile
+    result = await AgentDB.find_one(
+        {"_id": ObjectId(agent_id), field: {"$elemMatch": {"id": item_id, "tokens": item.tokens}}}
+    ).update({"$pull": {field: {"id": item_id}}, "$inc": {"total_tokens": -item.tokens}})
+    if result is None or not result.matched_count:
+        return None
+    await refresh_knowledge_prompt(agent_id)
+    return item
+
+async def _replace_item(agent_id: str, field: str, item_id: str, new_item: FileModel):
+    """
+    Atomically replace one file or website in place and adjust the agent's total
+    """
+    if await get_agent_token_total(agent_id) is None:
+        return None
+    item = await _get_item(agent_id, field, item_id)
+    if not item:
+        return None
+    
+    new_item.id = item_id
+    result = await AgentDB.find_one(
+        {"_id": ObjectId(agent_id), field: {"$elemMatch": {"id": item_id, "tokens": item.tokens}}}
+    ).update({"$set": {f"{field}.$": new_item}, "$inc": {"total_tokens": new_item.tokens - item.tokens}})
+    if result is None or not result.matched_count:
+        return None
+    await refresh_knowledge_prompt(agent_id)
+    return item
+
+async def get_agent_file(agent_id: str, file_id: str):
+    """
+    Get the name and tokens of an agent file
+    
+    Args:
+        agent_id: ID of the agent
+        file_id: ID of the file
+    
+    Returns:
+        FileListing or None if not found
+    """
+    try:
+        return await _get_item(agent_id, "files", file_id)
+    except:
+        raise
+
+async def get_agent_website(agent_id: str, website_id: str):
+    """
+    Get the URL and tokens of an agent website
+    
+    Args:
+        agent_id: ID of the agent
+        website_id: ID of the website
+    
+    Returns:
+        FileListing or None if not found
+    """
+    try:
+        return await _get_item(agent_id, "websites", website_id)
+    except:
+        raise
+
+async def delete_agent_file(agent_id: str, file_id: str):
+    """
+    Delete one agent file
+    
+    Args:
+        agent_id: ID of the agent to update
+        file_id: ID of the file to delete
+    
+    Returns:
+        Deleted file's listing or None if not found
+    """
+    try:
+        return await _delete_item(agent_id, "files", file_id)
     except:
-        raise
\ No newline at end of file
+        raise
+
+async def delete_agent_website(agent_id: str, website_id: str):
+    """
+    Delete one agent website
+    
+    Args:
+        agent_id: ID of the agent to update
+        website_id: ID of the website to delete
+    
+    Returns:
+        Deleted website's listing or None if not found
+    """
+    try:
+        return await _delete_item(agent_id, "websites", website_id)
+    except:
+        raise
+
+async def replace_agent_file(agent_id: str, file_id: str, new_file: FileModel):
+    """
+    Replace one agent file, keeping its ID and position
+    
+    Args:
+        agent_id: ID of the agent to update
+        file_id: ID of the file to replace
+        new_file: Newly extracted file
+    
+    Returns:
+        Replaced file's listing or None if not found
+    """
+    try:
+        return await _replace_item(agent_id, "files", file_id, new_file)
+    except:
+        raise
+
+async def replace_agent_website(agent_id: str, website_id: str, new_website: FileModel):
+    """
+    Replace one agent website, keeping its ID and position
+    
+    Args:
+        agent_id: ID of the agent to update
+        website_id: ID of the website to replace
+        new_website: Newly crawled website
+    
+    Returns:
+        Replaced website's listing or None if not found
+    """
+    try:
+        return await _replace_item(agent_id, "websites", website_id, new_website)
+    except:
+        raise
+
+async def iter_agent_documents(batch_size: int = 100):
+    """
+    Stream every agent as its raw stored document, without validating or decompressing it
+    
+    Args:
+        batch_size: Documents fetched from MongoDB per round trip
+    
+    Returns:
+        Async iterator of raw agent documents
+    """
+    try:
+        cursor = AgentDB.get_motor_collection().find({}, batch_size=batch_size)
+        async for document in cursor:
+            yield document
+    except:
+        raise
+
+async def insert_agent_documents(documents: List[dict]):
+    """
+    Insert raw agent documents in bulk
+    
+    Args:
+        documents: Agent documents ready to insert, as produced by a snapshot import
+    
+    Returns:
+        Number of documents inserted
+    """
+    try:
+        if not documents:
+            return 0
+        result = await AgentDB.get_motor_collection().insert_many(documents, ordered=False)
+        return len(result.inserted_ids)
+    except:
+        raise
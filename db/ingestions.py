@@ -0,0 +1,92 @@
+from bson.objectid import ObjectId
+from db.errors import InvalidAgentIDError, InvalidObjectIdError
+from models.ingestions import IngestionDB, IngestionFile, utc_now
+from typing import List, Optional
+
+async def create_ingestion(agent_id: str, file_names: List[str]):
+    """
+    Record a new ingestion with every file queued
+    
+    Args:
+        agent_id: ID of the agent the files are added to
+        file_names: Names of the uploaded files
+    
+    Returns:
+        Newly created ingestion
+    """
+    try:
+        if not ObjectId.is_valid(agent_id):
+            raise InvalidAgentIDError(agent_id)
+        
+        ingestion = IngestionDB(
+            agent_id=agent_id,
+            files=[IngestionFile(name=name) for name in file_names]
+        )
+        await ingestion.insert()
+        
+        return ingestion
+    except:
+        raise
+
+async def get_ingestion(agent_id: str, ingestion_id: str):
+    """
+    Get an ingestion of an agent by ID
+    
+    Args:
+        agent_id: ID of the agent the ingestion belongs to
+        ingestion_id: ID of the ingestion to retrieve
+    
+    Returns:
+        Ingestion or None if not found
+    """
+    try:
+        if not ObjectId.is_valid(agent_id):
+            raise InvalidAgentIDError(agent_id)
+        if not ObjectId.is_valid(ingestion_id):
+            raise InvalidObjectIdError(ingestion_id, location=["path", "ingestion_id"])
+        
+        return await IngestionDB.find_one({"_id": ObjectId(ingestion_id), "agent_id": agent_id})
+    except:
+        raise
+
+async def update_ingestion(ingestion_id: str, status: Optional[str] = None, add_tokens: int = 0):
+    """
+    Update the overall status of an ingestion
+    
+    Args:
+        ingestion_id: ID of the ingestion to update
+        status: New overall status, if it changed
+        add_tokens: Tokens persisted to the agent since the last update
+    """
+    try:
+        update = {"$set": {"updated_at": utc_now()}}
+        if status:
+            update["$set"]["status"] = status
+        if add_tokens:
+            update["$inc"] = {"tokens": add_tokens}
+        
+        await IngestionDB.find_one({"_id": ObjectId(ingestion_id)}).update(update)
+    except:
+        raise
+
+async def update_ingestion_file(ingestion_id: str, index: int, status: str, tokens: Optional[int] = None, error: Optional[str] = None):
+    """
+    Update the progress of one file of an ingestion
+    
+    Args:
+        ingestion_id: ID of the ingestion to update
+        index: Position of the file in the ingestion
+        status: Stage the file reached
+        tokens: Token count of the file, once known
+        error: Reason the file failed
+    """
+    try:
+        fields = {f"files.{index}.status": status, "updated_at": utc_now()}
+        if tokens is not None:
+            fields[f"files.{index}.tokens"] = tokens
+        if error is not None:
+            fields[f"files.{index}.error"] = error
+        
+        await IngestionDB.find_one({"_id": ObjectId(ingestion_id)}).update({"$set": fields})
+    except:
+        raise
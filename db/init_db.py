@@ -2,6 +2,7 @@ import logging
 import os
 from beanie import init_beanie
 from models.agents import AgentDB
+from models.ingestions import IngestionDB
 from motor.motor_asyncio import AsyncIOMotorClient
 from typing import Optional
 
@@ -22,6 +23,7 @@ async def init_mongodb(db_url: Optional[str] = None):
             database=client["i-love-mongo"],
             document_models=[
                 AgentDB,
+                IngestionDB,
             ]
         )
         
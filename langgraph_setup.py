@@ -1,52 +1,80 @@
+from langgraph.errors import GraphRecursionError
 from langgraph.prebuilt import create_react_agent
-from langchain_core.messages import BaseMessage
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, SystemMessage
 from llm_setup import LLMSetup
 from tool_setup import ToolSetup
+from functools import lru_cache
+from utils.knowledge_prompt import build_knowledge_prompt
+from utils.metrics import metrics
+from utils.model_router import RoutedChatModel
+from utils.research_budget import CANCELLED, DEADLINE, STEPS, ResearchBudget
+from utils.tool_cache import ToolCallCache
+from utils.tool_prefetch import ToolPrefetcher
+import asyncio
 import os
 
+SYNTHESIS_TIMEOUT_ANSWER = "The research ran out of time before an answer could be written from the information gathered."
+
+@lru_cache(maxsize=1)
+def read_base_system_prompt() -> str:
+    """
+    Read system_prompt.txt once per process
+    """
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    system_prompt_path = os.path.join(script_dir, 'system_prompt.txt')
+        
+    with open(system_prompt_path, 'r') as file:
+        return file.read()
+        
+@lru_cache(maxsize=1)
+def default_prefetcher():
+    """
+    Prefetcher shared by research runs when TOOL_PREFETCH=true, otherwise None
+    """
+    if os.getenv("TOOL_PREFETCH", "false").lower() != "true":
+        return None
+    return ToolPrefetcher(max_terms=int(os.getenv("PREFETCH_MAX_TERMS", "2")))
+        
 class LangGraphSetup:
-    def __init__(self, llm_setup=None, tool_setup=None, agent_files=None, agent_websites=None):
+    def __init__(self, llm_setup=None, tool_setup=None, agent_files=None, agent_websites=None, knowledge_prompt=None, tool_cache=None, prefetcher=None, budget=None):
         self.llm_setup = llm_setup if llm_setup else LLMSetup()
         self.tool_setup = tool_setup if tool_setup else ToolSetup()
+        # One setup serves one research run, so repeated tool calls are memoized per run
+        self.tool_cache = tool_cache if tool_cache else ToolCallCache()
+        self.prefetcher = prefetcher if prefetcher else default_prefetcher()
+        self.budget = budget if budget else ResearchBudget()
+        self._run = None
+        self._loop = None
         
-        script_dir = os.path.dirname(os.path.abspath(__file__))
-        system_prompt_path = os.path.join(script_dir, 'system_prompt.txt')
-        
-        with open(system_prompt_path, 'r') as file:
-            self.base_system_prompt = file.read()
+        self.base_system_prompt = read_base_system_prompt()
         
-        self._create_agent(agent_files, agent_websites)
+        self._create_agent(agent_files, agent_websites, knowledge_prompt)
         
-    def _create_agent(self, agent_files, agent_websites):
+    def _create_agent(self, agent_files, agent_websites, knowledge_prompt=None):
         """
-        Create or recreate the agent with optional file context from AgentDB
+        Create or recreate the agent with optional file context from AgentDB.
+        A knowledge prompt precomputed at ingest time is used as is.
         """
-        system_prompt = self._add_long_context_to_base_system_prompt(agent_files, agent_websites)
+        if knowledge_prompt is None:
+            system_prompt = self._add_long_context_to_base_system_prompt(agent_files, agent_websites)
+        else:
+            # The base prompt and knowledge base never change between queries, so they form a
+            # stable prefix that provider-side prompt caching can reuse
+            system_prompt = self.base_system_prompt + knowledge_prompt
         
+        self.system_prompt = system_prompt
+        self.tools = self.tool_setup.get_graph_tools()
+        kb_tokens = sum(item.tokens for item in [*(agent_files or []), *(agent_websites or [])])
+        self.model = self.llm_setup.get_model(kb_tokens)
         self.graph = create_react_agent(
-            self.llm_setup.get_model(), 
-            tools=self.tool_setup.get_tools(), 
+            self.model, 
+            tools=self.budget.wrap_tools(self.tool_cache.wrap_tools(self.tools)), 
             prompt=system_prompt, 
             name="research_agent"
         )
         
     def _add_long_context_to_base_system_prompt(self, agent_files, agent_websites=None):
-        system_prompt = self.base_system_prompt
-        long_context = """# KNOWLEDGE BASE\n\nWhen answering questions, first check if relevant information exists in these knowledge sources:\n1. Agent Files \n2. Agent Websites\n3. Only then use general search tools\n\nWhen using information from knowledge sources:\n- For Agent Files: Cite as [Agent KB: Filename]\n- For Agent Websites: Cite as [Agent KB: URL]\n- Clearly distinguish between knowledge base information and information from other sources
-        """     
-        if agent_files:
-            long_context+="\n## Agent Files Knowledge Base\n\nWhen you use any agent file, you MUST specify the file name instead of the url\n\n"
-            for file in agent_files:
-                long_context += f"### {file.name}\n{file.text}\n\n"
-        
-        if agent_websites:
-            long_context+="\n## Agent Websites Knowledge Base\n\nWhen you use any agent website, you MUST specify the url\n\n"
-            for website in agent_websites:
-                long_context += f"### {website.name}\n{website.text}\n\n"
-
-        system_prompt += long_context
-        print("system_prompt", system_prompt)
-        return system_prompt
+        return self.base_system_prompt + build_knowledge_prompt(agent_files, agent_websites)
 
     def _extract_message_content(self, message: BaseMessage, truncate=True) -> dict:
         """
@@ -93,19 +121,141 @@ class LangGraphSetup:
         else:
             print(f"\n[{message_type}]: {str(message)[:100]}...")
 
+    async def _synthesize(self, messages) -> BaseMessage:
+        """
+        Final answer from the conversation so far, without tools, within the time left.
+        """
+        history = list(messages)
+        # Tool requests that were never answered can't be sent back to the model
+        while history and isinstance(history[-1], AIMessage) and history[-1].tool_calls:
+            history.pop()
+        prompt = [SystemMessage(content=self.system_prompt), *history, HumanMessage(content=self.budget.wrap_up_prompt())]
+        try:
+            # A routed run answers on its synthesis route, like the answers the graph writes
+            answer = self.model.asynthesize(prompt) if isinstance(self.model, RoutedChatModel) else self.model.ainvoke(prompt)
+            return await asyncio.wait_for(answer, timeout=max(self.budget.remaining(), 0))
+        except asyncio.TimeoutError:
+            metrics.increment("research.synthesis_timeouts")
+            return AIMessage(content=SYNTHESIS_TIMEOUT_ANSWER)
+    
+    def cancel(self):
+        """
+        Cancel a running research. Safe to call from any thread, e.g. when the client disconnected.
+        The model call in flight is cancelled and tool calls that haven't started are refused.
+        Tool calls already running in worker threads can't be interrupted; they finish in the
+        background and are counted in the research.abandoned_tool_calls metric.
+        """
+        self.budget.cancel()
+        if self._run is not None and not self._run.done():
+            self._loop.call_soon_threadsafe(self._run.cancel)
+    
+    def _record_abandoned_tool_calls(self):
+        abandoned = self.budget.running_calls
+        if abandoned:
+            metrics.increment("research.abandoned_tool_calls", abandoned)
+            print(f"\n[ABANDONED]: {abandoned} tool calls still running in the background")
+    
+    def _record_upstream_calls(self, model_calls: int):
+        made = model_calls + self.budget.tool_calls
+        if self.budget.truncated != CANCELLED:
+            metrics.increment("research.completed")
+            metrics.increment("research.upstream_calls", made)
+            return
+        # What a typical complete run would still have called, at least the refused tool calls
+        expected = metrics.ratio("research.upstream_calls", "research.completed")
+        saved = max(self.budget.refused_calls, round(expected - made))
+        metrics.increment("research.cancelled")
+        metrics.increment("research.upstream_calls_saved", saved)
+        print(f"\n[CANCELLED]: research stopped after {made} upstream calls, saving about {saved}")
+    
     def research(self, user_input):
+        """
+        Blocking version of aresearch(), for callers without an event loop.
+        """
+        return asyncio.run(self.aresearch(user_input))
+    
+    async def aresearch(self, user_input):
         """
         Process a user research query through the LangGraph agent.
         Returns the complete conversation history with properly formatted messages.
+        
+        The run is bounded by the setup's ResearchBudget: when its step limit is reached,
+        or the graph is still running `reserve_seconds` before the deadline, the graph is
+        stopped and the model answers with what it has gathered within the reserve. The final
+        message tells whether the run was truncated and how many steps it used.
+        A run stopped with cancel() returns what it had when it was cancelled;
+        cancelling the awaiting task stops the run the same way and re-raises.
         """
         formatted_input = {"messages": [{"role": "user", "content": user_input}]}
         results = []
+        messages = []
+        model_calls = 0
         
         print("\n--- Starting Research Process ---")
         
-        for s in self.graph.stream(formatted_input, stream_mode="values"):
-            message = s["messages"][-1]
-            results.append(self._extract_message_content(message, False))
+        self.budget.start()
+        if self.prefetcher and not self.budget.cancelled.is_set():
+            # Runs alongside the first model call, which usually asks for these searches
+            self.prefetcher.start(user_input, self.tools, self.tool_cache)
+        
+        # Each step is a model turn and a tool turn; the refused step and final answer need two more
+        config = {"recursion_limit": 2 * (self.budget.max_steps + 2) + 1}
+        
+        async def stream():
+            nonlocal messages, model_calls
+            async for s in self.graph.astream(formatted_input, config, stream_mode="values"):
+                messages = s["messages"]
+                message = messages[-1]
+                results.append(self._extract_message_content(message, False))
+                if isinstance(message, AIMessage):
+                    model_calls += 1
+                    if message.tool_calls:
+                        self.budget.begin_step()
+                if self.budget.cancelled.is_set():
+                    break
+        
+        # The graph runs as its own task so cancel() can stop it mid-call from any thread
+        self._loop = asyncio.get_running_loop()
+        self._run = asyncio.ensure_future(stream())
+        if self.budget.cancelled.is_set():
+            self._run.cancel()
+        try:
+            # The reserve is kept for answering once the graph is stopped at the deadline
+            done, _ = await asyncio.wait({self._run}, timeout=max(self.budget.remaining() - self.budget.reserve_seconds, 0))
+            if not done:
+                self.budget.stop(DEADLINE)
+                self._run.cancel()
+                await asyncio.wait({self._run})
+        except asyncio.CancelledError:
+            self._run.cancel()
+            self.budget.cancel()
+            self._record_abandoned_tool_calls()
+            self._record_upstream_calls(model_calls)
+            raise
+        if self._run.cancelled():
+            self._record_abandoned_tool_calls()
+        else:
+            try:
+                self._run.result()
+            except GraphRecursionError:
+                self.budget.stop(STEPS)
+        
+        if self.budget.truncated not in (None, CANCELLED) and messages and not (isinstance(messages[-1], AIMessage) and not messages[-1].tool_calls):
+            print(f"\n[BUDGET]: {self.budget.truncated} budget used up after {self.budget.steps} steps, answering with the information gathered")
+            results.append(self._extract_message_content(await self._synthesize(messages), False))
+            model_calls += 1
+        self._record_upstream_calls(model_calls)
         
+        if self.tool_cache.duplicates_avoided:
+            print(f"\n[TOOL CACHE]: {self.tool_cache.duplicates_avoided} repeated tool calls answered without running the tool")
+        if self.prefetcher:
+            unused = self.tool_cache.unused_prefetches()
+            metrics.increment("tool_prefetch.unused", unused)
+            print(f"\n[TOOL PREFETCH]: {self.tool_cache.prefetch_hits} tool calls answered from a prefetch, {unused} prefetched calls unused")
+        metrics.increment("research.runs")
+        metrics.increment("research.steps", self.budget.steps)
         print("\n--- Research Complete ---\n")
-        return results if results else [{"role": "assistant", "content": "No response generated."}]
\ No newline at end of file
+        if not results:
+            return [{"role": "assistant", "content": "No response generated."}]
+        results[-1].update(truncated=self.budget.truncated is not None, steps=self.budget.steps)
+        return results
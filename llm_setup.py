@@ -1,6 +1,7 @@
 from langchain_openai import ChatOpenAI
 import os
 from dotenv import load_dotenv
+from utils.model_router import get_model_router
 
 class LLMSetup:
     def __init__(self):
@@ -16,5 +17,15 @@ class LLMSetup:
             api_key=open_ai_key
         )
     
-    def get_model(self):
+    def get_model(self, kb_tokens=0):
+        """
+        Model of a research run: routed between the models of MODEL_ROUTES when it is
+        set, gpt-4o-mini otherwise.
+        
+        Args:
+            kb_tokens (int): Tokens of the agent's knowledge base, used by the routing rules.
+        """
+        router = get_model_router()
+        if router is not None:
+            return router.chat_model(kb_tokens)
         return self.model
\ No newline at end of file
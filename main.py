@@ -1,8 +1,12 @@
-from api.routes.agents import router as agents_router
+from api.routes.agents import document_extractor, router as agents_router
+from api.routes.metrics import router as metrics_router
 from contextlib import asynccontextmanager
 from db.init_db import init_mongodb
 from fastapi import FastAPI
+from fastapi.responses import ORJSONResponse
+import asyncio
 import logging
+import os
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -20,14 +24,21 @@ async def lifespan(app: FastAPI):
         logger.error(f"❌ MongoDB connection failed: {str(e)}")
         raise e
     
+    if os.getenv("WARM_UP_EXTRACTORS", "false").lower() == "true":
+        # Import the document partitioners in the background so the first upload doesn't pay for it
+        app.extractor_warm_up = asyncio.create_task(asyncio.to_thread(document_extractor.warm_up))
+    
     yield
     
     if hasattr(app, "mongodb_client"):
         app.mongodb_client.close()
+    
+    document_extractor.shutdown()
 
-app = FastAPI(lifespan=lifespan)
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 
 app.include_router(agents_router)
+app.include_router(metrics_router)
 
 @app.get("/")
 def read_root():
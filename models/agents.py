@@ -1,17 +1,95 @@
-from beanie import Document
-from pydantic import BaseModel, Field
+from beanie import Document, PydanticObjectId
+from pydantic import BaseModel, Field, PrivateAttr, computed_field, model_validator
 from typing import List, Optional
+from utils.text_compression import text_compressor
 
-class File(BaseModel):
+class CompressedText(BaseModel):
+    """
+    Base for models whose text is stored compressed
+    
+    Attributes
+        text (str): Text, decompressed the first time it is read
+        compression (str): Codec of the stored text
+        compressed_text (bytes): Stored text, never returned by the API
+    """
+    compression: str = Field(default="none")
+    compressed_text: bytes = Field(default=b"", exclude=True)
+    _text: Optional[str] = PrivateAttr(default=None)
+    
+    @model_validator(mode="wrap")
+    @classmethod
+    def compress_text(cls, data, handler):
+        """
+        Accept plain text (new extractions and documents stored before compression)
+        and keep only its compressed form.
+        """
+        text = None
+        if isinstance(data, dict) and isinstance(data.get("text"), str):
+            data = dict(data)
+            text = data.pop("text")
+            data["compression"], data["compressed_text"] = text_compressor.compress(text)
+        
+        compressed = handler(data)
+        if text is not None:
+            compressed._text = text
+        return compressed
+    
+    @computed_field
+    @property
+    def text(self) -> str:
+        return self.read_text()
+    
+    def read_text(self, cache: bool = True) -> str:
+        """
+        Decompress the stored text.
+        
+        Args:
+            cache (bool): Keep the decompressed text on the instance. Writers that
+                stream many files pass False so only one text is alive at a time.
+        """
+        if self._text is not None:
+            return self._text
+        text = text_compressor.decompress(self.compression, self.compressed_text)
+        if cache:
+            self._text = text
+        return text
+
+class Summary(CompressedText):
+    """
+    Digest of a document too large to use whole, made at ingest time
+    
+    Attributes
+        tokens (int): Tokens utilized by the digest
+        source_tokens (int): Tokens utilized by the full text
+    """
+    tokens: int = Field(default=0)
+    source_tokens: int = Field(default=0)
+
+class File(CompressedText):
     """
     Attributes
+        id (str): Stable ID of the file within its agent, assigned when it is stored
         name (str): File name
-        text (str): Extracted text
-        tokens (int): Tokens utilized by the text
+        tokens (int): Tokens utilized by the text, or by its summary when it has one
+        summary (Summary): Digest used in place of the text in the knowledge prompt
     """
+    id: Optional[str] = Field(default=None)
     name: str
-    text: str
     tokens: int = Field(default=0)
+    summary: Optional[Summary] = Field(default=None)
+
+class KnowledgePrompt(CompressedText):
+    """
+    Knowledge base section of the system prompt, assembled when the knowledge base changes
+    
+    Attributes
+        version (str): Hash of the files and websites the prompt was built from
+        tokens (int): Tokens utilized by the prompt
+        saved_tokens (int): Tokens of near-duplicate passages left out of the prompt
+    """
+    version: str
+    tokens: int = Field(default=0)
+    saved_tokens: int = Field(default=0)
 
 class CreateAgent(BaseModel):
     """
@@ -28,11 +106,56 @@ class AgentDB(Document):
         files (list[File]): Files to access
         websites (list[File]): Websites crawled
         messages (list[str]): All prompts by user
+        total_tokens (int): Tokens of all files and websites, kept up to date by every write
+        knowledge_prompt (KnowledgePrompt): Precomputed knowledge base prompt, never returned by the API
     """
     name: str
     files: List[File] = Field(default=[])
     websites: List[File] = Field(default=[])
     messages: List[str] = Field(default=[])
+    total_tokens: Optional[int] = Field(default=None)
+    knowledge_prompt: Optional[KnowledgePrompt] = Field(default=None, exclude=True)
     
     class Settings:
-        name = "agents"
\ No newline at end of file
+        name = "agents"
+
+class AgentMetadata(BaseModel):
+    """
+    Projection of an agent without its knowledge base
+    
+    Attributes
+        id (str): Agent ID
+        name (str): Name of the Agent
+        total_tokens (int): Tokens of all files and websites
+        file_count (int): Number of files
+        website_count (int): Number of websites
+        deduplicated_tokens (int): Tokens of near-duplicate passages left out of the knowledge prompt
+    """
+    id: Optional[PydanticObjectId] = Field(default=None, alias="_id")
+    name: str
+    total_tokens: Optional[int] = None
+    file_count: int = 0
+    website_count: int = 0
+    deduplicated_tokens: int = 0
+
+class FileListing(BaseModel):
+    """
+    Attributes
+        id (str): Stable ID of the file or website within its agent
+        name (str): File name or URL
+        tokens (int): Tokens utilized by the text
+    """
+    id: Optional[str] = Field(default=None)
+    name: str
+    tokens: int = Field(default=0)
+
+class AgentFileListing(AgentMetadata):
+    """
+    Projection of an agent listing its files and websites without their text
+    
+    Attributes
+        files (list[FileListing]): Page of files
+        websites (list[FileListing]): Page of websites
+    """
+    files: List[FileListing] = Field(default=[])
+    websites: List[FileListing] = Field(default=[])
\ No newline at end of file
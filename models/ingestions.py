@@ -0,0 +1,55 @@
+from beanie import Document
+from datetime import datetime, timezone
+from pydantic import BaseModel, Field
+from typing import List, Optional
+
+class IngestionStatus:
+    """Statuses of an ingestion and of each file in it."""
+    
+    QUEUED = "queued"
+    EXTRACTING = "extracting"
+    TOKENIZING = "tokenizing"
+    SUMMARIZING = "summarizing"
+    PERSISTING = "persisting"
+    DONE = "done"
+    FAILED = "failed"
+    
+    RUNNING = "running"
+    COMPLETED = "completed"
+    COMPLETED_WITH_ERRORS = "completed_with_errors"
+
+def utc_now() -> datetime:
+    return datetime.now(timezone.utc)
+
+class IngestionFile(BaseModel):
+    """
+    Attributes
+        name (str): File name
+        status (str): Pipeline stage the file is in
+        tokens (int): Tokens of the extracted text, once tokenized
+        error (str): Reason the file failed, if it did
+    """
+    name: str
+    status: str = Field(default=IngestionStatus.QUEUED)
+    tokens: int = Field(default=0)
+    error: Optional[str] = None
+
+class IngestionDB(Document):
+    """
+    Attributes
+        agent_id (str): Agent the files are added to
+        status (str): Overall status of the ingestion
+        files (list[IngestionFile]): Per-file progress
+        tokens (int): Tokens persisted to the agent so far
+        created_at (datetime): When the upload was accepted
+        updated_at (datetime): Last progress update
+    """
+    agent_id: str
+    status: str = Field(default=IngestionStatus.QUEUED)
+    files: List[IngestionFile] = Field(default=[])
+    tokens: int = Field(default=0)
+    created_at: datetime = Field(default_factory=utc_now)
+    updated_at: datetime = Field(default_factory=utc_now)
+    
+    class Settings:
+        name = "ingestions"
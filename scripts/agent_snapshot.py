@@ -0,0 +1,54 @@
+"""
+Agent snapshot CLI.
+
+Exports every agent, with its extracted knowledge base, to a msgpack or NDJSON
+snapshot, and restores snapshots with bulk inserts. Nothing is re-extracted on import.
+
+Usage:
+    python scripts/agent_snapshot.py export agents.msgpack [--format msgpack]
+    python scripts/agent_snapshot.py import agents.msgpack [--format msgpack] [--keep-ids]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT_ROOT)
+
+from db.init_db import init_mongodb
+from utils.agent_snapshot import MEDIA_TYPES, MSGPACK, export_agents, import_agents
+
+async def run(args: argparse.Namespace):
+    client = await init_mongodb(args.db_url)
+    start = time.perf_counter()
+    try:
+        if args.command == "export":
+            agents = -1
+            with open(args.path, "wb") as f:
+                async for chunk in export_agents(args.format):
+                    f.write(chunk)
+                    agents += 1
+            print(f"Exported {agents} agents to {args.path} in {time.perf_counter() - start:.1f}s")
+        else:
+            with open(args.path, "rb") as f:
+                agents = await import_agents(f, args.format, args.keep_ids, args.batch_size)
+            print(f"Imported {agents} agents from {args.path} in {time.perf_counter() - start:.1f}s")
+    finally:
+        client.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Export or import agents as a snapshot")
+    parser.add_argument("command", choices=["export", "import"])
+    parser.add_argument("path", help="Snapshot file")
+    parser.add_argument("--format", choices=sorted(MEDIA_TYPES), default=MSGPACK)
+    parser.add_argument("--keep-ids", action="store_true", help="Keep agent IDs from the snapshot on import")
+    parser.add_argument("--batch-size", type=int, default=500, help="Agents per bulk insert on import")
+    parser.add_argument("--db-url", default=None, help="MongoDB URL, defaults to MONGODB_URL")
+    args = parser.parse_args()
+    
+    asyncio.run(run(args))
+
+if __name__ == "__main__":
+    main()
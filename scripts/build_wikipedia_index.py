@@ -0,0 +1,33 @@
+"""
+Offline Wikipedia index builder.
+
+Builds the index read by search_wikipedia when WIKIPEDIA_BACKEND=offline from a
+Wikipedia abstracts dump (https://dumps.wikimedia.org/enwiki/latest/enwiki-latest-abstract.xml.gz)
+or a JSON lines file with "title", "url" and "abstract" fields.
+
+Usage:
+    python scripts/build_wikipedia_index.py enwiki-latest-abstract.xml.gz data/wikipedia
+"""
+import argparse
+import os
+import sys
+import time
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT_ROOT)
+
+from utils.wikipedia_index import build_wikipedia_index
+
+def main():
+    parser = argparse.ArgumentParser(description="Build an offline Wikipedia index from an abstracts dump")
+    parser.add_argument("dump", help="Abstracts dump, XML or JSON lines, optionally gzipped")
+    parser.add_argument("index", help="Directory the index is written to")
+    parser.add_argument("--max-document-frequency", type=float, default=0.1, help="Share of articles above which a term is not indexed")
+    args = parser.parse_args()
+    
+    start = time.perf_counter()
+    articles = build_wikipedia_index(args.dump, args.index, args.max_document_frequency)
+    print(f"Indexed {articles} articles into {args.index} in {time.perf_counter() - start:.1f}s")
+
+if __name__ == "__main__":
+    main()
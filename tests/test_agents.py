@@ -1,17 +1,21 @@
+import asyncio
 import json
 from bson import ObjectId
 import json
 import os
 import pytest
 import sys
+import threading
 from fastapi.testclient import TestClient
-from unittest.mock import MagicMock, patch
+from unittest.mock import AsyncMock, MagicMock, patch
 
 parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 if (parent_dir not in sys.path):
     sys.path.append(parent_dir)
 
 from api.routes.utils import DefaultErrorMessages
+from db.agents import _page
+from models.agents import AgentDB, AgentFileListing, AgentMetadata, File as FileModel, FileListing, KnowledgePrompt
 from main import app
 
 client = TestClient(app)
@@ -109,7 +113,7 @@ def test_get_agent_success():
     """Test successful agent retrieval"""
     agent_id = "507f1f77bcf86cd799439011"
     
-    with patch("api.routes.agents.get_agent") as mock_get:
+    with patch("api.routes.agents.get_agent_page") as mock_get:
         mock_agent = MagicMock()
         mock_agent._id = ObjectId(agent_id)
         mock_agent.name = "Test Agent"
@@ -122,13 +126,58 @@ def test_get_agent_success():
         assert response.json()["name"] == "Test Agent"
         assert "_id" in response.json()
         
-        mock_get.assert_called_once_with(agent_id)
+        mock_get.assert_called_once_with(agent_id, 0, None)
+
+def test_get_agent_large_is_streamed():
+    """Test agents above the streaming threshold are written item by item with the same JSON"""
+    agent_id = "507f1f77bcf86cd799439011"
+    agent = AgentDB.model_construct(
+        id=ObjectId(agent_id),
+        name="Test Agent",
+        files=[FileModel(id="1", name="report.pdf", text="Quarterly revenue grew.", tokens=30000)],
+        websites=[],
+        messages=[],
+        total_tokens=30000
+    )
+    
+    with patch("api.routes.agents.get_agent_page") as mock_get:
+        mock_get.return_value = agent
+        
+        response = client.get(f"/agents/{agent_id}")
+        
+        assert response.status_code == 200
+        assert response.json()["_id"] == agent_id
+        assert response.json()["files"][0]["text"] == "Quarterly revenue grew."
+        assert response.json() == json.loads(agent.model_dump_json(by_alias=True))
+
+def test_get_agent_page_is_not_streamed():
+    """Test the streaming threshold applies to the requested page, not the whole agent"""
+    agent_id = "507f1f77bcf86cd799439011"
+    agent = AgentDB.model_construct(
+        id=ObjectId(agent_id),
+        name="Test Agent",
+        files=[FileModel(id="2", name="notes.pdf", text="Short notes.", tokens=50)],
+        websites=[],
+        messages=[],
+        total_tokens=90000
+    )
+    
+    with patch("api.routes.agents.get_agent_page") as mock_get, \
+         patch("api.routes.agents.stream_agent") as mock_stream:
+        mock_get.return_value = agent
+        
+        response = client.get(f"/agents/{agent_id}?offset=1&limit=1")
+        
+        assert response.status_code == 200
+        assert response.json()["files"][0]["name"] == "notes.pdf"
+        mock_get.assert_called_once_with(agent_id, 1, 1)
+        mock_stream.assert_not_called()
 
 def test_get_agent_not_found():
     """Test agent not found case"""
     agent_id = "507f1f77bcf86cd799439011"
     
-    with patch("api.routes.agents.get_agent") as mock_get:
+    with patch("api.routes.agents.get_agent_page") as mock_get:
         mock_null_agent = MagicMock()
         mock_null_agent._id = None
         mock_null_agent.name = ""
@@ -140,7 +189,7 @@ def test_get_agent_not_found():
         assert response.json()["name"] == ""
         assert response.json()["_id"] is None
         
-        mock_get.assert_called_once_with(agent_id)
+        mock_get.assert_called_once_with(agent_id, 0, None)
 
 def test_get_agent_validation_error():
     """Test validation error handling"""
@@ -170,6 +219,56 @@ def test_get_agent_validation_error():
     assert "type" in error
     assert "value_error" in error["type"]
 
+def test_get_agent_metadata_projection():
+    """Test fields=metadata returns the projection without the knowledge base"""
+    agent_id = "507f1f77bcf86cd799439011"
+    
+    with patch("api.routes.agents.get_agent_metadata") as mock_metadata, \
+         patch("api.routes.agents.get_agent") as mock_get:
+        mock_metadata.return_value = AgentMetadata(_id=agent_id, name="Test Agent", total_tokens=1200, file_count=3)
+        
+        response = client.get(f"/agents/{agent_id}?fields=metadata")
+        
+        assert response.status_code == 200
+        assert response.json()["total_tokens"] == 1200
+        assert response.json()["file_count"] == 3
+        assert "files" not in response.json()
+        mock_get.assert_not_called()
+
+def test_get_agent_file_listing_paginated():
+    """Test fields=files passes pagination to the listing projection"""
+    agent_id = "507f1f77bcf86cd799439011"
+    
+    with patch("api.routes.agents.get_agent_file_listing") as mock_listing:
+        mock_listing.return_value = AgentFileListing(
+            _id=agent_id,
+            name="Test Agent",
+            total_tokens=30,
+            file_count=5,
+            files=[FileListing(name="b.pdf", tokens=10), FileListing(name="c.pdf", tokens=20)]
+        )
+        
+        response = client.get(f"/agents/{agent_id}?fields=files&offset=1&limit=2")
+        
+        assert response.status_code == 200
+        assert [file["name"] for file in response.json()["files"]] == ["b.pdf", "c.pdf"]
+        assert "text" not in response.json()["files"][0]
+        mock_listing.assert_called_once_with(agent_id, 1, 2)
+
+def test_page_of_an_empty_list_has_a_positive_slice_count():
+    """Test offsets without a limit never give $slice a count of 0, which MongoDB rejects for empty lists"""
+    items = {"$ifNull": ["$websites", []]}
+    
+    assert _page("websites", 1) == {"$slice": [items, 1, {"$max": [1, {"$size": items}]}]}
+    assert _page("websites", 1, 2) == {"$slice": [items, 1, 2]}
+    assert _page("websites") == items
+
+def test_get_agent_invalid_fields():
+    """Test unknown views are rejected"""
+    response = client.get("/agents/507f1f77bcf86cd799439011?fields=everything")
+    
+    assert response.status_code == 422
+
 def test_delete_agent_success():
     """Test successful agent deletion"""
     agent_id = "507f1f77bcf86cd799439011"
@@ -212,7 +311,220 @@ def test_delete_agent_validation_error():
     assert "type" in error
     assert "value_error" in error["type"]
 
+def test_update_agent_files_background(tmp_path):
+    """Test files are accepted and handed to the ingestion pipeline"""
+    agent_id = "507f1f77bcf86cd799439011"
+    ingestion_id = "607f1f77bcf86cd799439022"
+    
+    with patch("api.routes.agents.get_agent_token_total") as mock_token_total, \
+         patch("api.routes.agents.create_ingestion") as mock_create_ingestion, \
+         patch("api.routes.agents.ingestion_pipeline") as mock_pipeline:
+        mock_token_total.return_value = 0
+        mock_ingestion = MagicMock()
+        mock_ingestion.id = ObjectId(ingestion_id)
+        mock_create_ingestion.return_value = mock_ingestion
+        mock_pipeline.spool = AsyncMock(return_value=[str(tmp_path / "0_report.pdf")])
+        
+        response = client.put(
+            f"/agents/{agent_id}/files?background=true",
+            files=[("files", ("report.pdf", b"%PDF-1.4", "application/pdf"))]
+        )
+        
+        assert response.status_code == 202
+        assert response.json() == {"ingestion_id": ingestion_id}
+        mock_create_ingestion.assert_called_once_with(agent_id, ["report.pdf"])
+        mock_pipeline.run.assert_called_once_with(ingestion_id, agent_id, ["report.pdf"], [str(tmp_path / "0_report.pdf")], 0, False)
+        assert "202" in app.openapi()["paths"]["/agents/{agent_id}/files"]["put"]["responses"]
+
+def test_update_agent_files_background_unsupported_extension():
+    """Test unsupported files are rejected before anything is spooled"""
+    agent_id = "507f1f77bcf86cd799439011"
+    
+    with patch("api.routes.agents.get_agent_token_total") as mock_token_total, \
+         patch("api.routes.agents.ingestion_pipeline") as mock_pipeline:
+        mock_token_total.return_value = 0
+        
+        response = client.put(
+            f"/agents/{agent_id}/files?background=true",
+            files=[("files", ("notes.txt", b"hello", "text/plain"))]
+        )
+        
+        assert response.status_code == 400
+        assert "Unsupported file extension" in response.json()["detail"]
+        mock_pipeline.spool.assert_not_called()
+
+def test_update_agent_files_summarize_oversized():
+    """Test summarize mode stores a file over the token limit with a digest counted instead"""
+    agent_id = "507f1f77bcf86cd799439011"
+    
+    with patch("api.routes.agents.get_agent_token_total") as mock_token_total, \
+         patch("api.routes.agents.document_extractor.extract_from_file") as mock_extract, \
+         patch("api.routes.agents.document_summarizer.summarize", new_callable=AsyncMock) as mock_summarize, \
+         patch("api.routes.agents.update_agent_files") as mock_update:
+        mock_token_total.return_value = 100000
+        mock_extract.return_value = ("full annual report", 50000)
+        mock_summarize.return_value = "Revenue grew 12%."
+        
+        response = client.put(
+            f"/agents/{agent_id}/files?summarize=true",
+            files={"files": ("report.pdf", b"%PDF-1.4", "application/pdf")}
+        )
+        
+        assert response.status_code == 204
+        mock_summarize.assert_awaited_once_with("report.pdf", "full annual report")
+        new_file = mock_update.call_args.args[1][0]
+        assert new_file.text == "full annual report"
+        assert new_file.summary.text.endswith("Revenue grew 12%.")
+        assert new_file.summary.source_tokens == 50000
+        assert new_file.tokens == new_file.summary.tokens < 100
+
+def test_replace_agent_file():
+    """Test replacing one file extracts only the upload and keeps the file ID"""
+    agent_id = "507f1f77bcf86cd799439011"
+    file_id = "707f1f77bcf86cd799439033"
+    
+    with patch("api.routes.agents.get_agent_token_total") as mock_token_total, \
+         patch("api.routes.agents.get_agent_file") as mock_get_file, \
+         patch("api.routes.agents.document_extractor.extract_from_file") as mock_extract, \
+         patch("api.routes.agents.replace_agent_file") as mock_replace:
+        mock_token_total.return_value = 119000
+        mock_get_file.return_value = FileListing(id=file_id, name="old.pdf", tokens=1000)
+        mock_extract.return_value = ("new text", 1500)
+        mock_replace.return_value = mock_get_file.return_value
+        
+        response = client.put(
+            f"/agents/{agent_id}/files/{file_id}",
+            files={"file": ("new.pdf", b"%PDF-1.4", "application/pdf")}
+        )
+        
+        assert response.status_code == 204
+        replaced_id, replaced_file_id, new_file = mock_replace.call_args.args
+        assert (replaced_id, replaced_file_id) == (agent_id, file_id)
+        assert (new_file.name, new_file.text, new_file.tokens) == ("new.pdf", "new text", 1500)
+
+def test_replace_agent_file_token_limit():
+    """Test the replaced file's tokens are freed before the limit is checked"""
+    agent_id = "507f1f77bcf86cd799439011"
+    file_id = "707f1f77bcf86cd799439033"
+    
+    with patch("api.routes.agents.get_agent_token_total") as mock_token_total, \
+         patch("api.routes.agents.get_agent_file") as mock_get_file, \
+         patch("api.routes.agents.document_extractor.extract_from_file") as mock_extract, \
+         patch("api.routes.agents.replace_agent_file") as mock_replace:
+        mock_token_total.return_value = 119000
+        mock_get_file.return_value = FileListing(id=file_id, name="old.pdf", tokens=1000)
+        mock_extract.return_value = ("new text", 2500)
+        
+        response = client.put(
+            f"/agents/{agent_id}/files/{file_id}",
+            files={"file": ("new.pdf", b"%PDF-1.4", "application/pdf")}
+        )
+        
+        assert response.status_code == 400
+        assert "Token limit exceeded" in response.json()["detail"]
+        mock_replace.assert_not_called()
+
+def test_replace_agent_file_summarize_oversized():
+    """Test summarize mode stores an oversized replacement with a digest instead of rejecting it"""
+    agent_id = "507f1f77bcf86cd799439011"
+    file_id = "707f1f77bcf86cd799439033"
+    
+    with patch("api.routes.agents.get_agent_token_total") as mock_token_total, \
+         patch("api.routes.agents.get_agent_file") as mock_get_file, \
+         patch("api.routes.agents.document_extractor.extract_from_file") as mock_extract, \
+         patch("api.routes.agents.document_summarizer.summarize", new_callable=AsyncMock) as mock_summarize, \
+         patch("api.routes.agents.replace_agent_file") as mock_replace:
+        mock_token_total.return_value = 119000
+        mock_get_file.return_value = FileListing(id=file_id, name="old.pdf", tokens=1000)
+        mock_extract.return_value = ("full annual report", 50000)
+        mock_summarize.return_value = "Revenue grew 12%."
+        mock_replace.return_value = mock_get_file.return_value
+        
+        response = client.put(
+            f"/agents/{agent_id}/files/{file_id}?summarize=true",
+            files={"file": ("report.pdf", b"%PDF-1.4", "application/pdf")}
+        )
+        
+        assert response.status_code == 204
+        mock_summarize.assert_awaited_once_with("report.pdf", "full annual report")
+        new_file = mock_replace.call_args.args[2]
+        assert new_file.summary.source_tokens == 50000
+        assert new_file.tokens == new_file.summary.tokens < 100
+
+def test_delete_agent_file():
+    """Test deleting one file"""
+    agent_id = "507f1f77bcf86cd799439011"
+    file_id = "707f1f77bcf86cd799439033"
+    
+    with patch("api.routes.agents.delete_agent_file") as mock_delete:
+        mock_delete.return_value = FileListing(id=file_id, name="old.pdf", tokens=1000)
+        
+        response = client.delete(f"/agents/{agent_id}/files/{file_id}")
+        
+        assert response.status_code == 204
+        mock_delete.assert_called_once_with(agent_id, file_id)
+
+def test_delete_agent_website_not_found():
+    """Test deleting an unknown website returns 404"""
+    with patch("api.routes.agents.delete_agent_website") as mock_delete:
+        mock_delete.return_value = None
+        
+        response = client.delete("/agents/507f1f77bcf86cd799439011/websites/unknown")
+        
+        assert response.status_code == 404
+
+def test_export_agents():
+    """Test agents are streamed as an NDJSON snapshot"""
+    async def documents():
+        yield {"_id": ObjectId("507f1f77bcf86cd799439011"), "name": "Test Agent", "files": []}
+    
+    with patch("utils.agent_snapshot.iter_agent_documents", return_value=documents()):
+        response = client.get("/agents/export?format=ndjson")
+        
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "application/x-ndjson"
+        lines = response.text.splitlines()
+        assert len(lines) == 2
+        assert json.loads(lines[1])["name"] == "Test Agent"
+
+def test_import_agents_invalid_snapshot():
+    """Test snapshots without a header are rejected"""
+    with patch("utils.agent_snapshot.insert_agent_documents") as mock_insert:
+        response = client.post(
+            "/agents/import?format=ndjson",
+            files={"snapshot": ("agents.ndjson", b'{"name": "Test Agent"}\n', "application/x-ndjson")}
+        )
+        
+        assert response.status_code == 400
+        mock_insert.assert_not_called()
+
+def test_get_ingestion_not_found():
+    """Test unknown ingestion IDs return 404"""
+    agent_id = "507f1f77bcf86cd799439011"
+    
+    with patch("api.routes.agents.get_ingestion") as mock_get_ingestion:
+        mock_get_ingestion.return_value = None
+        
+        response = client.get(f"/agents/{agent_id}/ingestions/607f1f77bcf86cd799439022")
+        
+        assert response.status_code == 404
+
+def test_get_metrics():
+    """Test metrics include the knowledge base text compression stats"""
+    response = client.get("/metrics")
+    
+    assert response.status_code == 200
+    assert "kb_text.compression_ratio" in response.json()
+    assert "kb_text.avg_decompress_ms" in response.json()
+
 class TestAgentQueriesRoute:
+    @pytest.fixture(autouse=True)
+    def mock_knowledge_prompt(self):
+        """Serve a precomputed knowledge prompt instead of reading it from MongoDB"""
+        with patch("api.routes.agents.get_knowledge_prompt") as mock_get_knowledge_prompt:
+            mock_get_knowledge_prompt.return_value = KnowledgePrompt(version="v1", tokens=4, text="# KNOWLEDGE BASE")
+            yield mock_get_knowledge_prompt
+    
     @pytest.fixture
     def mock_research_results(self):
         """Create mock research results"""
@@ -240,16 +552,78 @@ class TestAgentQueriesRoute:
         mock_update_messages.return_value = updated_agent
         
         mock_langgraph_instance = mock_langgraph_class.return_value
-        mock_langgraph_instance.research.return_value = mock_research_results
+        mock_langgraph_instance.aresearch = AsyncMock(return_value=mock_research_results)
         
         response = client.post(f"/agents/{agent_id}/queries", json=message)
         
         assert response.status_code == 201
         mock_get_agent.assert_called_once_with(agent_id)
         mock_update_messages.assert_called_once_with(agent_id, "What is climate change?")
-        mock_langgraph_instance.research.assert_called_once_with("What is climate change?")
+        mock_langgraph_instance.aresearch.assert_awaited_once_with("What is climate change?")
         assert response.json() == mock_research_results[-1]
 
+    @patch("api.routes.agents.get_agent")
+    @patch("api.routes.agents.update_agent_messages")
+    @patch("api.routes.agents.LangGraphSetup")
+    def test_send_message_lookup_context(self, mock_langgraph_class, mock_update_messages, mock_get_agent, mock_knowledge_prompt, mock_research_results):
+        """Test the lookup mode sends a table of contents and binds the lookup tool"""
+        agent_id = "507f1f77bcf86cd799439011"
+        mock_get_agent.return_value = AgentDB.model_construct(
+            id=ObjectId(agent_id), name="Test Agent", websites=[], messages=[],
+            files=[FileModel(id="1", name="report.pdf", text="Revenue grew.", tokens=3)]
+        )
+        mock_langgraph_class.return_value.aresearch = AsyncMock(return_value=mock_research_results)
+        
+        response = client.post(f"/agents/{agent_id}/queries?context=lookup", json={"message": "How did revenue change?"})
+        
+        assert response.status_code == 201
+        mock_knowledge_prompt.assert_not_called()
+        knowledge_prompt = mock_langgraph_class.call_args.kwargs["knowledge_prompt"]
+        assert "| report.pdf | 3 |" in knowledge_prompt and "Revenue grew." not in knowledge_prompt
+        tool_setup = mock_langgraph_class.call_args.args[1]
+        assert tool_setup.get_tools()[-1].name == "lookup_agent_file"
+    
+    @patch("api.routes.agents.get_agent")
+    @patch("api.routes.agents.update_agent_messages")
+    @patch("api.routes.agents.LangGraphSetup")
+    def test_send_message_research_budget(self, mock_langgraph_class, mock_update_messages, mock_get_agent, mock_knowledge_prompt, mock_research_results):
+        """Test the deadline and step budget are taken from the query"""
+        agent_id = "507f1f77bcf86cd799439011"
+        mock_get_agent.return_value = AgentDB.model_construct(id=ObjectId(agent_id), name="Test Agent", files=[], websites=[], messages=[])
+        mock_langgraph_class.return_value.aresearch = AsyncMock(return_value=[*mock_research_results[:-1], {**mock_research_results[-1], "truncated": True, "steps": 2}])
+        
+        response = client.post(f"/agents/{agent_id}/queries?deadline_seconds=15&max_steps=2", json={"message": "What is climate change?"})
+        
+        assert response.status_code == 201
+        assert response.json()["truncated"] is True
+        assert response.json()["steps"] == 2
+        budget = mock_langgraph_class.call_args.kwargs["budget"]
+        assert (budget.deadline_seconds, budget.max_steps) == (15, 2)
+        assert client.post(f"/agents/{agent_id}/queries?max_steps=0", json={"message": "What is climate change?"}).status_code == 422
+    
+    @patch("api.routes.agents.get_agent")
+    @patch("api.routes.agents.update_agent_messages")
+    @patch("api.routes.agents.LangGraphSetup")
+    def test_send_message_cancelled_on_disconnect(self, mock_langgraph_class, mock_update_messages, mock_get_agent, mock_knowledge_prompt):
+        """Test the research is cancelled when the client disconnects"""
+        agent_id = "507f1f77bcf86cd799439011"
+        mock_get_agent.return_value = AgentDB.model_construct(id=ObjectId(agent_id), name="Test Agent", files=[], websites=[], messages=[])
+        cancelled = threading.Event()
+        mock_langgraph_class.return_value.cancel.side_effect = cancelled.set
+        
+        async def research(query):
+            await asyncio.sleep(5)
+            return []
+        
+        mock_langgraph_class.return_value.aresearch = AsyncMock(side_effect=research)
+        
+        with patch("starlette.requests.Request.is_disconnected", AsyncMock(return_value=True)):
+            response = client.post(f"/agents/{agent_id}/queries", json={"message": "What is climate change?"})
+        
+        assert response.status_code == 499
+        mock_langgraph_class.return_value.cancel.assert_called_once()
+        assert cancelled.is_set()
+    
     @patch("api.routes.agents.get_agent")
     @patch("api.routes.agents.update_agent_messages")
     def test_agent_not_found(self, mock_update_messages, mock_get_agent):
@@ -281,7 +655,7 @@ class TestAgentQueriesRoute:
         mock_update_messages.return_value = mock_agent
         
         mock_langgraph_instance = mock_langgraph_class.return_value
-        mock_langgraph_instance.research.side_effect = Exception("Research error")
+        mock_langgraph_instance.aresearch = AsyncMock(side_effect=Exception("Research error"))
         
         agent_id = "507f1f77bcf86cd799439011"
         message = {"message": "What is climate change?"}
@@ -304,7 +678,7 @@ class TestAgentQueriesRoute:
         mock_update_messages.return_value = mock_agent
 
         mock_langgraph_instance = mock_langgraph_class.return_value
-        mock_langgraph_instance.research.return_value = []
+        mock_langgraph_instance.aresearch = AsyncMock(return_value=[])
         
         agent_id = "507f1f77bcf86cd799439011"
         message = {"message": "What is climate change?"}
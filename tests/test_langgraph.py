@@ -1,3 +1,4 @@
+import asyncio
 import pytest
 from unittest.mock import patch, MagicMock
 import sys
@@ -7,9 +8,27 @@ parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 if parent_dir not in sys.path:
     sys.path.append(parent_dir)
 
-from langgraph_setup import LangGraphSetup
+from langgraph_setup import SYNTHESIS_TIMEOUT_ANSWER, LangGraphSetup
 from llm_setup import LLMSetup
-from tool_setup import ToolSetup, search_wikipedia, search_web_with_duckduckgo, search_duckduckgo_news
+from models.agents import File
+from tool_setup import ResultShaper, ToolSetup, ddgs_pool, search_wikipedia, search_web_with_duckduckgo, search_duckduckgo_news
+from utils.knowledge_prompt import build_knowledge_toc
+from utils.metrics import metrics
+from utils.tool_cache import ToolCallCache
+from utils.rate_limiter import RateLimitExceeded
+from utils.tool_prefetch import ToolPrefetcher, extract_search_terms
+from utils.research_budget import ResearchBudget
+from utils.model_router import ModelRouter, RoutedChatModel, RoutingRule
+from concurrent.futures import ThreadPoolExecutor
+import itertools
+from langchain_core.language_models.fake_chat_models import GenericFakeChatModel
+from langchain_core.messages import AIMessage, HumanMessage
+from utils.tool_resilience import TOOL_POLICIES, ToolPolicy, ToolResilience
+import threading
+import time
+from utils.vector_index import VectorIndexStore
+from duckduckgo_search.exceptions import RatelimitException
+from langchain_core.tools import tool
 
 class TestLLMSetup:
     @patch('llm_setup.os')
@@ -38,6 +57,15 @@ class TestLLMSetup:
             LLMSetup()
         
         assert "OPENAI_API_KEY is not set" in str(e.value)
+    
+    def test_get_model_is_routed_when_routes_are_configured(self):
+        router = ModelRouter({"fast": lambda: ToolCallingFakeModel(messages=iter([]))})
+        
+        with patch('llm_setup.get_model_router', return_value=router):
+            model = LLMSetup().get_model(kb_tokens=500)
+        
+        assert isinstance(model, RoutedChatModel)
+        assert model.kb_tokens == 500
 
 class TestToolSetup:
     def test_init(self):
@@ -51,6 +79,521 @@ class TestToolSetup:
         tools = tool_setup.get_tools()
         
         assert tools == [search_wikipedia, search_web_with_duckduckgo, search_duckduckgo_news]
+    
+    def test_agent_knowledge_tool_is_bound_when_indexing_is_enabled(self, tmp_path):
+        agent = MagicMock()
+        agent.id = "507f1f77bcf86cd799439011"
+        agent.files = [File(id="1", name="wind.pdf", text="Wind turbine gearbox inspected.", tokens=6)]
+        agent.websites = []
+        vector_index = VectorIndexStore(root=str(tmp_path))
+        vector_index.sync(agent)
+        
+        tools = ToolSetup(agent, vector_index).get_tools()
+        
+        assert tools[:3] == [search_wikipedia, search_web_with_duckduckgo, search_duckduckgo_news]
+        assert tools[3].name == "search_agent_knowledge"
+        result = tools[3].invoke({"query": "turbine gearbox"})
+        assert result["status"] == "success"
+        assert result["results"][0]["source"] == "wind.pdf"
+        assert result["results"][0]["text"] == "Wind turbine gearbox inspected."
+    
+    def test_agent_knowledge_tool_is_not_bound_without_index(self):
+        assert ToolSetup(MagicMock(), MagicMock(enabled=False)).get_tools() == [search_wikipedia, search_web_with_duckduckgo, search_duckduckgo_news]
+
+class TestLookupAgentFile:
+    def lookup_tool(self):
+        agent = MagicMock()
+        agent.files = [
+            File(id="1", name="solar.pdf", text="\n".join(f"Solar panel note {i}." for i in range(400)) + "\nInverter warranty lasts ten years.", tokens=3000),
+            File(id="2", name="wind.pdf", text="Wind turbine gearbox inspected.", tokens=6),
+        ]
+        agent.websites = [File(id="3", name="https://example.org/about", text="About us.", tokens=3)]
+        tools = ToolSetup(agent, lookup=True).get_tools()
+        assert tools[-1].name == "lookup_agent_file"
+        return tools[-1]
+    
+    def test_query_returns_relevant_passages(self):
+        result = self.lookup_tool().invoke({"name": "solar.pdf", "query": "inverter warranty"})
+        
+        assert result["status"] == "success"
+        assert result["type"] == "file"
+        assert "Inverter warranty lasts ten years." in result["results"][0]["text"]
+        assert len(result["results"]) < 10
+    
+    def test_parts_read_in_order(self):
+        lookup_agent_file = self.lookup_tool()
+        
+        first = lookup_agent_file.invoke({"name": "solar.pdf"})
+        last = lookup_agent_file.invoke({"name": "solar.pdf", "part": first["parts"]})
+        
+        assert first["parts"] > 1
+        assert first["text"].startswith("Solar panel note 0.")
+        assert last["text"].endswith("Inverter warranty lasts ten years.")
+    
+    def test_names_match_loosely(self):
+        lookup_agent_file = self.lookup_tool()
+        
+        assert lookup_agent_file.invoke({"name": "example.org"})["text"] == "About us."
+        result = lookup_agent_file.invoke({"name": "budget.xlsx"})
+        assert result["status"] == "not_found"
+        assert "wind.pdf" in result["message"]
+    
+    def test_repeated_and_piped_names_are_looked_up_as_listed(self):
+        agent = MagicMock()
+        agent.files = [File(id="1", name="report.pdf", text="First report.", tokens=3), File(id="2", name="a|b.pdf", text="Piped name.", tokens=3)]
+        agent.websites = [File(id="3", name="report.pdf", text="Second report.", tokens=3)]
+        lookup_agent_file = ToolSetup(agent, lookup=True).get_tools()[-1]
+        toc = build_knowledge_toc(agent.files, agent.websites)
+        
+        assert "| report.pdf | 3 |" in toc and "| report.pdf (2) | 3 |" in toc and "| a\\|b.pdf | 3 |" in toc
+        assert lookup_agent_file.invoke({"name": "report.pdf"})["text"] == "First report."
+        assert lookup_agent_file.invoke({"name": "report.pdf (2)"})["text"] == "Second report."
+        assert lookup_agent_file.invoke({"name": "a\\|b.pdf"})["text"] == "Piped name."
+    
+    def test_not_bound_by_default(self):
+        assert ToolSetup(MagicMock()).get_tools() == [search_wikipedia, search_web_with_duckduckgo, search_duckduckgo_news]
+
+class TestToolCallCache:
+    def counting_tool(self, results=None):
+        calls = []
+        
+        @tool
+        def search(query: str, max_results: int = 5) -> dict:
+            """Search for a query."""
+            calls.append(query)
+            return results.pop(0) if results else {"status": "success", "query": query}
+        
+        return search, calls
+    
+    def test_repeated_call_returns_reference_without_running_tool(self):
+        search, calls = self.counting_tool()
+        cache = ToolCallCache()
+        cached_search = cache.wrap(search)
+        
+        first = cached_search.invoke({"query": "Nvidia stock price"})
+        repeat = cached_search.invoke({"query": "  nvidia  stock price?", "max_results": 5})
+        
+        assert first == {"status": "success", "query": "Nvidia stock price"}
+        assert repeat["status"] == "duplicate"
+        assert calls == ["Nvidia stock price"]
+        assert cache.duplicates_avoided == 1
+    
+    def test_different_arguments_are_not_shared(self):
+        search, calls = self.counting_tool()
+        cached_search = ToolCallCache().wrap(search)
+        
+        cached_search.invoke({"query": "Nvidia"})
+        cached_search.invoke({"query": "Nvidia", "max_results": 10})
+        
+        assert len(calls) == 2
+    
+    def test_punctuation_inside_arguments_is_kept(self):
+        search, _ = self.counting_tool()
+        cache = ToolCallCache()
+        
+        assert cache.key(search, {"query": "C++"}) != cache.key(search, {"query": "C"})
+        assert cache.key(search, {"query": "U.S. GDP"}) != cache.key(search, {"query": "us gdp"})
+        assert cache.key(search, {"query": "GPT 3.5"}) != cache.key(search, {"query": "GPT 3 5"})
+        assert cache.key(search, {"query": "Nvidia earnings."}) == cache.key(search, {"query": "nvidia earnings"})
+    
+    def test_error_results_are_retried(self):
+        search, calls = self.counting_tool([{"status": "error", "message": "Ratelimit"}])
+        cached_search = ToolCallCache().wrap(search)
+        
+        cached_search.invoke({"query": "Nvidia"})
+        result = cached_search.invoke({"query": "Nvidia"})
+        
+        assert result == {"status": "success", "query": "Nvidia"}
+        assert len(calls) == 2
+    
+    def test_stored_result_is_returned_in_full_once(self):
+        search, calls = self.counting_tool()
+        cache = ToolCallCache()
+        cached_search = cache.wrap(search)
+        cache.put(cache.key(search, {"query": "Nvidia"}), {"status": "success", "query": "Nvidia", "results": ["prefetched"]})
+        
+        assert cached_search.invoke({"query": "nvidia"})["results"] == ["prefetched"]
+        assert cached_search.invoke({"query": "nvidia"})["status"] == "duplicate"
+        assert calls == []
+    
+    @patch('langgraph_setup.create_react_agent')
+    def test_graph_tools_go_through_the_cache(self, mock_create_react_agent):
+        setup = LangGraphSetup()
+        
+        tools = mock_create_react_agent.call_args.kwargs["tools"]
+        assert [t.name for t in tools] == [t.name for t in setup.tool_setup.get_tools()]
+        assert tools[0] is not search_wikipedia
+
+class TestToolResilience:
+    def make_tool(self, behaviour):
+        @tool
+        def flaky_search(query: str) -> dict:
+            """Search for a query."""
+            return behaviour(query)
+        
+        return flaky_search
+    
+    def test_slow_call_times_out_with_structured_error(self):
+        resilience = ToolResilience(policies={"flaky_search": ToolPolicy(timeout=0.1)})
+        slow_search = resilience.wrap(self.make_tool(lambda query: time.sleep(1) or {"status": "success"}))
+        
+        start = time.monotonic()
+        result = slow_search.invoke({"query": "Nvidia"})
+        
+        assert time.monotonic() - start < 0.5
+        assert result["status"] == "timeout"
+        assert result["tool"] == "flaky_search"
+    
+    def test_breaker_opens_after_failures_and_closes_after_trial(self):
+        responses = [{"status": "error", "message": "Ratelimit"}] * 2 + [{"status": "success"}]
+        calls = []
+        resilience = ToolResilience(policies={"flaky_search": ToolPolicy(timeout=1)}, failure_threshold=2, reset_seconds=0.1)
+        flaky_search = resilience.wrap(self.make_tool(lambda query: calls.append(query) or responses[len(calls) - 1]))
+        
+        flaky_search.invoke({"query": "a"})
+        flaky_search.invoke({"query": "b"})
+        rejected = flaky_search.invoke({"query": "c"})
+        
+        assert rejected["status"] == "unavailable"
+        assert calls == ["a", "b"]
+        assert metrics.get("tool_breaker.flaky_search.state") == "open"
+        
+        time.sleep(0.15)
+        assert flaky_search.invoke({"query": "d"}) == {"status": "success"}
+        assert metrics.get("tool_breaker.flaky_search.state") == "closed"
+    
+    def test_slow_call_is_hedged(self):
+        calls = []
+        lock = threading.Lock()
+        
+        def search(query):
+            with lock:
+                calls.append(query)
+                first = len(calls) == 1
+            time.sleep(1 if first else 0.01)
+            return {"status": "success", "hedged": not first}
+        
+        resilience = ToolResilience(policies={"flaky_search": ToolPolicy(timeout=2)})
+        for _ in range(20):
+            resilience.latency("flaky_search").record(0.05)
+        hedged_search = resilience.wrap(self.make_tool(search))
+        
+        start = time.monotonic()
+        result = hedged_search.invoke({"query": "Nvidia"})
+        
+        assert result == {"status": "success", "hedged": True}
+        assert time.monotonic() - start < 0.5
+        assert len(calls) == 2
+    
+    def test_abandoned_calls_fill_only_their_tool(self):
+        resilience = ToolResilience(policies={"flaky_search": ToolPolicy(timeout=0.05, max_in_flight=1)})
+        hanging_search = resilience.wrap(self.make_tool(lambda query: time.sleep(0.5) or {"status": "success"}))
+        
+        @tool
+        def lookup_agent_file(name: str) -> dict:
+            """Read an agent file."""
+            return {"status": "success", "name": name}
+        
+        assert hanging_search.invoke({"query": "a"})["status"] == "timeout"
+        busy = hanging_search.invoke({"query": "b"})
+        
+        assert busy["status"] == "unavailable"
+        assert resilience.breaker("flaky_search").failures == 1
+        assert resilience.wrap(lookup_agent_file).invoke({"name": "report.pdf"})["status"] == "success"
+    
+    def test_timeouts_are_not_cached(self):
+        calls = []
+        resilience = ToolResilience(policies={"flaky_search": ToolPolicy(timeout=0.1)})
+        
+        def slow_first(query):
+            calls.append(query)
+            time.sleep(0.3 if len(calls) == 1 else 0)
+            return {"status": "success"}
+        
+        cached_search = ToolCallCache().wrap(resilience.wrap(self.make_tool(slow_first)))
+        
+        assert cached_search.invoke({"query": "Nvidia"})["status"] == "timeout"
+        assert cached_search.invoke({"query": "Nvidia"}) == {"status": "success"}
+        assert len(calls) == 2
+    
+    @patch('langgraph_setup.create_react_agent')
+    def test_graph_tools_are_resilient(self, mock_create_react_agent):
+        setup = LangGraphSetup(tool_setup=ToolSetup(resilience=MagicMock(wrap_tools=MagicMock(return_value=[search_wikipedia]))))
+        
+        setup.tool_setup.resilience.wrap_tools.assert_called_once_with(setup.tool_setup.get_tools())
+        assert [t.name for t in mock_create_react_agent.call_args.kwargs["tools"]] == ["search_wikipedia"]
+
+class TestToolPrefetch:
+    def counting_tool(self, delay=0.0, results=None):
+        calls = []
+        
+        @tool
+        def search_wikipedia(topic: str) -> dict:
+            """Get information about a topic from Wikipedia."""
+            calls.append(topic)
+            time.sleep(delay)
+            return results.pop(0) if results else {"status": "success", "title": topic}
+        
+        return search_wikipedia, calls
+    
+    def test_extracts_entities_from_questions(self):
+        assert extract_search_terms("What is Nvidia's market share compared to AMD?") == ["Nvidia", "AMD"]
+        assert extract_search_terms('How did "Project Stargate" change Bank of the West in 2025?') == ["Project Stargate", "Bank of the West"]
+        assert extract_search_terms("Compare Tesla and BYD sales.", max_terms=1) == ["Tesla"]
+        assert extract_search_terms("what is the weather like today?") == []
+    
+    def test_model_call_waits_for_the_prefetch_instead_of_repeating_it(self):
+        search, calls = self.counting_tool(delay=0.2)
+        cache = ToolCallCache()
+        
+        started = ToolPrefetcher(tool_names=["search_wikipedia"]).start("Who founded Nvidia?", [search], cache)
+        result = cache.wrap(search).invoke({"topic": "nvidia"})
+        
+        assert started == 1
+        assert result == {"status": "success", "title": "Nvidia"}
+        assert calls == ["Nvidia"]
+        assert cache.prefetch_hits == 1
+        assert cache.duplicates_avoided == 0
+        assert cache.unused_prefetches() == 0
+    
+    def test_failed_prefetch_is_retried_by_the_model_call(self):
+        search, calls = self.counting_tool(results=[{"status": "timeout"}])
+        cache = ToolCallCache()
+        
+        ToolPrefetcher(tool_names=["search_wikipedia"]).start("Who founded Nvidia?", [search], cache)
+        result = cache.wrap(search).invoke({"topic": "Nvidia"})
+        
+        assert result == {"status": "success", "title": "Nvidia"}
+        assert calls == ["Nvidia", "Nvidia"]
+    
+    @patch('langgraph_setup.create_react_agent')
+    def test_research_prefetches_into_the_run_cache(self, mock_create_react_agent):
+        search, calls = self.counting_tool(delay=0.1)
+        resilience = MagicMock(wrap_tools=MagicMock(return_value=[search]))
+        setup = LangGraphSetup(tool_setup=ToolSetup(resilience=resilience), prefetcher=ToolPrefetcher(tool_names=["search_wikipedia"]))
+        graph_tools = mock_create_react_agent.call_args.kwargs["tools"]
+        
+        async def astream(formatted_input, config, stream_mode):
+            graph_tools[0].invoke({"topic": "Jensen Huang"})
+            yield {"messages": [MagicMock(type="ai", content="Jensen Huang founded Nvidia.")]}
+        
+        setup.graph.astream.side_effect = astream
+        messages = setup.research("Who is Jensen Huang?")
+        
+        assert messages[-1]["content"] == "Jensen Huang founded Nvidia."
+        assert calls == ["Jensen Huang"]
+        assert setup.tool_cache.prefetch_hits == 1
+
+class ToolCallingFakeModel(GenericFakeChatModel):
+    def bind_tools(self, tools, **kwargs):
+        return self
+
+class TestResearchBudget:
+    def tool_call(self, topic):
+        return AIMessage(content="", tool_calls=[{"name": "search_wikipedia", "args": {"topic": topic}, "id": f"call_{topic}"}])
+    
+    def setup(self, responses, budget, delay=0.0, on_call=None):
+        calls = []
+        
+        @tool
+        def search_wikipedia(topic: str) -> dict:
+            """Get information about a topic from Wikipedia."""
+            calls.append(topic)
+            if on_call:
+                on_call()
+            time.sleep(delay)
+            return {"status": "success", "title": topic}
+        
+        model = ToolCallingFakeModel(messages=iter(responses))
+        tool_setup = ToolSetup(resilience=MagicMock(wrap_tools=MagicMock(return_value=[search_wikipedia])))
+        return LangGraphSetup(MagicMock(get_model=MagicMock(return_value=model)), tool_setup, budget=budget), calls
+    
+    def test_untruncated_run_reports_its_steps(self):
+        setup, calls = self.setup([self.tool_call("Nvidia"), AIMessage(content="Nvidia designs GPUs.")], ResearchBudget(60, 3))
+        
+        final = setup.research("What does Nvidia do?")[-1]
+        
+        assert final == {"role": "ai", "content": "Nvidia designs GPUs.", "truncated": False, "steps": 1}
+        assert calls == ["Nvidia"]
+    
+    def test_step_limit_refuses_tools_and_model_answers(self):
+        responses = [self.tool_call("a"), self.tool_call("b"), self.tool_call("c"), AIMessage(content="Partial answer.")]
+        setup, calls = self.setup(responses, ResearchBudget(60, 2))
+        
+        messages = setup.research("Runaway question")
+        
+        assert calls == ["a", "b"]
+        assert any("budget is used up" in str(message["content"]) for message in messages if message["role"] == "tool")
+        assert messages[-1]["content"] == "Partial answer."
+        assert messages[-1]["truncated"] is True
+        assert messages[-1]["steps"] == 2
+    
+    def test_deadline_stops_the_graph_and_synthesizes_an_answer(self):
+        responses = [self.tool_call("a"), AIMessage(content="Answer from what was gathered.")]
+        setup, calls = self.setup(responses, ResearchBudget(0.4, 5, reserve_seconds=0.2), delay=0.6)
+        
+        start = time.monotonic()
+        messages = setup.research("Slow question")
+        
+        assert time.monotonic() - start < 1
+        assert calls == ["a"]
+        assert messages[-1]["content"] == "Answer from what was gathered."
+        assert messages[-1]["truncated"] is True
+        assert setup.budget.truncated == "deadline"
+    
+    def test_slow_synthesis_is_bounded_by_the_deadline(self):
+        setup, calls = self.setup([self.tool_call("a")], ResearchBudget(0.4, 5, reserve_seconds=0.2), delay=0.6)
+        
+        async def slow_answer(prompt):
+            await asyncio.sleep(5)
+        
+        setup.model = MagicMock(ainvoke=slow_answer)
+        timeouts_before = metrics.get("research.synthesis_timeouts")
+        
+        start = time.monotonic()
+        messages = setup.research("Slow question")
+        
+        assert time.monotonic() - start < 1
+        assert messages[-1]["content"] == SYNTHESIS_TIMEOUT_ANSWER
+        assert messages[-1]["truncated"] is True
+        assert metrics.get("research.synthesis_timeouts") == timeouts_before + 1
+
+    def test_cancel_stops_the_run_and_records_saved_calls(self):
+        responses = [self.tool_call("a"), self.tool_call("b"), AIMessage(content="Never reached.")]
+        setup, calls = self.setup(responses, ResearchBudget(60, 5), on_call=lambda: setup.cancel())
+        cancelled_before = metrics.get("research.cancelled")
+        abandoned_before = metrics.get("research.abandoned_tool_calls")
+        
+        messages = setup.research("Question from a client that disconnects")
+        
+        assert calls == ["a"]
+        assert messages[-1]["role"] == "ai"
+        assert messages[-1]["truncated"] is True
+        assert setup.budget.truncated == "cancelled"
+        assert metrics.get("research.cancelled") == cancelled_before + 1
+        assert metrics.get("research.abandoned_tool_calls") == abandoned_before + 1
+
+class TestModelRouter:
+    def answer(self, content):
+        return AIMessage(content=content)
+    
+    def tool_call(self, topic):
+        return AIMessage(content="", tool_calls=[{"name": "search_wikipedia", "args": {"topic": topic}, "id": f"call_{topic}"}])
+    
+    def research(self, router, question, files=()):
+        @tool
+        def search_wikipedia(topic: str) -> dict:
+            """Get information about a topic from Wikipedia."""
+            return {"status": "success", "title": topic}
+        
+        llm_setup = MagicMock(get_model=router.chat_model)
+        tool_setup = ToolSetup(resilience=MagicMock(wrap_tools=MagicMock(return_value=[search_wikipedia])))
+        return LangGraphSetup(llm_setup, tool_setup, agent_files=list(files)).research(question)
+    
+    def test_rules_pick_the_first_matching_route(self):
+        router = ModelRouter(
+            {"fast": MagicMock(), "strong": MagicMock()},
+            rules=[RoutingRule("strong", min_kb_tokens=50000), RoutingRule("strong", min_query_chars=200, min_prompt_tokens=1000)]
+        )
+        
+        assert router.select(prompt_tokens=100, kb_tokens=60000, query_chars=10) == "strong"
+        assert router.select(prompt_tokens=2000, kb_tokens=0, query_chars=300) == "strong"
+        assert router.select(prompt_tokens=500, kb_tokens=0, query_chars=300) == "fast"
+        with pytest.raises(ValueError):
+            ModelRouter({"fast": MagicMock()}, synthesis="strong")
+    
+    def test_large_knowledge_base_runs_on_the_strong_model(self):
+        strong = ToolCallingFakeModel(messages=iter([self.tool_call("Nvidia"), self.answer("Strong answer.")]))
+        fast = ToolCallingFakeModel(messages=iter([]))
+        router = ModelRouter({"fast": lambda: fast, "strong": lambda: strong}, rules=[RoutingRule("strong", min_kb_tokens=1000)])
+        
+        messages = self.research(router, "What does Nvidia do?", files=[File(name="report.pdf", text="Revenue grew.", tokens=2000)])
+        
+        assert messages[-1]["content"] == "Strong answer."
+    
+    def test_fast_model_selects_tools_and_strong_model_answers(self):
+        bound = []
+        
+        class BindingRecorder(ToolCallingFakeModel):
+            def bind_tools(self, tools, **kwargs):
+                bound.append(self)
+                return self
+        
+        fast = BindingRecorder(messages=iter([self.tool_call("Nvidia"), self.answer("Fast answer.")]))
+        strong = BindingRecorder(messages=iter([self.answer("Strong answer.")]))
+        router = ModelRouter({"fast": lambda: fast, "strong": lambda: strong}, synthesis="strong")
+        fast_calls, strong_calls = metrics.get("model.fast.calls"), metrics.get("model.strong.calls")
+        discarded_tokens = metrics.get("model_routing.synthesis.discarded_tokens")
+        
+        messages = self.research(router, "What does Nvidia do?")
+        
+        assert messages[-1]["content"] == "Strong answer."
+        assert metrics.get("model.fast.calls") - fast_calls == 2
+        assert metrics.get("model.strong.calls") - strong_calls == 1
+        assert metrics.get("model.fast.seconds") > 0
+        assert strong not in bound
+        assert metrics.get("model_routing.synthesis.discarded_tokens") - discarded_tokens == router.token_manager.count_tokens("Fast answer.")
+    
+    def test_forced_answer_is_written_by_the_synthesis_route(self):
+        fast = ToolCallingFakeModel(messages=iter([]))
+        strong = ToolCallingFakeModel(messages=iter([self.answer("Strong answer.")]))
+        router = ModelRouter({"fast": lambda: fast, "strong": lambda: strong}, synthesis="strong")
+        setup = LangGraphSetup(MagicMock(get_model=router.chat_model), ToolSetup(resilience=MagicMock(wrap_tools=MagicMock(return_value=[]))))
+        setup.budget.stop("deadline")
+        strong_calls = metrics.get("model.strong.calls")
+        
+        answer = asyncio.run(setup._synthesize([HumanMessage(content="What does Nvidia do?")]))
+        
+        assert answer.content == "Strong answer."
+        assert metrics.get("model.strong.calls") - strong_calls == 1
+    
+    def test_concurrency_is_limited_per_route(self):
+        active = []
+        peak = []
+        lock = threading.Lock()
+        
+        class SlowFakeModel(GenericFakeChatModel):
+            def _generate(self, *args, **kwargs):
+                with lock:
+                    active.append(1)
+                    peak.append(len(active))
+                time.sleep(0.05)
+                with lock:
+                    active.pop()
+                return super()._generate(*args, **kwargs)
+        
+        model = SlowFakeModel(messages=itertools.repeat(AIMessage(content="ok")))
+        router = ModelRouter({"fast": lambda: model}, max_concurrency={"fast": 2})
+        
+        with ThreadPoolExecutor(max_workers=6) as executor:
+            results = list(executor.map(lambda i: router.chat_model().invoke(f"Question {i}"), range(6)))
+        
+        assert [result.content for result in results] == ["ok"] * 6
+        assert max(peak) == 2
+
+    def test_async_concurrency_is_limited_per_route(self):
+        active = []
+        peak = []
+        
+        class SlowFakeModel(GenericFakeChatModel):
+            async def _agenerate(self, *args, **kwargs):
+                active.append(1)
+                peak.append(len(active))
+                await asyncio.sleep(0.05)
+                active.pop()
+                return await super()._agenerate(*args, **kwargs)
+        
+        model = SlowFakeModel(messages=itertools.repeat(AIMessage(content="ok")))
+        router = ModelRouter({"fast": lambda: model}, max_concurrency={"fast": 2})
+        
+        async def ask_all():
+            return await asyncio.gather(*(router.chat_model().ainvoke(f"Question {i}") for i in range(6)))
+        
+        results = asyncio.run(ask_all())
+        
+        assert [result.content for result in results] == ["ok"] * 6
+        assert max(peak) == 2
+        assert metrics.get("model.fast.wait_seconds") > 0
 
 class TestLangGraphSetup:
     @patch('langgraph_setup.create_react_agent')
@@ -61,6 +604,15 @@ class TestLangGraphSetup:
         assert isinstance(setup.tool_setup, ToolSetup)
         mock_create_react_agent.assert_called_once()
     
+    @patch('langgraph_setup.create_react_agent')
+    def test_precomputed_knowledge_prompt_is_used_as_is(self, mock_create_react_agent):
+        with patch('langgraph_setup.build_knowledge_prompt') as mock_build:
+            setup = LangGraphSetup(knowledge_prompt="# KNOWLEDGE BASE\n### report.pdf\nRevenue grew.")
+        
+        mock_build.assert_not_called()
+        prompt = mock_create_react_agent.call_args.kwargs["prompt"]
+        assert prompt == setup.base_system_prompt + "# KNOWLEDGE BASE\n### report.pdf\nRevenue grew."
+    
     def test_extract_message_content_simple(self):
         setup = LangGraphSetup()
         mock_message = MagicMock()
@@ -163,10 +715,11 @@ class TestLangGraphSetup:
         mock_message2.type = "ai"
         mock_message2.content = "test response"
         
-        setup.graph.stream.return_value = [
-            {"messages": [mock_message1]},
-            {"messages": [mock_message1, mock_message2]}
-        ]
+        async def astream(formatted_input, config, stream_mode):
+            yield {"messages": [mock_message1]}
+            yield {"messages": [mock_message1, mock_message2]}
+        
+        setup.graph.astream.side_effect = astream
         
         with patch.object(setup, '_extract_message_content') as mock_extract:
             mock_extract.side_effect = [
@@ -176,11 +729,18 @@ class TestLangGraphSetup:
             results = setup.research("test query")
         
         assert len(results) == 2
-        setup.graph.stream.assert_called_once()
-        formatted_input = setup.graph.stream.call_args[0][0]
+        setup.graph.astream.assert_called_once()
+        formatted_input = setup.graph.astream.call_args[0][0]
         assert formatted_input == {"messages": [{"role": "user", "content": "test query"}]}
 
 class TestToolFunctions:
+    @pytest.fixture(autouse=True)
+    def empty_ddgs_pool(self):
+        """Create DuckDuckGo clients from the patched DDGS in every test"""
+        ddgs_pool.clear()
+        yield
+        ddgs_pool.clear()
+    
     @patch('tool_setup.wikipedia')
     def test_search_wikipedia_success_function(self, mock_wikipedia):
         search_func = search_wikipedia.func
@@ -199,6 +759,23 @@ class TestToolFunctions:
         assert result["url"] == "https://en.wikipedia.org/wiki/Test_Title"
         assert result["summary"] == "Test summary"
     
+    @patch('tool_setup.wikipedia')
+    def test_search_wikipedia_offline_backend_falls_back_to_api(self, mock_wikipedia):
+        offline = {"title": "Nvidia", "url": "https://en.wikipedia.org/wiki/Nvidia", "summary": "Nvidia designs GPUs.", "status": "success"}
+        index = MagicMock()
+        index.lookup.side_effect = lambda topic: offline if topic == "Nvidia" else None
+        mock_wikipedia.page.return_value = MagicMock(title="AMD", url="https://en.wikipedia.org/wiki/AMD")
+        mock_wikipedia.summary.return_value = "AMD designs CPUs."
+        
+        with patch('tool_setup.wikipedia_index', index):
+            assert search_wikipedia.func("Nvidia") == offline
+            mock_wikipedia.page.assert_not_called()
+            assert search_wikipedia.func("AMD")["summary"] == "AMD designs CPUs."
+            with patch('tool_setup.WIKIPEDIA_LIVE_FALLBACK', False):
+                assert search_wikipedia.func("Intel")["status"] == "page_error"
+        
+        assert mock_wikipedia.page.call_count == 1
+    
     @patch('tool_setup.wikipedia')
     def test_search_wikipedia_disambiguation_function(self, mock_wikipedia):
         search_func = search_wikipedia.func
@@ -252,6 +829,39 @@ class TestToolFunctions:
             max_results=5
         )
     
+    @patch('tool_setup.ddgs_limiter')
+    @patch('tool_setup.DDGS')
+    def test_duckduckgo_session_is_reused_and_throttling_backs_off(self, mock_ddgs, mock_limiter):
+        mock_ddgs.return_value.text.side_effect = [[], RatelimitException("https://duckduckgo.com 202 Ratelimit")]
+        
+        first = search_web_with_duckduckgo.func("test query")
+        second = search_web_with_duckduckgo.func("other query")
+        
+        assert first["status"] == "success"
+        assert second["status"] == "error"
+        mock_ddgs.assert_called_once()
+        assert mock_limiter.acquire.call_count == 2
+        mock_limiter.throttled.assert_called_once()
+    
+    @patch('tool_setup.ddgs_limiter')
+    @patch('tool_setup.DDGS')
+    def test_local_rate_limit_is_not_a_failure(self, mock_ddgs, mock_limiter):
+        mock_limiter.acquire.side_effect = RateLimitExceeded("Rate limit of duckduckgo exceeded", retry_after=3.2)
+        resilience = ToolResilience(failure_threshold=1)
+        
+        result = resilience.wrap(search_web_with_duckduckgo).invoke({"query": "test query"})
+        
+        assert result["status"] == "rate_limited"
+        assert result["retry_after_seconds"] == 3.2
+        assert resilience.breaker("search_web_with_duckduckgo").state == "closed"
+        assert not TOOL_POLICIES["search_web_with_duckduckgo"].hedge
+        mock_ddgs.return_value.text.assert_not_called()
+        
+        cached_search = ToolCallCache().wrap(search_web_with_duckduckgo)
+        cached_search.invoke({"query": "test query"})
+        assert cached_search.invoke({"query": "test query"})["status"] == "rate_limited"
+        assert mock_limiter.acquire.call_count == 3
+    
     @patch('tool_setup.DDGS')
     def test_search_duckduckgo_news_function(self, mock_ddgs):
         search_func = search_duckduckgo_news.func
@@ -277,4 +887,64 @@ class TestToolFunctions:
             safesearch="moderate",
             timelimit="d",
             max_results=5
-        )
\ No newline at end of file
+        )
+
+class TestResultShaper:
+    def test_duplicates_and_unused_fields_are_dropped(self):
+        shaper = ResultShaper(budgets={"search_duckduckgo_news": 1000})
+        result = {"status": "success", "results": [
+            {"title": "Nvidia earnings", "href": "https://www.example.com/nvidia/", "body": "Revenue rose.", "image": "https://img.example.com/1.png", "source": "Unknown source"},
+            {"title": "Nvidia earnings", "href": "http://example.com/nvidia#top", "body": "Revenue rose.", "image": None},
+            {"title": "AMD earnings", "href": "https://example.com/amd", "body": "No body text"},
+        ]}
+        
+        shaped = shaper.shape("search_duckduckgo_news", result)
+        
+        assert shaped["results"] == [
+            {"title": "Nvidia earnings", "href": "https://www.example.com/nvidia/", "body": "Revenue rose."},
+            {"title": "AMD earnings", "href": "https://example.com/amd"},
+        ]
+        assert len(result["results"]) == 3
+    
+    def test_long_snippets_share_the_budget(self):
+        shaper = ResultShaper(budgets={"search_web_with_duckduckgo": 200})
+        long_body = " ".join(f"Sentence number {i} about the company." for i in range(100))
+        result = {"status": "success", "results": [
+            {"title": "Short", "href": "https://a.com", "body": "A short snippet."},
+            {"title": "Long", "href": "https://b.com", "body": long_body},
+            {"title": "Longer", "href": "https://c.com", "body": long_body + long_body},
+        ]}
+        
+        shaped = shaper.shape("search_web_with_duckduckgo", result)
+        
+        assert shaper.tokens(shaped) <= 200
+        assert shaped["results"][0]["body"] == "A short snippet."
+        for item in shaped["results"][1:]:
+            assert item["body"].endswith(".…")
+            assert len(item["body"]) < len(long_body)
+    
+    def test_special_token_text_is_truncated(self):
+        shaper = ResultShaper(budgets={"search_web_with_duckduckgo": 60})
+        body = "Models end documents with <|endoftext|> markers. " * 50
+        result = {"status": "success", "results": [{"title": "Tokenizers", "href": "https://a.com", "body": body}]}
+        
+        shaped = shaper.shape("search_web_with_duckduckgo", result)
+        
+        assert shaper.tokens(shaped) <= 60
+        assert shaped["results"][0]["body"].startswith("Models end documents with <|endoftext|>")
+    
+    def test_unbudgeted_tools_and_wrapped_tools(self):
+        shaper = ResultShaper(budgets={"search_wikipedia": 50})
+        
+        @tool
+        def search_wikipedia(query: str) -> dict:
+            """Search Wikipedia."""
+            return {"status": "success", "title": query, "summary": "Nvidia designs GPUs. " * 200, "url": "https://en.wikipedia.org/wiki/Nvidia"}
+        
+        unchanged = {"status": "success", "summary": "x " * 500}
+        assert shaper.shape("search_agent_knowledge", unchanged) is unchanged
+        
+        shaped = shaper.wrap(search_wikipedia).invoke({"query": "Nvidia"})
+        assert shaper.tokens(shaped) <= 50
+        assert shaped["url"] == "https://en.wikipedia.org/wiki/Nvidia"
+        assert shaped["summary"].startswith("Nvidia designs GPUs.")
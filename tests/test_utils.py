@@ -0,0 +1,845 @@
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import json
+import os
+import pytest
+import subprocess
+import sys
+import threading
+from unittest.mock import MagicMock, patch
+
+parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if parent_dir not in sys.path:
+    sys.path.append(parent_dir)
+
+from pypdf import PdfWriter
+from bson import ObjectId
+from utils.agent_snapshot import SnapshotFormatError, SnapshotWriter, import_agents, iter_records
+from utils.context_packer import ContextPacker, split_spans
+from utils.dedup import MinHasher, deduplicate_passages
+from utils.document_extractor import DocumentExtractor
+import io
+from models.agents import AgentFileListing, File as FileModel, FileListing
+from models.ingestions import IngestionStatus
+from utils.ingestion_pipeline import IngestionPipeline
+from utils.json_stream import iter_model_json
+from utils.knowledge_prompt import build_knowledge_prompt, build_knowledge_toc, create_knowledge_prompt, knowledge_version
+from utils.lazy_import import LazyCallable, import_timings
+from utils.metrics import metrics
+from utils.client_pool import ClientPool
+from utils.rate_limiter import MongoBucketStore, RateLimitExceeded, TokenBucketLimiter
+from utils.spreadsheet_extractor import SpreadsheetExtractor
+import mongomock
+import time
+from utils.summarizer import DocumentSummarizer
+from langchain_core.language_models.fake_chat_models import FakeListChatModel
+from utils.text_compression import TextCompressor, train_dictionary
+import numpy as np
+import openpyxl
+from utils.token_manager import TokenManager
+from utils.vector_index import HashingEmbedder, VectorIndexStore
+from utils.wikipedia_index import WikipediaIndex, build_wikipedia_index
+import gzip
+
+def write_blank_pdf(path, pages):
+    writer = PdfWriter()
+    for _ in range(pages):
+        writer.add_blank_page(width=200, height=200)
+    with open(path, "wb") as f:
+        writer.write(f)
+
+class TestTokenManager:
+    def test_count_tokens_matches_tiktoken(self):
+        token_manager = TokenManager()
+        text = "The quick brown fox jumps over the lazy dog."
+        
+        assert token_manager.count_tokens(text) == len(token_manager.encoding.encode(text))
+        assert token_manager.count_tokens("") == 0
+    
+    def test_count_tokens_uses_cache(self):
+        token_manager = TokenManager()
+        text = "cached text " * 10
+        
+        first = token_manager.count_tokens(text)
+        with patch.object(token_manager, "_count_uncached") as mock_count:
+            second = token_manager.count_tokens(text)
+        
+        assert first == second
+        mock_count.assert_not_called()
+        assert token_manager.cache_hits == 1
+    
+    def test_cache_evicts_least_recently_used(self):
+        token_manager = TokenManager(cache_size=2)
+        
+        token_manager.count_tokens("one")
+        token_manager.count_tokens("two")
+        token_manager.count_tokens("one")
+        token_manager.count_tokens("three")
+        
+        assert token_manager._text_key("one") in token_manager._cache
+        assert token_manager._text_key("two") not in token_manager._cache
+    
+    def test_segmented_count_is_exact(self):
+        token_manager = TokenManager(segment_chars=50)
+        text = "\n".join(f"Line {i}: some words, numbers 12345 and  spacing." for i in range(200))
+        
+        assert len(token_manager._split_segments(text)) > 1
+        assert token_manager.count_tokens(text) == len(token_manager.encoding.encode(text))
+    
+    def test_count_tokens_batch(self):
+        token_manager = TokenManager(num_threads=2)
+        texts = ["alpha beta", "", "gamma delta epsilon", "alpha beta", "zeta"]
+        
+        counts = token_manager.count_tokens_batch(texts)
+        
+        assert counts == [len(token_manager.encoding.encode(text)) for text in texts]
+        assert len(token_manager._cache) == 3
+
+class TestDocumentExtractorPdf:
+    def test_choose_pdf_strategy_text_layer(self):
+        extractor = DocumentExtractor(token_manager=TokenManager())
+        page = MagicMock()
+        page.extract_text.return_value = "Some extractable text on this page. " * 5
+        reader = MagicMock()
+        reader.pages = [page] * 12
+        
+        assert extractor.choose_pdf_strategy(reader) == "fast"
+    
+    def test_choose_pdf_strategy_scanned(self, tmp_path):
+        extractor = DocumentExtractor(token_manager=TokenManager())
+        pdf_path = str(tmp_path / "scan.pdf")
+        write_blank_pdf(pdf_path, 3)
+        
+        with patch("utils.document_extractor._partition_pdf_pages", return_value=["scanned"]) as mock_partition:
+            text, _ = extractor.extract_from_file(pdf_path)
+        
+        assert text == "scanned"
+        mock_partition.assert_called_once_with(pdf_path, "hi_res")
+    
+    def test_large_pdf_is_partitioned_in_parallel_and_merged_in_order(self, tmp_path):
+        executor = ThreadPoolExecutor(max_workers=4)
+        extractor = DocumentExtractor(token_manager=TokenManager(), max_workers=4, executor=executor)
+        pdf_path = str(tmp_path / "report.pdf")
+        write_blank_pdf(pdf_path, 25)
+        
+        def fake_partition(chunk_path, strategy, starting_page_number=1):
+            return [f"{strategy}:{starting_page_number}"]
+        
+        with patch("utils.document_extractor._partition_pdf_pages", side_effect=fake_partition) as mock_partition:
+            text, tokens = extractor.extract_from_file(pdf_path, pdf_strategy="fast")
+        
+        executor.shutdown()
+        assert mock_partition.call_count == 3
+        assert text == "fast:1\n\nfast:11\n\nfast:21"
+        assert tokens > 0
+    
+    def test_invalid_pdf_strategy(self, tmp_path):
+        extractor = DocumentExtractor(token_manager=TokenManager())
+        pdf_path = str(tmp_path / "doc.pdf")
+        write_blank_pdf(pdf_path, 1)
+        
+        with pytest.raises(Exception) as e:
+            extractor.extract_from_file(pdf_path, pdf_strategy="magic")
+        
+        assert "Unsupported PDF strategy" in str(e.value)
+
+class TestLazyPartitioners:
+    def test_lazy_callable_imports_on_first_call(self):
+        lazy_dumps = LazyCallable("json", "dumps")
+        
+        assert not lazy_dumps.loaded
+        assert lazy_dumps({"a": 1}) == '{"a": 1}'
+        assert lazy_dumps.loaded
+        assert "json" in import_timings
+    
+    def test_warm_up_loads_requested_backends(self):
+        extractor = DocumentExtractor(token_manager=TokenManager())
+        lazy_loads = LazyCallable("json", "loads")
+        
+        with patch.dict("utils.document_extractor.PARTITIONERS", {".json": lazy_loads}, clear=True):
+            extractor.warm_up()
+        
+        assert lazy_loads.loaded
+    
+    def test_app_import_does_not_load_partitioners(self):
+        code = (
+            "import sys, main\n"
+            "print(any(name.startswith('unstructured.partition') for name in sys.modules))\n"
+        )
+        env = dict(os.environ, OPENAI_API_KEY="test")
+        result = subprocess.run([sys.executable, "-c", code], cwd=parent_dir, env=env, capture_output=True, text=True)
+        
+        assert result.stdout.strip().splitlines()[-1] == "False"
+
+class TestSpreadsheetExtractor:
+    def test_render_sheet_compacts_rows(self):
+        extractor = SpreadsheetExtractor(token_manager=TokenManager())
+        rows = [
+            (None, None, None),
+            ("Region", "Product", "Product", None),
+            ("North", "Widget", "A", None),
+            ("North", "Gadget", "A", None),
+            ("North", "Gadget", "A", None),
+            ("North", "Gadget", "A", None),
+            ("Region", "Product", "Product", None),
+            ("South", "Gadget", 2.0, None),
+        ]
+        
+        text, data_rows = extractor.render_sheet("Sales", rows)
+        
+        assert data_rows == 5
+        assert text == "\n".join([
+            "## Sheet: Sales",
+            "Region | Product | Product_2",
+            "North | Widget | A",
+            '" | Gadget | "',
+            "(previous row repeated 2x)",
+            'South | " | 2',
+        ])
+    
+    def test_max_rows_per_sheet(self):
+        extractor = SpreadsheetExtractor(token_manager=TokenManager(), max_rows_per_sheet=2)
+        rows = [("id",)] + [(i,) for i in range(5)]
+        
+        text, data_rows = extractor.render_sheet("Ids", rows)
+        
+        assert data_rows == 2
+        assert text.endswith("(3 more rows omitted)")
+    
+    def test_extract_xlsx_reports_tokens_per_sheet(self, tmp_path):
+        workbook = openpyxl.Workbook()
+        first = workbook.active
+        first.title = "First"
+        first.append(["Name", "Score"])
+        first.append(["Ada", 10])
+        second = workbook.create_sheet("Second")
+        second.append(["City"])
+        second.append(["Paris"])
+        path = str(tmp_path / "book.xlsx")
+        workbook.save(path)
+        
+        token_manager = TokenManager()
+        extractor = DocumentExtractor(token_manager=token_manager)
+        text, tokens = extractor.extract_from_file(path)
+        extraction = extractor.extract_spreadsheet(path)
+        
+        assert text == "## Sheet: First\nName | Score\nAda | 10\n\n## Sheet: Second\nCity\nParis"
+        assert tokens == token_manager.count_tokens(text)
+        assert [sheet.name for sheet in extraction.sheets] == ["First", "Second"]
+        assert [sheet.rows for sheet in extraction.sheets] == [1, 1]
+        assert all(sheet.tokens > 0 for sheet in extraction.sheets)
+
+class TestIngestionPipeline:
+    def run_pipeline(self, tmp_path, texts, max_tokens=120000):
+        token_manager = TokenManager(max_tokens=max_tokens)
+        extractor = MagicMock()
+        extractor.extract_text.side_effect = lambda path: texts[os.path.basename(path)]
+        pipeline = IngestionPipeline(document_extractor=extractor, token_manager=token_manager)
+        
+        spool_dir = tmp_path / "spool"
+        spool_dir.mkdir()
+        paths = []
+        for name in texts:
+            (spool_dir / name).write_text("spooled")
+            paths.append(str(spool_dir / name))
+        
+        with patch("utils.ingestion_pipeline.update_ingestion_file") as mock_update_file, \
+             patch("utils.ingestion_pipeline.update_ingestion") as mock_update, \
+             patch("utils.ingestion_pipeline.update_agent_files") as mock_update_agent_files, \
+             patch("utils.ingestion_pipeline.refresh_knowledge_prompt") as mock_refresh:
+            asyncio.run(pipeline.run("ingestion-id", "agent-id", list(texts), paths))
+        
+        assert not spool_dir.exists()
+        mock_refresh.assert_called_once_with("agent-id")
+        assert all(call.kwargs == {"refresh_prompt": False} for call in mock_update_agent_files.call_args_list)
+        return mock_update_file, mock_update, mock_update_agent_files
+    
+    def test_run_persists_each_file(self, tmp_path):
+        texts = {"a.pdf": "first document", "b.docx": "second document"}
+        
+        mock_update_file, mock_update, mock_update_agent_files = self.run_pipeline(tmp_path, texts)
+        
+        assert mock_update_agent_files.call_count == 2
+        persisted = sorted(call.args[1][0].name for call in mock_update_agent_files.call_args_list)
+        assert persisted == ["a.pdf", "b.docx"]
+        statuses = [call.args[2] for call in mock_update_file.call_args_list]
+        assert statuses.count(IngestionStatus.DONE) == 2
+        assert mock_update.call_args_list[-1].kwargs == {"status": IngestionStatus.COMPLETED}
+    
+    def test_run_records_per_file_errors(self, tmp_path):
+        texts = {"small.pdf": "tiny", "huge.pdf": "word " * 50}
+        
+        mock_update_file, mock_update, mock_update_agent_files = self.run_pipeline(tmp_path, texts, max_tokens=10)
+        
+        mock_update_agent_files.assert_called_once()
+        failed = [call for call in mock_update_file.call_args_list if call.args[2] == IngestionStatus.FAILED]
+        assert len(failed) == 1
+        assert "Token limit exceeded" in failed[0].kwargs["error"]
+        assert mock_update.call_args_list[-1].kwargs == {"status": IngestionStatus.COMPLETED_WITH_ERRORS}
+    
+    def test_run_finishes_when_errors_cannot_be_recorded(self, tmp_path):
+        token_manager = TokenManager()
+        extractor = MagicMock()
+        extractor.extract_text.side_effect = ValueError("corrupt file")
+        pipeline = IngestionPipeline(document_extractor=extractor, token_manager=token_manager)
+        path = tmp_path / "bad.pdf"
+        path.write_text("spooled")
+        
+        async def update_file(ingestion_id, index, status, **kwargs):
+            if status == IngestionStatus.FAILED:
+                raise ConnectionError("database unavailable")
+        
+        with patch("utils.ingestion_pipeline.update_ingestion_file", side_effect=update_file), \
+             patch("utils.ingestion_pipeline.update_ingestion") as mock_update, \
+             patch("utils.ingestion_pipeline.update_agent_files") as mock_update_agent_files, \
+             patch("utils.ingestion_pipeline.refresh_knowledge_prompt"):
+            asyncio.run(asyncio.wait_for(pipeline.run("ingestion-id", "agent-id", ["bad.pdf"], [str(path)]), timeout=5))
+        
+        mock_update_agent_files.assert_not_called()
+        assert mock_update.call_args_list[-1].kwargs == {"status": IngestionStatus.FAILED}
+
+class TestTextCompression:
+    def test_file_stores_text_compressed(self):
+        text = "Quarterly revenue grew by 12 percent. " * 200
+        
+        file = FileModel(name="report.pdf", text=text, tokens=10)
+        
+        assert file.compressed_text
+        assert len(file.compressed_text) < len(text) / 10
+        assert file.text == text
+        assert "compressed_text" not in file.model_dump()
+        assert file.model_dump()["text"] == text
+    
+    def test_text_is_decompressed_on_first_read_only(self):
+        stored = FileModel(name="report.pdf", text="stored text", tokens=2)
+        
+        with patch("models.agents.text_compressor.decompress", return_value="stored text") as mock_decompress:
+            loaded = FileModel.model_validate({
+                "name": "report.pdf",
+                "tokens": 2,
+                "compression": stored.compression,
+                "compressed_text": stored.compressed_text
+            })
+            mock_decompress.assert_not_called()
+            
+            assert loaded.text == "stored text"
+            assert loaded.text == "stored text"
+        
+        mock_decompress.assert_called_once()
+    
+    def test_zlib_and_none_codecs_round_trip(self):
+        for codec in ("zlib", "none"):
+            compressor = TextCompressor(codec=codec)
+            
+            used_codec, payload = compressor.compress("naïve café")
+            
+            assert used_codec == codec
+            assert compressor.decompress(used_codec, payload) == "naïve café"
+    
+    def test_trained_dictionary(self, tmp_path):
+        samples = [f"Invoice {i}: customer {i % 17} ordered {i % 5} widgets at $9.99 each." for i in range(2000)]
+        dictionary_path = tmp_path / "kb.dict"
+        dictionary_path.write_bytes(train_dictionary(samples, dict_size=4096))
+        
+        compressor = TextCompressor(codec="zstd", dictionary_path=str(dictionary_path))
+        codec, payload = compressor.compress(samples[3])
+        
+        assert compressor.decompress(codec, payload) == samples[3]
+        with pytest.raises(ValueError):
+            TextCompressor(codec="zstd").decompress(codec, payload)
+
+
+class TestAgentSnapshot:
+    def agent_document(self, name="Agent"):
+        file = FileModel(name="report.pdf", text="Quarterly revenue grew.", tokens=4)
+        return {
+            "_id": ObjectId(),
+            "name": name,
+            "files": [{"name": file.name, "tokens": 4, "compression": file.compression, "compressed_text": file.compressed_text}],
+            "websites": [],
+            "messages": ["hello"]
+        }
+    
+    @pytest.mark.parametrize("fmt", ["msgpack", "ndjson"])
+    def test_round_trip_keeps_stored_text(self, fmt):
+        documents = [self.agent_document("A"), self.agent_document("B")]
+        writer = SnapshotWriter(fmt)
+        
+        stream = io.BytesIO(writer.header() + b"".join(writer.encode(document) for document in documents))
+        records = list(iter_records(stream, fmt))
+        
+        assert records == documents
+        restored = FileModel.model_validate(records[0]["files"][0])
+        assert restored.text == "Quarterly revenue grew."
+    
+    def test_missing_header_is_rejected(self):
+        writer = SnapshotWriter("msgpack")
+        
+        with pytest.raises(SnapshotFormatError):
+            list(iter_records(io.BytesIO(writer.encode(self.agent_document())), "msgpack"))
+    
+    @pytest.mark.parametrize("fmt", ["msgpack", "ndjson"])
+    def test_corrupt_or_truncated_record_is_rejected(self, fmt):
+        writer = SnapshotWriter(fmt)
+        snapshot = writer.header() + writer.encode(self.agent_document())
+        
+        with pytest.raises(SnapshotFormatError):
+            list(iter_records(io.BytesIO(snapshot[:-5]), fmt))
+        with pytest.raises(SnapshotFormatError):
+            list(iter_records(io.BytesIO(writer.header() + b"\xc1{not a record\n"), fmt))
+    
+    def test_import_inserts_in_batches(self):
+        documents = [self.agent_document(f"Agent {i}") for i in range(5)]
+        writer = SnapshotWriter("msgpack")
+        stream = io.BytesIO(writer.header() + b"".join(writer.encode(document) for document in documents))
+        
+        with patch("utils.agent_snapshot.insert_agent_documents") as mock_insert:
+            mock_insert.side_effect = lambda batch: len(batch)
+            
+            imported = asyncio.run(import_agents(stream, "msgpack", batch_size=2))
+        
+        assert imported == 5
+        assert [len(call.args[0]) for call in mock_insert.call_args_list] == [2, 2, 1]
+        first = mock_insert.call_args_list[0].args[0][0]
+        assert first["_id"] != documents[0]["_id"]
+        assert first["total_tokens"] == 4
+        assert first["files"][0]["id"]
+
+
+class TestJsonStream:
+    def test_streamed_json_matches_model_dump(self):
+        model = AgentFileListing(
+            name="Agent",
+            total_tokens=3,
+            files=[FileListing(id=str(i), name=f"file_{i}.pdf", tokens=i) for i in range(50)]
+        )
+        
+        chunks = list(iter_model_json(model, ("files", "websites"), chunk_bytes=256))
+        
+        assert len(chunks) > 1
+        assert json.loads(b"".join(chunks)) == model.model_dump(mode="json", by_alias=True)
+    
+    def test_streamed_file_text_is_not_cached(self):
+        stored = FileModel(name="report.pdf", text="stored text", tokens=2)
+        loaded = FileModel.model_validate(stored.model_dump(exclude={"text"}) | {"compressed_text": stored.compressed_text})
+        
+        assert loaded.read_text(cache=False) == "stored text"
+        assert loaded._text is None
+
+
+class TestKnowledgePrompt:
+    def test_prompt_lists_files_then_websites(self):
+        files = [FileModel(name="report.pdf", text="Revenue grew.", tokens=3)]
+        websites = [FileModel(name="https://example.org", text="About us.", tokens=3)]
+        
+        prompt = build_knowledge_prompt(files, websites)
+        
+        assert prompt.startswith("# KNOWLEDGE BASE")
+        assert prompt.index("### report.pdf\nRevenue grew.") < prompt.index("### https://example.org\nAbout us.")
+    
+    def test_create_records_version_and_tokens(self):
+        files = [FileModel(name="report.pdf", text="Revenue grew.", tokens=3)]
+        token_manager = TokenManager()
+        
+        knowledge_prompt = create_knowledge_prompt(files, token_manager=token_manager)
+        
+        assert knowledge_prompt.text == build_knowledge_prompt(files)
+        assert knowledge_prompt.tokens == token_manager.count_tokens(knowledge_prompt.text)
+        assert knowledge_prompt.version == knowledge_version(files)
+    
+    def test_version_changes_only_with_knowledge_base(self):
+        files = [FileModel(name="report.pdf", text="Revenue grew.", tokens=3)]
+        loaded = [FileModel.model_validate({"name": "report.pdf", "compression": files[0].compression, "compressed_text": files[0].compressed_text})]
+        replaced = [FileModel(name="report.pdf", text="Revenue fell.", tokens=3)]
+        
+        with patch("models.agents.text_compressor.decompress") as mock_decompress:
+            assert knowledge_version(loaded) == knowledge_version(files)
+            mock_decompress.assert_not_called()
+        assert knowledge_version(replaced) != knowledge_version(files)
+        assert knowledge_version([], files) != knowledge_version(files)
+    
+    def test_table_of_contents_lists_sources_without_text(self):
+        files = [FileModel(name="report.pdf", text="Revenue grew.", tokens=3)]
+        loaded = [FileModel.model_validate({"name": "report.pdf", "tokens": 3, "compression": files[0].compression, "compressed_text": files[0].compressed_text})]
+        
+        with patch("models.agents.text_compressor.decompress") as mock_decompress:
+            toc = build_knowledge_toc(loaded, [FileModel(name="https://example.org", text="About us.", tokens=4)])
+            mock_decompress.assert_not_called()
+        
+        assert "| report.pdf | 3 |" in toc and "| https://example.org | 4 |" in toc
+        assert "Revenue grew." not in toc
+        assert build_knowledge_toc([], []) == ""
+
+
+class TestDedup:
+    BOILERPLATE = "This document is confidential and intended only for the named recipient. If you received it in error, delete it and notify the sender immediately. Unauthorized copying or distribution is prohibited."
+    
+    def test_minhash_similarity_tracks_overlap(self):
+        hasher = MinHasher()
+        changed = self.BOILERPLATE.replace("immediately", "at once")
+        unrelated = "Quarterly revenue grew across every region, led by strong demand for solar panels and storage batteries in the south."
+        
+        assert hasher.similarity(hasher.signature(self.BOILERPLATE), hasher.signature(self.BOILERPLATE)) == 1.0
+        assert hasher.similarity(hasher.signature(self.BOILERPLATE), hasher.signature(changed)) > 0.5
+        assert hasher.similarity(hasher.signature(self.BOILERPLATE), hasher.signature(unrelated)) < 0.2
+    
+    def test_short_paragraphs_are_kept(self):
+        results = deduplicate_passages([("a.pdf", "Summary\n\n" + self.BOILERPLATE), ("b.pdf", "Summary\n\n" + self.BOILERPLATE)])
+        
+        assert results[0] == [("Summary", None), (self.BOILERPLATE, None)]
+        assert results[1] == [("Summary", None), (self.BOILERPLATE, "a.pdf")]
+    
+    def test_duplicates_across_sources_are_replaced_with_provenance(self):
+        files = [
+            FileModel(name="a.pdf", text=f"Revenue grew.\n\n{self.BOILERPLATE}", tokens=40),
+            FileModel(name="b.pdf", text=f"Costs fell.\n\n{self.BOILERPLATE}", tokens=40),
+        ]
+        websites = [FileModel(name="https://example.org", text=f"{self.BOILERPLATE}\n\nAbout us.", tokens=40)]
+        token_manager = TokenManager()
+        
+        knowledge_prompt = create_knowledge_prompt(files, websites, token_manager=token_manager)
+        
+        assert knowledge_prompt.text.count(self.BOILERPLATE) == 1
+        assert "### b.pdf\nCosts fell.\n\n[Duplicate passage omitted, see a.pdf]" in knowledge_prompt.text
+        assert "### https://example.org\n[Duplicate passage omitted, see a.pdf]\n\nAbout us." in knowledge_prompt.text
+        assert knowledge_prompt.saved_tokens == 2 * (token_manager.count_tokens(self.BOILERPLATE) - token_manager.count_tokens("[Duplicate passage omitted, see a.pdf]"))
+        assert files[1].text.endswith(self.BOILERPLATE)
+    
+    def test_dedup_can_be_disabled(self):
+        files = [FileModel(name="a.pdf", text=self.BOILERPLATE, tokens=40), FileModel(name="b.pdf", text=self.BOILERPLATE, tokens=40)]
+        deduplicated = create_knowledge_prompt(files)
+        
+        with patch.dict(os.environ, {"KB_DEDUP": "false"}):
+            knowledge_prompt = create_knowledge_prompt(files)
+        
+        assert knowledge_prompt.text.count(self.BOILERPLATE) == 2
+        assert knowledge_prompt.saved_tokens == 0
+        assert knowledge_prompt.version != deduplicated.version
+
+
+class TestDocumentSummarizer:
+    def summarizer(self, responses, **kwargs):
+        model = FakeListChatModel(responses=responses)
+        return DocumentSummarizer(model=model, chunk_tokens=50, requests_per_second=1000, **kwargs), model
+    
+    def test_chunks_are_mapped_then_reduced_to_digest_size(self):
+        text = "\n".join(f"Line {i} of the quarterly report covers revenue, costs and hiring in region {i}." for i in range(40))
+        summarizer, _ = self.summarizer(["Region notes on revenue, costs and hiring."], digest_tokens=60)
+        calls = metrics.get("summaries.model_calls")
+        
+        digest = asyncio.run(summarizer.summarize("report.pdf", text))
+        
+        chunks = len(split_spans(text, 200))
+        assert metrics.get("summaries.model_calls") - calls > chunks
+        assert 0 < summarizer.token_manager.count_tokens(digest) <= 60
+    
+    def test_small_summaries_are_joined_without_reduce(self):
+        summarizer, _ = self.summarizer(["Half."], digest_tokens=100)
+        calls = metrics.get("summaries.model_calls")
+        
+        digest = asyncio.run(summarizer.summarize("report.pdf", "word " * 30 + "\n" + "word " * 30))
+        
+        assert digest == "Half.\n\nHalf."
+        assert metrics.get("summaries.model_calls") - calls == 2
+    
+    def test_summarized_file_uses_digest_unless_full_text(self):
+        summarizer, _ = self.summarizer(["Revenue grew."], digest_tokens=100)
+        file = asyncio.run(summarizer.create_file("report.pdf", "Full report text.", 40000))
+        
+        digest_prompt = create_knowledge_prompt([file])
+        full_prompt = create_knowledge_prompt([file], full_text=True)
+        
+        assert file.tokens == file.summary.tokens
+        assert "Revenue grew." in digest_prompt.text and "Full report text." not in digest_prompt.text
+        assert "Full report text." in full_prompt.text
+        assert digest_prompt.version != full_prompt.version
+    
+    def test_should_summarize_large_or_over_budget(self):
+        summarizer, _ = self.summarizer([], min_tokens=20000)
+        
+        assert summarizer.should_summarize(25000, 100000)
+        assert summarizer.should_summarize(5000, 4000)
+        assert not summarizer.should_summarize(5000, 100000)
+    
+    def test_truncation_accepts_special_token_text(self):
+        summarizer, _ = self.summarizer([], digest_tokens=5)
+        
+        digest = summarizer._truncate("Sample <|endoftext|> marker copied from a tokenizer manual. " * 10)
+        
+        assert digest.startswith("Sample <|")
+        assert summarizer.token_manager.count_tokens(digest) <= 5
+
+
+class TestRateLimiter:
+    def test_burst_passes_then_requests_are_queued(self):
+        limiter = TokenBucketLimiter("search", rate=20, burst=2)
+        
+        assert limiter.acquire() == 0 and limiter.acquire() == 0
+        start = time.monotonic()
+        waited = limiter.acquire()
+        
+        assert waited > 0
+        assert time.monotonic() - start >= 0.04
+    
+    def test_request_beyond_max_wait_is_rejected(self):
+        limiter = TokenBucketLimiter("search", rate=1, burst=1, max_wait=0.5)
+        limiter.acquire()
+        
+        with pytest.raises(RateLimitExceeded):
+            limiter.acquire()
+        with pytest.raises(RateLimitExceeded):
+            limiter.acquire()
+    
+    def test_throttling_backs_off_and_recovers(self):
+        limiter = TokenBucketLimiter("search", rate=4, burst=4, max_wait=0.5)
+        
+        limiter.throttled()
+        
+        assert limiter.rate == 2
+        with pytest.raises(RateLimitExceeded):
+            limiter.acquire()
+        for _ in range(6):
+            limiter.succeeded()
+        assert limiter.rate == 4
+    
+    def test_mongo_store_shares_the_limit_between_workers(self):
+        collection = mongomock.MongoClient().db.rate_limits
+        first = TokenBucketLimiter("search", rate=1, burst=1, store=MongoBucketStore(collection), max_wait=0.5)
+        second = TokenBucketLimiter("search", rate=1, burst=1, store=MongoBucketStore(collection), max_wait=0.5)
+        
+        first.acquire()
+        
+        with pytest.raises(RateLimitExceeded):
+            second.acquire()
+    
+    def test_client_pool_reuses_clients(self):
+        pool = ClientPool(factory=MagicMock, size=1)
+        
+        with pool.client() as first:
+            pass
+        with pool.client() as second:
+            pass
+        with pytest.raises(RuntimeError):
+            with pool.client():
+                raise RuntimeError("Session broken")
+        with pool.client() as third:
+            pass
+        
+        assert first is second
+        assert third is not first
+
+
+class TestContextPacker:
+    def knowledge_base(self):
+        files = [
+            FileModel(name="solar.pdf", text="\n".join(f"Solar panel efficiency note {i}. Photovoltaic cells convert sunlight." for i in range(60)), tokens=900),
+            FileModel(name="wind.pdf", text="\n".join(f"Wind turbine maintenance log {i}. Blades and gearbox inspected." for i in range(60)), tokens=900),
+        ]
+        return files, create_knowledge_prompt(files)
+    
+    def test_small_knowledge_base_is_used_whole(self):
+        files, knowledge_prompt = self.knowledge_base()
+        packer = ContextPacker(budget_tokens=500, full_context_max_tokens=knowledge_prompt.tokens)
+        
+        assert packer.pack("turbine gearbox", knowledge_prompt, files) == knowledge_prompt.text
+    
+    def test_large_knowledge_base_is_packed_by_relevance_within_budget(self):
+        files, knowledge_prompt = self.knowledge_base()
+        token_manager = TokenManager()
+        packer = ContextPacker(token_manager=token_manager, budget_tokens=400, full_context_max_tokens=100, chunk_tokens=50)
+        
+        context = packer.pack("wind turbine gearbox", knowledge_prompt, files)
+        
+        assert token_manager.count_tokens(context) <= 400
+        assert "### wind.pdf" in context
+        assert "### solar.pdf" not in context
+        assert "Wind turbine maintenance log" in context
+    
+    def test_index_is_reused_for_the_same_version(self):
+        files, knowledge_prompt = self.knowledge_base()
+        packer = ContextPacker(budget_tokens=400, full_context_max_tokens=100, chunk_tokens=50)
+        
+        with patch.object(packer, "build_index", wraps=packer.build_index) as mock_build_index:
+            packer.pack("solar", knowledge_prompt, files)
+            packer.pack("wind", knowledge_prompt, files)
+        
+        mock_build_index.assert_called_once()
+    
+    def test_unmatched_query_falls_back_to_leading_chunks(self):
+        files, knowledge_prompt = self.knowledge_base()
+        token_manager = TokenManager()
+        packer = ContextPacker(token_manager=token_manager, budget_tokens=400, full_context_max_tokens=100, chunk_tokens=50)
+        
+        context = packer.pack("quarterly revenue", knowledge_prompt, files)
+        
+        assert token_manager.count_tokens(context) <= 400
+        assert "Solar panel efficiency note 0." in context
+    
+    def test_large_knowledge_base_is_packed_by_default(self, monkeypatch):
+        monkeypatch.delenv("KB_FULL_CONTEXT_MAX_TOKENS", raising=False)
+        monkeypatch.delenv("KB_CONTEXT_BUDGET_TOKENS", raising=False)
+        token_manager = TokenManager(max_tokens=120000)
+        text = "\n".join(f"Quarterly report paragraph {i}: revenue, margins and outlook for segment {i % 40} were reviewed in detail." for i in range(2500))
+        files = [FileModel(name="reports.pdf", text=text, tokens=token_manager.count_tokens(text))]
+        knowledge_prompt = create_knowledge_prompt(files)
+        packer = ContextPacker(token_manager=token_manager)
+        
+        context = packer.pack("segment 7 outlook", knowledge_prompt, files)
+        
+        assert 45000 < knowledge_prompt.tokens < token_manager.max_tokens
+        assert token_manager.count_tokens(context) <= packer.budget_tokens
+
+
+class TestVectorIndex:
+    def agent(self, *files):
+        agent = MagicMock()
+        agent.id = ObjectId()
+        agent.files = list(files)
+        agent.websites = []
+        return agent
+    
+    def solar(self):
+        return FileModel(id="1", name="solar.pdf", text="\n".join(f"Solar panel efficiency note {i}. Photovoltaic cells convert sunlight." for i in range(20)), tokens=300)
+    
+    def wind(self, text=None):
+        return FileModel(id="2", name="wind.pdf", text=text or "\n".join(f"Wind turbine maintenance log {i}. Gearbox inspected." for i in range(20)), tokens=300)
+    
+    def test_hashing_embedder_is_normalized_and_deterministic(self):
+        embedder = HashingEmbedder(dim=256)
+        
+        vectors = embedder.embed(["wind turbine gearbox", "wind turbine gearbox", ""])
+        
+        assert vectors.dtype == np.float32
+        assert np.allclose(np.linalg.norm(vectors[0]), 1)
+        assert np.array_equal(vectors[0], vectors[1])
+        assert not vectors[2].any()
+    
+    def test_search_returns_most_similar_chunks(self, tmp_path):
+        store = VectorIndexStore(root=str(tmp_path), chunk_tokens=30)
+        agent = self.agent(self.solar(), self.wind())
+        store.sync(agent)
+        
+        hits = store.search(str(agent.id), "turbine gearbox maintenance", k=3)
+        
+        assert len(hits) == 3
+        assert all(hit.item_id == "2" for hit in hits)
+        assert hits[0].score >= hits[-1].score
+        assert "Wind turbine" in agent.files[1].text[hits[0].start:hits[0].end]
+    
+    def test_sync_is_incremental(self, tmp_path):
+        store = VectorIndexStore(root=str(tmp_path), chunk_tokens=30)
+        agent = self.agent(self.solar())
+        
+        added = store.sync(agent)
+        with patch.object(store.embedder, "embed", wraps=store.embedder.embed) as mock_embed:
+            assert store.sync(agent) == 0
+            agent.files.append(self.wind())
+            store.sync(agent)
+        
+        embedded = sum(len(call.args[0]) for call in mock_embed.call_args_list)
+        assert added > 0
+        assert embedded == len(store._load_metadata(str(agent.id))) - added
+    
+    def test_replaced_and_removed_items_leave_the_index(self, tmp_path):
+        store = VectorIndexStore(root=str(tmp_path), chunk_tokens=30)
+        agent = self.agent(self.solar(), self.wind())
+        store.sync(agent)
+        
+        agent.files = [self.wind(text="Offshore wind farm expansion")]
+        store.sync(agent)
+        
+        assert store.search(str(agent.id), "solar photovoltaic", k=5) == []
+        hits = store.search(str(agent.id), "turbine gearbox", k=5)
+        assert [hit.item_id for hit in hits] == []
+        assert store.search(str(agent.id), "offshore wind farm", k=5)[0].item_id == "2"
+    
+    def test_search_during_compaction_and_with_k_below_one(self, tmp_path):
+        store = VectorIndexStore(root=str(tmp_path), chunk_tokens=30)
+        agent = self.agent(self.solar(), self.wind())
+        store.sync(agent)
+        errors = []
+        
+        def replace_wind():
+            for i in range(20):
+                agent.files = [self.solar(), self.wind(text="\n".join(f"Wind turbine revision {i} note {j}." for j in range(20)))]
+                store.sync(agent)
+        
+        def search():
+            while writer.is_alive():
+                try:
+                    store.search(str(agent.id), "wind turbine", k=3)
+                except Exception as e:
+                    errors.append(e)
+        
+        writer = threading.Thread(target=replace_wind)
+        writer.start()
+        search()
+        writer.join()
+        
+        assert errors == []
+        assert len(store.search(str(agent.id), "solar photovoltaic", k=0)) == 1
+
+class TestWikipediaIndex:
+    ARTICLES = [
+        ("Nvidia", "Nvidia Corporation is an American technology company that designs graphics processing units."),
+        ("Python (programming language)", "Python is a high-level programming language."),
+        ("Python (genus)", "Python is a genus of constricting snakes."),
+        ("Jensen Huang", "Jensen Huang is the co-founder and chief executive of Nvidia."),
+    ]
+    
+    def build(self, tmp_path, name="index", **kwargs):
+        dump = tmp_path / "abstracts.jsonl"
+        dump.write_text("\n".join(
+            json.dumps({"title": title, "url": f"https://en.wikipedia.org/wiki/{title.replace(' ', '_')}", "abstract": abstract})
+            for title, abstract in self.ARTICLES
+        ))
+        build_wikipedia_index(str(dump), str(tmp_path / name), max_document_frequency=1.0, **kwargs)
+        return WikipediaIndex(str(tmp_path / name))
+    
+    def test_postings_spilled_in_chunks_match_a_single_chunk(self, tmp_path):
+        self.build(tmp_path, "whole")
+        self.build(tmp_path, "chunked", chunk_postings=5)
+        
+        for name in ("postings", "posting_in_title", "posting_offsets", "terms"):
+            assert np.array_equal(np.load(tmp_path / "whole" / f"{name}.npy"), np.load(tmp_path / "chunked" / f"{name}.npy"))
+        assert sorted(os.listdir(tmp_path / "chunked")) == sorted(os.listdir(tmp_path / "whole"))
+    
+    def test_title_lookup_ignores_case_and_underscores(self, tmp_path):
+        index = self.build(tmp_path)
+        
+        assert index.get("jensen_huang")["abstract"].startswith("Jensen Huang is the co-founder")
+        assert index.get("Python (GENUS)")["title"] == "Python (genus)"
+        assert index.get("Nvidia Corporation") is None
+    
+    def test_search_ranks_title_matches_first(self, tmp_path):
+        index = self.build(tmp_path)
+        
+        assert [article["title"] for article in index.search("nvidia", limit=2)] == ["Nvidia", "Jensen Huang"]
+        assert index.search("quantum chromodynamics") == []
+        assert [article["title"] for article in index.search("python")] == ["Python (programming language)", "Python (genus)"]
+        assert [article["title"] for article in index.search("python", limit=1)] == ["Python (programming language)"]
+    
+    def test_lookup_returns_tool_results_and_misses(self, tmp_path):
+        index = self.build(tmp_path)
+        
+        result = index.lookup("NVIDIA")
+        assert result == {
+            "title": "Nvidia",
+            "url": "https://en.wikipedia.org/wiki/Nvidia",
+            "summary": self.ARTICLES[0][1],
+            "status": "success"
+        }
+        assert index.lookup("python programming language")["title"] == "Python (programming language)"
+        assert index.lookup("snakes") is None
+    
+    def test_builds_from_the_xml_abstracts_dump(self, tmp_path):
+        dump = tmp_path / "enwiki-latest-abstract.xml.gz"
+        with gzip.open(dump, "wt", encoding="utf-8") as f:
+            f.write(
+                "<feed><doc><title>Wikipedia: Nvidia</title><url>https://en.wikipedia.org/wiki/Nvidia</url>"
+                "<abstract>Nvidia designs GPUs.</abstract><links/></doc>"
+                "<doc><title>Wikipedia: Empty</title><url>https://en.wikipedia.org/wiki/Empty</url><abstract></abstract></doc></feed>"
+            )
+        
+        assert build_wikipedia_index(str(dump), str(tmp_path / "index")) == 1
+        assert WikipediaIndex(str(tmp_path / "index")).get("nvidia")["abstract"] == "Nvidia designs GPUs."
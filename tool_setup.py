@@ -1,11 +1,79 @@
 from duckduckgo_search import DDGS
-from langchain_core.tools import tool
+from duckduckgo_search.exceptions import RatelimitException
+from langchain_core.tools import StructuredTool, tool
+from utils.client_pool import ClientPool
+from utils.context_packer import Chunk, ChunkIndex, split_spans
+from utils.knowledge_prompt import TOC_ESCAPED_PIPE, source_names
+from utils.metrics import metrics
+from utils.rate_limiter import RateLimitExceeded, TokenBucketLimiter, create_bucket_store
+from utils.token_manager import TokenManager
+from utils.tool_resilience import DEFAULT_TIMEOUT, tool_resilience
+from utils.wikipedia_index import create_wikipedia_index
+import json
+import logging
+import os
 import wikipedia
 
-@tool
-def search_wikipedia(topic: str) -> dict:
+logger = logging.getLogger(__name__)
+
+# Tokens of agent knowledge returned by one lookup_agent_file call
+LOOKUP_MAX_TOKENS = 1500
+LOOKUP_PASSAGE_TOKENS = 300
+
+# Tokens a tool result may add to the conversation; tools not listed are passed through
+TOOL_RESULT_BUDGETS = {
+    "search_wikipedia": int(os.getenv("WIKIPEDIA_RESULT_TOKENS", "600")),
+    "search_web_with_duckduckgo": int(os.getenv("WEB_RESULT_TOKENS", "700")),
+    "search_duckduckgo_news": int(os.getenv("NEWS_RESULT_TOKENS", "700")),
+}
+# Result fields the model never uses
+DROPPED_RESULT_FIELDS = {"image"}
+PLACEHOLDER_VALUES = {"", "No body text", "No URL", "No date", "Unknown source", "No title"}
+TEXT_FIELDS = ("body", "summary", "text")
+
+# Offline Wikipedia index, opened on first lookup; misses go to the Wikipedia API unless WIKIPEDIA_LIVE_FALLBACK=false
+wikipedia_index = create_wikipedia_index()
+WIKIPEDIA_LIVE_FALLBACK = os.getenv("WIKIPEDIA_LIVE_FALLBACK", "true").lower() == "true"
+
+# One DuckDuckGo session pool and rate limit per process; RATE_LIMIT_BACKEND=mongo shares the limit across workers.
+# Requests wait for a slot at most half the tool deadline, leaving the other half for the search itself.
+ddgs_pool = ClientPool(lambda: DDGS(timeout=int(os.getenv("DDG_TIMEOUT_SECONDS", "10"))), size=4, name="duckduckgo")
+ddgs_limiter = TokenBucketLimiter(
+    "duckduckgo",
+    rate=float(os.getenv("DDG_REQUESTS_PER_SECOND", "1")),
+    burst=int(os.getenv("DDG_BURST", "3")),
+    store=create_bucket_store(),
+    max_wait=min(float(os.getenv("DDG_MAX_WAIT_SECONDS", "8")), DEFAULT_TIMEOUT / 2)
+)
+
+def rate_limited(query: str, error: RateLimitExceeded) -> dict:
     """
-    Get information about a topic from Wikipedia.
+    Result of a search our own rate limiter turned away before it reached DuckDuckGo
+    """
+    return {
+        "status": "rate_limited",
+        "query": query,
+        "retry_after_seconds": round(error.retry_after, 1),
+        "message": "Too many DuckDuckGo searches are queued. Use another tool, or search again later."
+    }
+
+def duckduckgo(method: str, **kwargs) -> list:
+    """
+    Call a DDGS search method through the shared session pool and rate limiter
+    """
+    ddgs_limiter.acquire()
+    try:
+        with ddgs_pool.client() as ddgs:
+            results = getattr(ddgs, method)(**kwargs)
+    except RatelimitException:
+        ddgs_limiter.throttled()
+        raise
+    ddgs_limiter.succeeded()
+    return results
+
+def search_wikipedia_live(topic: str) -> dict:
+    """
+    Look a topic up with the Wikipedia API.
     """
     try:
         page = wikipedia.page(topic)
@@ -50,6 +118,26 @@ def search_wikipedia(topic: str) -> dict:
             "query": topic,
             "message": f"Error retrieving information: {str(e)}"
         }
+
+@tool
+def search_wikipedia(topic: str) -> dict:
+    """
+    Get information about a topic from Wikipedia.
+    """
+    if wikipedia_index is not None:
+        try:
+            result = wikipedia_index.lookup(topic)
+            if result is not None:
+                return result
+        except Exception as e:
+            logger.warning(f"Offline Wikipedia lookup failed, using the Wikipedia API: {str(e)}")
+        if not WIKIPEDIA_LIVE_FALLBACK:
+            return {
+                "status": "page_error",
+                "query": topic,
+                "message": f"No Wikipedia article found for '{topic}'. Try another search term."
+            }
+    return search_wikipedia_live(topic)
         
 @tool
 def search_web_with_duckduckgo(query: str, max_results: int = 5) -> dict:
@@ -57,8 +145,8 @@ def search_web_with_duckduckgo(query: str, max_results: int = 5) -> dict:
     Perform a general web search using DuckDuckGo.
     """
     try:
-        ddgs = DDGS()
-        results = ddgs.text(
+        results = duckduckgo(
+            "text",
             keywords=query,
             region="wt-wt",
             safesearch="moderate",
@@ -79,6 +167,8 @@ def search_web_with_duckduckgo(query: str, max_results: int = 5) -> dict:
             "results": formatted_results
         }
     
+    except RateLimitExceeded as e:
+        return rate_limited(query, e)
     except Exception as e:
         return {
             "status": "error",
@@ -92,8 +182,8 @@ def search_duckduckgo_news(query: str, max_results: int = 5, time_period: str =
     Search for news articles using DuckDuckGo News.
     """
     try:
-        ddgs = DDGS()
-        results = ddgs.news(
+        results = duckduckgo(
+            "news",
             keywords=query,
             region="wt-wt",
             safesearch="moderate",
@@ -119,6 +209,8 @@ def search_duckduckgo_news(query: str, max_results: int = 5, time_period: str =
             "results": formatted_results
         }
     
+    except RateLimitExceeded as e:
+        return rate_limited(query, e)
     except Exception as e:
         return {
             "status": "error",
@@ -126,10 +218,299 @@ def search_duckduckgo_news(query: str, max_results: int = 5, time_period: str =
             "message": f"Error performing news search: {str(e)}"
         }
 
+def make_search_agent_knowledge(agent, vector_index):
+    """
+    Build the knowledge search tool bound to one agent and its vector index.
+    """
+    items = {item.id: (item, "file") for item in agent.files}
+    items.update({item.id: (item, "website") for item in agent.websites})
+    
+    @tool
+    def search_agent_knowledge(query: str, max_results: int = 5) -> dict:
+        """
+        Semantic search over this agent's own files and websites. Returns the passages
+        most similar to the query. Cite them as [Agent KB: source].
+        """
+        try:
+            hits = vector_index.search(str(agent.id), query, max_results)
+            
+            formatted_results = []
+            for hit in hits:
+                if hit.item_id not in items:
+                    continue
+                item, item_type = items[hit.item_id]
+                formatted_results.append({
+                    "source": item.name,
+                    "type": item_type,
+                    "score": round(hit.score, 3),
+                    "text": item.text[hit.start:hit.end]
+                })
+            
+            return {
+                "status": "success",
+                "query": query,
+                "results": formatted_results
+            }
+        
+        except Exception as e:
+            return {
+                "status": "error",
+                "query": query,
+                "message": f"Error searching the knowledge base: {str(e)}"
+            }
+    
+    return search_agent_knowledge
+
+def make_lookup_agent_file(agent, token_manager=None):
+    """
+    Build the tool that reads one agent's files and websites on demand.
+    """
+    token_manager = token_manager or TokenManager()
+    # Keyed by the names of the table of contents, where repeated names are numbered
+    items = {name: (item, item_type) for name, item_type, item in source_names(agent.files, agent.websites)}
+    texts = {}
+    
+    def find(name):
+        name = name.replace(TOC_ESCAPED_PIPE, "|")
+        if name in items:
+            return name
+        matches = [item_name for item_name in items if item_name.casefold() == name.casefold()]
+        matches = matches or [item_name for item_name in items if name.casefold() in item_name.casefold()]
+        return matches[0] if len(matches) == 1 else None
+    
+    def read(name):
+        if name not in texts:
+            texts[name] = items[name][0].read_text(cache=False)
+        return texts[name]
+    
+    @tool
+    def lookup_agent_file(name: str, query: str = "", part: int = 1) -> dict:
+        """
+        Read one of this agent's own files or websites listed in the knowledge base.
+        Pass its file name or URL, and a query to get its most relevant passages, or a
+        part number to read it in order. Cite it as [Agent KB: name].
+        """
+        try:
+            source = find(name)
+            if source is None:
+                return {
+                    "status": "not_found",
+                    "name": name,
+                    "message": f"No agent file or website named '{name}'. Available sources: {', '.join(items)}"
+                }
+            item, item_type = items[source]
+            text = read(source)
+            
+            if query:
+                spans = split_spans(text, LOOKUP_PASSAGE_TOKENS * 4)
+                passages = [text[start:end] for start, end in spans]
+                counts = token_manager.count_tokens_batch(passages)
+                index = ChunkIndex([Chunk(item_type, source, i, passage, tokens) for i, (passage, tokens) in enumerate(zip(passages, counts))])
+                scores = index.score(query)
+                
+                chosen = []
+                remaining = LOOKUP_MAX_TOKENS
+                for i in sorted(range(len(passages)), key=lambda i: (-scores[i], i)):
+                    if scores[i] <= 0:
+                        break
+                    if counts[i] <= remaining:
+                        chosen.append(i)
+                        remaining -= counts[i]
+                
+                return {
+                    "status": "success",
+                    "source": source,
+                    "type": item_type,
+                    "query": query,
+                    "results": [{"passage": i + 1, "text": passages[i]} for i in sorted(chosen)]
+                }
+            
+            parts = split_spans(text, LOOKUP_MAX_TOKENS * 4)
+            if not 1 <= part <= len(parts):
+                return {
+                    "status": "error",
+                    "source": source,
+                    "message": f"'{source}' has {len(parts)} parts. Ask for a part between 1 and {len(parts)}."
+                }
+            start, end = parts[part - 1]
+            return {
+                "status": "success",
+                "source": source,
+                "type": item_type,
+                "part": part,
+                "parts": len(parts),
+                "text": text[start:end]
+            }
+        
+        except Exception as e:
+            return {
+                "status": "error",
+                "name": name,
+                "message": f"Error reading the knowledge base: {str(e)}"
+            }
+    
+    return lookup_agent_file
+
+def normalize_url(url: str) -> str:
+    """
+    URL without scheme, "www.", fragment or trailing slash, used to spot duplicate results
+    """
+    url = url.split("#", 1)[0].strip().lower()
+    url = url.split("://", 1)[-1]
+    if url.startswith("www."):
+        url = url[4:]
+    return url.rstrip("/")
+
+class ResultShaper:
+    """
+    Trims tool results before they reach the model, since every result is sent
+    again with each later turn of the research run.
+    
+    Unused fields and placeholders are dropped and results that point to the same
+    URL are merged. If the result is still over its tool's token budget, the text
+    fields are shortened, longest first, so that short snippets stay whole and the
+    budget is shared by the long ones. Texts are cut at a sentence end where possible.
+    """
+    
+    def __init__(self, token_manager=None, budgets=None):
+        """
+        Initialize the ResultShaper.
+        
+        Args:
+            token_manager (Optional[TokenManager]): Measures results.
+                If None, a new instance will be created.
+            budgets (Optional[dict]): Token budget per tool name. Defaults to TOOL_RESULT_BUDGETS.
+        """
+        self.token_manager = token_manager or TokenManager()
+        self.budgets = budgets if budgets is not None else TOOL_RESULT_BUDGETS
+    
+    def tokens(self, result) -> int:
+        return self.token_manager.count_tokens(json.dumps(result, ensure_ascii=False))
+    
+    def _clean(self, item: dict) -> dict:
+        return {
+            key: value for key, value in item.items()
+            if key not in DROPPED_RESULT_FIELDS and not (value is None or isinstance(value, str) and value in PLACEHOLDER_VALUES)
+        }
+    
+    def _deduplicate(self, items: list) -> list:
+        seen = set()
+        unique = []
+        for item in items:
+            url = item.get("href") or item.get("url")
+            if url:
+                key = normalize_url(url)
+                if key in seen:
+                    continue
+                seen.add(key)
+            unique.append(item)
+        return unique
+    
+    def truncate(self, text: str, max_tokens: int) -> str:
+        """
+        Shorten a text to at most `max_tokens` tokens, ending at a sentence if one ends
+        in the second half of the kept text.
+        """
+        encoded = self.token_manager.encoding.encode_ordinary(text)
+        if len(encoded) <= max_tokens:
+            return text
+        kept = self.token_manager.encoding.decode(encoded[:max(0, max_tokens - 1)])
+        cut = max(kept.rfind(". "), kept.rfind("! "), kept.rfind("? "))
+        if cut >= len(kept) // 2:
+            kept = kept[:cut + 1]
+        return kept.rstrip() + "…"
+    
+    def _fit_texts(self, result: dict, fields: list, budget: int):
+        """
+        Water-fill the text fields: short texts keep their length, long ones share what is left.
+        """
+        overhead = self.tokens(result) - sum(self.token_manager.count_tokens_batch(container[key] for container, key in fields))
+        available = max(0, budget - overhead)
+        lengths = self.token_manager.count_tokens_batch(container[key] for container, key in fields)
+        
+        remaining = sorted(range(len(fields)), key=lambda i: lengths[i])
+        while remaining:
+            share = available // len(remaining)
+            i = remaining.pop(0)
+            container, key = fields[i]
+            if lengths[i] > share:
+                container[key] = self.truncate(container[key], share)
+                lengths[i] = self.token_manager.count_tokens(container[key])
+            available -= lengths[i]
+    
+    def shape(self, tool_name: str, result):
+        """
+        Shape one tool result.
+        
+        Args:
+            tool_name (str): Name of the tool that produced the result.
+            result: The tool result.
+        
+        Returns:
+            The result, trimmed to the tool's budget.
+        """
+        budget = self.budgets.get(tool_name)
+        if budget is None or not isinstance(result, dict):
+            return result
+        
+        before = self.tokens(result)
+        shaped = self._clean(result)
+        for list_field in ("results", "options"):
+            if isinstance(shaped.get(list_field), list):
+                shaped[list_field] = self._deduplicate([self._clean(item) if isinstance(item, dict) else item for item in shaped[list_field]])
+        
+        if self.tokens(shaped) > budget:
+            fields = [(shaped, key) for key in TEXT_FIELDS if isinstance(shaped.get(key), str)]
+            for list_field in ("results", "options"):
+                for item in shaped.get(list_field) or []:
+                    if isinstance(item, dict):
+                        fields.extend((item, key) for key in TEXT_FIELDS if isinstance(item.get(key), str))
+            if fields:
+                self._fit_texts(shaped, fields, budget)
+        
+        metrics.increment("tool_results.tokens_before", before)
+        metrics.increment("tool_results.tokens_after", self.tokens(shaped))
+        return shaped
+    
+    def wrap(self, tool):
+        """
+        Copy of a tool whose results are shaped
+        """
+        def run(**kwargs):
+            return self.shape(tool.name, tool.invoke(kwargs))
+        
+        return StructuredTool.from_function(
+            func=run,
+            name=tool.name,
+            description=tool.description,
+            args_schema=tool.args_schema
+        )
+    
+    def wrap_tools(self, tools):
+        return [self.wrap(tool) for tool in tools]
+
 tools = [search_wikipedia, search_web_with_duckduckgo, search_duckduckgo_news]
 class ToolSetup:
-    def __init__(self):
+    def __init__(self, agent=None, vector_index=None, lookup=False, resilience=None, result_shaper=None):
+        self.resilience = resilience if resilience else tool_resilience
+        self.result_shaper = result_shaper if result_shaper else ResultShaper()
         self.tools = tools
+        if agent is not None and vector_index is not None and vector_index.enabled:
+            self.tools = self.tools + [make_search_agent_knowledge(agent, vector_index)]
+        if agent is not None and lookup:
+            self.tools = self.tools + [make_lookup_agent_file(agent)]
     
     def get_tools(self):
-        return self.tools
\ No newline at end of file
+        return self.tools
+    
+    def get_resilient_tools(self):
+        """
+        Tools wrapped with deadlines, hedged requests and circuit breakers
+        """
+        return self.resilience.wrap_tools(self.tools)
+    
+    def get_graph_tools(self):
+        """
+        Resilient tools whose results are trimmed to their token budgets
+        """
+        return self.result_shaper.wrap_tools(self.get_resilient_tools())
\ No newline at end of file
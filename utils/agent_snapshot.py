@@ -0,0 +1,196 @@
+from bson import ObjectId, json_util
+from db.agents import insert_agent_documents, iter_agent_documents
+from fastapi.concurrency import run_in_threadpool
+from itertools import islice
+from typing import Any, AsyncIterator, BinaryIO, Dict, Iterator, List
+import msgpack
+
+SNAPSHOT_FORMAT = "agents-snapshot"
+SNAPSHOT_VERSION = 1
+
+MSGPACK = "msgpack"
+NDJSON = "ndjson"
+MEDIA_TYPES = {
+    MSGPACK: "application/x-msgpack",
+    NDJSON: "application/x-ndjson",
+}
+
+_OBJECT_ID_EXT = 1
+_READ_SIZE = 64 * 1024
+
+class SnapshotFormatError(ValueError):
+    """Raised when a snapshot is not in the expected format."""
+
+def _msgpack_default(value: Any):
+    if isinstance(value, ObjectId):
+        return msgpack.ExtType(_OBJECT_ID_EXT, value.binary)
+    raise TypeError(f"Cannot serialize {type(value).__name__} in a snapshot")
+
+def _msgpack_ext_hook(code: int, data: bytes):
+    if code == _OBJECT_ID_EXT:
+        return ObjectId(data)
+    return msgpack.ExtType(code, data)
+
+class SnapshotWriter:
+    """
+    Encodes agents as a stream of records: a header followed by one record per agent.
+    
+    Records are the raw MongoDB documents, so knowledge base text stays in its stored
+    (compressed) form and nothing is validated, decompressed or re-extracted.
+    msgpack keeps binary fields as bytes; NDJSON uses MongoDB extended JSON, one
+    document per line.
+    """
+    
+    def __init__(self, fmt: str = MSGPACK):
+        """
+        Initialize the SnapshotWriter.
+        
+        Args:
+            fmt (str): "msgpack" or "ndjson".
+        """
+        if fmt not in MEDIA_TYPES:
+            raise SnapshotFormatError(f"Unsupported snapshot format: {fmt}. Supported formats are: {', '.join(MEDIA_TYPES)}")
+        self.fmt = fmt
+        self.media_type = MEDIA_TYPES[fmt]
+        self._packer = msgpack.Packer(default=_msgpack_default, use_bin_type=True) if fmt == MSGPACK else None
+    
+    def encode(self, record: Dict[str, Any]) -> bytes:
+        """
+        Encode one record.
+        
+        Args:
+            record (Dict[str, Any]): Raw document or header.
+        
+        Returns:
+            bytes: The encoded record.
+        """
+        if self._packer:
+            return self._packer.pack(record)
+        return (json_util.dumps(record) + "\n").encode("utf-8")
+    
+    def header(self) -> bytes:
+        """
+        Encode the header record that starts every snapshot.
+        """
+        return self.encode({"format": SNAPSHOT_FORMAT, "version": SNAPSHOT_VERSION})
+
+def _decode_records(stream: BinaryIO, fmt: str) -> Iterator[Any]:
+    """
+    Decode the records of a snapshot, raising SnapshotFormatError for corrupt or truncated data.
+    """
+    try:
+        if fmt == MSGPACK:
+            unpacker = msgpack.Unpacker(ext_hook=_msgpack_ext_hook, raw=False, max_buffer_size=0)
+            while chunk := stream.read(_READ_SIZE):
+                unpacker.feed(chunk)
+                yield from unpacker
+            # The unpacker keeps a partial record without complaint; a nil fed after the
+            # last record only decodes on its own if no record was left unfinished
+            unpacker.feed(msgpack.packb(None))
+            if list(unpacker) != [None]:
+                raise SnapshotFormatError("Snapshot is truncated")
+        else:
+            for line in stream:
+                if line.strip():
+                    yield json_util.loads(line)
+    except SnapshotFormatError:
+        raise
+    except Exception as e:
+        raise SnapshotFormatError(f"Snapshot is not valid {fmt}: {str(e)}")
+
+def iter_records(stream: BinaryIO, fmt: str = MSGPACK) -> Iterator[Dict[str, Any]]:
+    """
+    Read the agent documents of a snapshot, checking its header first.
+    
+    Args:
+        stream (BinaryIO): Snapshot opened in binary mode.
+        fmt (str): "msgpack" or "ndjson".
+    
+    Returns:
+        Iterator[Dict[str, Any]]: Raw agent documents, read one at a time.
+    
+    Raises:
+        SnapshotFormatError: If the snapshot header is missing or unsupported, or a record is corrupt or truncated.
+    """
+    if fmt not in MEDIA_TYPES:
+        raise SnapshotFormatError(f"Unsupported snapshot format: {fmt}. Supported formats are: {', '.join(MEDIA_TYPES)}")
+    records = _decode_records(stream, fmt)
+    
+    try:
+        header = next(records)
+    except StopIteration:
+        raise SnapshotFormatError("Snapshot is empty")
+    if not isinstance(header, dict) or header.get("format") != SNAPSHOT_FORMAT:
+        raise SnapshotFormatError("Snapshot header is missing")
+    if header.get("version") != SNAPSHOT_VERSION:
+        raise SnapshotFormatError(f"Unsupported snapshot version: {header.get('version')}")
+    
+    for record in records:
+        if not isinstance(record, dict) or not isinstance(record.get("name"), str):
+            raise SnapshotFormatError("Snapshot contains a record that is not an agent")
+        yield record
+
+def prepare_for_import(document: Dict[str, Any], keep_ids: bool = False) -> Dict[str, Any]:
+    """
+    Make a snapshot document ready to insert: assign a new agent ID unless IDs are
+    kept, give items without an ID their stable ID and fill in a missing token total.
+    
+    Args:
+        document (Dict[str, Any]): Raw agent document from a snapshot.
+        keep_ids (bool): Keep the agent ID from the snapshot.
+    
+    Returns:
+        Dict[str, Any]: The document, updated in place.
+    """
+    if not keep_ids or "_id" not in document:
+        document["_id"] = ObjectId()
+    
+    total_tokens = 0
+    for field in ("files", "websites"):
+        items: List[Dict[str, Any]] = document.get(field) or []
+        for item in items:
+            if not item.get("id"):
+                item["id"] = str(ObjectId())
+            total_tokens += item.get("tokens") or 0
+    if not isinstance(document.get("total_tokens"), int):
+        document["total_tokens"] = total_tokens
+    return document
+
+async def export_agents(fmt: str = MSGPACK) -> AsyncIterator[bytes]:
+    """
+    Stream a snapshot of every agent, one encoded record at a time.
+    
+    Args:
+        fmt (str): "msgpack" or "ndjson".
+    
+    Returns:
+        AsyncIterator[bytes]: The header followed by one chunk per agent.
+    """
+    writer = SnapshotWriter(fmt)
+    yield writer.header()
+    async for document in iter_agent_documents():
+        yield writer.encode(document)
+
+async def import_agents(stream: BinaryIO, fmt: str = MSGPACK, keep_ids: bool = False, batch_size: int = 500) -> int:
+    """
+    Restore agents from a snapshot with bulk inserts. Stored knowledge base text is
+    inserted as is, so nothing is extracted or tokenized again.
+    
+    Args:
+        stream (BinaryIO): Snapshot opened in binary mode.
+        fmt (str): "msgpack" or "ndjson".
+        keep_ids (bool): Keep agent IDs from the snapshot instead of assigning new ones.
+        batch_size (int): Agents per insert_many call.
+    
+    Returns:
+        int: Number of agents imported.
+    """
+    records = iter_records(stream, fmt)
+    
+    def next_batch():
+        return [prepare_for_import(record, keep_ids) for record in islice(records, batch_size)]
+    
+    imported = 0
+    while batch := await run_in_threadpool(next_batch):
+        imported += await insert_agent_documents(batch)
+    return imported
@@ -0,0 +1,52 @@
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator
+from .metrics import metrics
+import queue
+
+class ClientPool:
+    """
+    Reuses clients across calls instead of opening a new session for each one.
+    
+    Clients are created on demand by `factory`, so the pool never blocks: a call
+    that finds no idle client gets a new one, and at most `size` idle clients are
+    kept. A client whose call raised is dropped, since its session may be broken.
+    """
+    
+    def __init__(self, factory: Callable[[], Any], size: int = 4, name: str = "client"):
+        """
+        Initialize the ClientPool.
+        
+        Args:
+            factory (Callable[[], Any]): Creates a client.
+            size (int): Idle clients kept for reuse.
+            name (str): Name used for the pool's metrics.
+        """
+        self.factory = factory
+        self.name = name
+        self._idle: "queue.LifoQueue[Any]" = queue.LifoQueue(maxsize=max(1, size))
+    
+    @contextmanager
+    def client(self) -> Iterator[Any]:
+        try:
+            client = self._idle.get_nowait()
+            metrics.increment(f"client_pool.{self.name}.reused")
+        except queue.Empty:
+            client = self.factory()
+            metrics.increment(f"client_pool.{self.name}.created")
+        
+        yield client
+        
+        try:
+            self._idle.put_nowait(client)
+        except queue.Full:
+            pass
+    
+    def clear(self):
+        """
+        Drop every idle client.
+        """
+        while True:
+            try:
+                self._idle.get_nowait()
+            except queue.Empty:
+                return
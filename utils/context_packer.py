@@ -0,0 +1,269 @@
+from collections import Counter, OrderedDict
+from models.agents import File, KnowledgePrompt
+from typing import List, NamedTuple, Optional, Sequence, Tuple
+from .dedup import tokenize_terms
+from .knowledge_prompt import FILES_HEADER, KNOWLEDGE_BASE_HEADER, WEBSITES_HEADER, deduplicated_texts
+from .token_manager import TokenManager
+import math
+import os
+import threading
+
+PACKED_CONTEXT_NOTE = "\nThe knowledge base is larger than this prompt allows, so only the passages most relevant to the query are included below. Passages from the same source are separated by [...].\n"
+
+def split_spans(text: str, max_chars: int) -> List[Tuple[int, int]]:
+    """
+    Split a text into (start, end) spans of at most `max_chars` characters, cutting
+    at line boundaries where possible and at spaces inside overlong lines.
+    Whitespace-only spans are skipped.
+    """
+    spans = []
+    start = 0
+    end = 0
+    for line in text.splitlines(keepends=True):
+        line_start = end
+        line_end = end + len(line)
+        while line_end - line_start > max_chars:
+            cut = text.rfind(" ", line_start, line_start + max_chars)
+            cut = cut if cut > line_start else line_start + max_chars
+            if end > start:
+                spans.append((start, line_start))
+            spans.append((line_start, cut))
+            line_start = start = cut
+        if line_start - start > 0 and line_end - start > max_chars:
+            spans.append((start, line_start))
+            start = line_start
+        end = line_end
+    if end > start:
+        spans.append((start, end))
+    return [(start, end) for start, end in spans if text[start:end].strip()]
+
+class Chunk(NamedTuple):
+    """
+    Attributes
+        section (str): "files" or "websites"
+        source (str): File name or URL, used as the citation label
+        position (int): Position of the chunk in the knowledge base
+        text (str): Chunk text
+        tokens (int): Tokens utilized by the text
+    """
+    section: str
+    source: str
+    position: int
+    text: str
+    tokens: int
+
+class ChunkIndex:
+    """
+    BM25 index over the chunks of one version of an agent's knowledge base.
+    """
+    
+    def __init__(self, chunks: List[Chunk], k1: float = 1.5, b: float = 0.75):
+        self.chunks = chunks
+        self.k1 = k1
+        self.b = b
+        self.term_counts = [Counter(tokenize_terms(chunk.text)) for chunk in chunks]
+        self.lengths = [sum(counts.values()) for counts in self.term_counts]
+        self.average_length = sum(self.lengths) / len(self.lengths) if self.lengths else 0.0
+        
+        document_frequency: Counter = Counter()
+        for counts in self.term_counts:
+            document_frequency.update(counts.keys())
+        total = len(chunks)
+        self.idf = {
+            term: math.log(1 + (total - frequency + 0.5) / (frequency + 0.5))
+            for term, frequency in document_frequency.items()
+        }
+    
+    def score(self, query: str) -> List[float]:
+        """
+        BM25 score of every chunk against a query, in chunk order.
+        """
+        terms = [term for term in set(tokenize_terms(query)) if term in self.idf]
+        scores = []
+        for counts, length in zip(self.term_counts, self.lengths):
+            score = 0.0
+            norm = self.k1 * (1 - self.b + self.b * length / self.average_length) if self.average_length else self.k1
+            for term in terms:
+                frequency = counts.get(term)
+                if frequency:
+                    score += self.idf[term] * frequency * (self.k1 + 1) / (frequency + norm)
+            scores.append(score)
+        return scores
+
+class ContextPacker:
+    """
+    Fits an agent's knowledge base into a per-query token budget.
+    
+    Knowledge bases whose precomputed prompt is within `full_context_max_tokens` are
+    used whole. Larger ones are split into chunks that are scored against the query
+    with BM25 and added greedily, best first, until the budget measured by
+    TokenManager is spent. When no chunk matches the query, the leading chunks are
+    used instead. Chosen chunks are written back in knowledge base order
+    under their "### name" headings so [Agent KB: ...] citations keep working.
+    
+    Chunk indexes are cached per knowledge prompt version, so an unchanged knowledge
+    base is chunked, counted and indexed once.
+    """
+    
+    def __init__(
+        self,
+        token_manager: Optional[TokenManager] = None,
+        budget_tokens: Optional[int] = None,
+        full_context_max_tokens: Optional[int] = None,
+        chunk_tokens: int = 400,
+        cache_size: int = 32
+    ):
+        """
+        Initialize the ContextPacker.
+        
+        Args:
+            token_manager (Optional[TokenManager]): A TokenManager instance.
+                If None, a new instance will be created.
+            budget_tokens (Optional[int]): Tokens of knowledge base context per query.
+                Defaults to KB_CONTEXT_BUDGET_TOKENS or 12000.
+            full_context_max_tokens (Optional[int]): Knowledge bases up to this size are
+                used whole. Defaults to KB_FULL_CONTEXT_MAX_TOKENS or twice the budget.
+            chunk_tokens (int): Approximate size of a chunk.
+            cache_size (int): Chunk indexes kept in memory.
+        """
+        self.token_manager = token_manager or TokenManager()
+        self.budget_tokens = budget_tokens or int(os.getenv("KB_CONTEXT_BUDGET_TOKENS", "12000"))
+        self.full_context_max_tokens = full_context_max_tokens or int(os.getenv("KB_FULL_CONTEXT_MAX_TOKENS", str(2 * self.budget_tokens)))
+        self.chunk_tokens = chunk_tokens
+        self.cache_size = cache_size
+        
+        self._indexes: "OrderedDict[str, ChunkIndex]" = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def _split_text(self, text: str) -> List[str]:
+        return [text[start:end] for start, end in split_spans(text, self.chunk_tokens * 4)]
+    
+    def build_index(self, files: Sequence[File], websites: Sequence[File] = (), full_text: bool = False) -> ChunkIndex:
+        """
+        Chunk a knowledge base and index it for scoring. Near-duplicate passages are
+        left out the same way as in the full knowledge prompt.
+        
+        Args:
+            files (Sequence[File]): Agent files.
+            websites (Sequence[File]): Agent websites.
+            full_text (bool): Chunk the full text of summarized items instead of their summary.
+        
+        Returns:
+            ChunkIndex: Chunks in knowledge base order with their BM25 statistics.
+        """
+        labelled: List[Tuple[str, str, str]] = []
+        for section, item, text in deduplicated_texts(files, websites, cache=False, full_text=full_text)[0]:
+            labelled.extend((section, item.name, piece) for piece in self._split_text(text))
+        
+        counts = self.token_manager.count_tokens_batch(piece for _, _, piece in labelled)
+        chunks = [
+            Chunk(section, source, position, piece, tokens)
+            for position, ((section, source, piece), tokens) in enumerate(zip(labelled, counts))
+        ]
+        return ChunkIndex(chunks)
+    
+    def get_index(self, knowledge_prompt: KnowledgePrompt, files: Sequence[File], websites: Sequence[File] = (), full_text: bool = False) -> ChunkIndex:
+        """
+        Get the cached chunk index of a knowledge base version, building it on first use.
+        """
+        with self._lock:
+            index = self._indexes.get(knowledge_prompt.version)
+            if index is not None:
+                self._indexes.move_to_end(knowledge_prompt.version)
+                return index
+        
+        index = self.build_index(files, websites, full_text)
+        with self._lock:
+            self._indexes[knowledge_prompt.version] = index
+            while len(self._indexes) > self.cache_size:
+                self._indexes.popitem(last=False)
+        return index
+    
+    def select(self, index: ChunkIndex, query: str, budget_tokens: int) -> List[Chunk]:
+        """
+        Greedily pick the best scoring chunks that fit the budget, or the leading
+        chunks when none of them matches the query.
+        
+        Args:
+            index (ChunkIndex): Index of the knowledge base.
+            query (str): User query.
+            budget_tokens (int): Tokens available for chunks and their headings.
+        
+        Returns:
+            List[Chunk]: Chosen chunks, in knowledge base order.
+        """
+        scores = index.score(query)
+        if not any(score > 0 for score in scores):
+            # Nothing matches, e.g. a query in other words than the knowledge base: keep its beginning
+            scores = [1.0] * len(scores)
+        ranked = sorted(range(len(index.chunks)), key=lambda i: (-scores[i], i))
+        
+        seen_sources = set()
+        chosen = []
+        remaining = budget_tokens
+        for i in ranked:
+            if scores[i] <= 0:
+                break
+            chunk = index.chunks[i]
+            cost = chunk.tokens
+            if chunk.source not in seen_sources:
+                cost += self.token_manager.count_tokens(f"### {chunk.source}\n")
+            if cost > remaining:
+                continue
+            seen_sources.add(chunk.source)
+            chosen.append(chunk)
+            remaining -= cost
+        return sorted(chosen, key=lambda chunk: chunk.position)
+    
+    def render(self, chunks: List[Chunk]) -> str:
+        """
+        Write chosen chunks under the same headings as the full knowledge prompt.
+        """
+        parts = [KNOWLEDGE_BASE_HEADER, PACKED_CONTEXT_NOTE]
+        section = None
+        source = None
+        previous_position = None
+        for chunk in chunks:
+            if chunk.section != section:
+                section = chunk.section
+                parts.append(FILES_HEADER if section == "files" else WEBSITES_HEADER)
+                source = None
+            if chunk.source != source:
+                if source is not None:
+                    parts.append("\n\n")
+                source = chunk.source
+                parts.append(f"### {source}\n")
+            elif chunk.position != previous_position + 1:
+                parts.append("\n[...]\n")
+            parts.append(chunk.text)
+            previous_position = chunk.position
+        parts.append("\n\n")
+        return "".join(parts)
+    
+    def pack(
+        self,
+        query: str,
+        knowledge_prompt: KnowledgePrompt,
+        files: Sequence[File],
+        websites: Sequence[File] = (),
+        full_text: bool = False
+    ) -> str:
+        """
+        Knowledge base context for one query.
+        
+        Args:
+            query (str): User query.
+            knowledge_prompt (KnowledgePrompt): Precomputed prompt of the full knowledge base.
+            files (Sequence[File]): Agent files.
+            websites (Sequence[File]): Agent websites.
+            full_text (bool): The knowledge prompt was built from the full text of summarized items.
+        
+        Returns:
+            str: The full knowledge prompt if it fits, otherwise the packed context.
+        """
+        if knowledge_prompt.tokens <= self.full_context_max_tokens:
+            return knowledge_prompt.text
+        
+        index = self.get_index(knowledge_prompt, files, websites, full_text)
+        overhead = self.token_manager.count_tokens(KNOWLEDGE_BASE_HEADER + PACKED_CONTEXT_NOTE + FILES_HEADER + WEBSITES_HEADER)
+        return self.render(self.select(index, query, self.budget_tokens - overhead))
@@ -0,0 +1,159 @@
+from collections import defaultdict
+from typing import Dict, List, Optional, Sequence, Tuple
+import numpy as np
+import re
+import zlib
+
+_TERM_PATTERN = re.compile(r"\w+", re.UNICODE)
+_MERSENNE_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+
+def tokenize_terms(text: str) -> List[str]:
+    """
+    Lowercased word terms used for lexical scoring and shingling
+    """
+    return _TERM_PATTERN.findall(text.lower())
+
+class MinHasher:
+    """
+    MinHash signatures over word shingles, used to estimate the Jaccard similarity
+    of two passages without comparing their text.
+    """
+    
+    def __init__(self, num_perm: int = 64, shingle_size: int = 5, seed: int = 1):
+        """
+        Initialize the MinHasher.
+        
+        Args:
+            num_perm (int): Number of hash permutations (signature length).
+            shingle_size (int): Words per shingle.
+            seed (int): Seed of the permutations. Signatures are only comparable
+                between hashers with the same seed and size.
+        """
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        rng = np.random.RandomState(seed)
+        self._a = rng.randint(1, _MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+        self._b = rng.randint(0, _MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+    
+    def shingles(self, text: str) -> List[str]:
+        terms = tokenize_terms(text)
+        if len(terms) <= self.shingle_size:
+            return [" ".join(terms)] if terms else []
+        return [" ".join(terms[i:i + self.shingle_size]) for i in range(len(terms) - self.shingle_size + 1)]
+    
+    def signature(self, text: str) -> Optional[np.ndarray]:
+        """
+        MinHash signature of a text.
+        
+        Args:
+            text (str): Passage to sign.
+        
+        Returns:
+            Optional[np.ndarray]: uint64 signature, or None if the text has no words.
+        """
+        shingles = self.shingles(text)
+        if not shingles:
+            return None
+        hashes = np.fromiter((zlib.crc32(shingle.encode("utf-8")) for shingle in set(shingles)), dtype=np.uint64)
+        permuted = (np.outer(hashes, self._a) + self._b) % _MERSENNE_PRIME & _MAX_HASH
+        return permuted.min(axis=0)
+    
+    @staticmethod
+    def similarity(first: np.ndarray, second: np.ndarray) -> float:
+        """
+        Estimated Jaccard similarity of two signatures.
+        """
+        return float(np.mean(first == second))
+
+class NearDuplicateIndex:
+    """
+    Locality-sensitive hashing over MinHash signatures. Each signature is split into
+    bands; passages that share a band are candidates, and candidates whose estimated
+    similarity reaches the threshold are near-duplicates.
+    """
+    
+    def __init__(self, hasher: Optional[MinHasher] = None, threshold: float = 0.8, bands: int = 16):
+        """
+        Initialize the NearDuplicateIndex.
+        
+        Args:
+            hasher (Optional[MinHasher]): Signs passages. If None, a new instance will be created.
+            threshold (float): Minimum estimated Jaccard similarity of near-duplicates.
+            bands (int): LSH bands. Must divide the signature length.
+        """
+        self.hasher = hasher or MinHasher()
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = self.hasher.num_perm // bands
+        self._buckets: Dict[Tuple[int, bytes], List[int]] = defaultdict(list)
+        self._signatures: List[np.ndarray] = []
+        self._keys: List[str] = []
+    
+    def _band_keys(self, signature: np.ndarray):
+        for band in range(self.bands):
+            yield band, signature[band * self.rows:(band + 1) * self.rows].tobytes()
+    
+    def find(self, signature: np.ndarray) -> Optional[str]:
+        """
+        Key of an indexed passage that is a near-duplicate of the signature, if any.
+        """
+        candidates = set()
+        for band_key in self._band_keys(signature):
+            candidates.update(self._buckets.get(band_key, ()))
+        for candidate in sorted(candidates):
+            if self.hasher.similarity(signature, self._signatures[candidate]) >= self.threshold:
+                return self._keys[candidate]
+        return None
+    
+    def add(self, key: str, signature: np.ndarray):
+        """
+        Index a passage under a key, usually its source name.
+        """
+        position = len(self._signatures)
+        self._signatures.append(signature)
+        self._keys.append(key)
+        for band_key in self._band_keys(signature):
+            self._buckets[band_key].append(position)
+
+def split_passages(text: str) -> List[str]:
+    """
+    Split a text into paragraphs. Joining them with a blank line gives back the text.
+    """
+    return text.split("\n\n")
+
+def deduplicate_passages(
+    sources: Sequence[Tuple[str, str]],
+    min_chars: int = 120,
+    index: Optional[NearDuplicateIndex] = None
+) -> List[List[Tuple[str, Optional[str]]]]:
+    """
+    Find near-duplicate paragraphs across sources, keeping the first occurrence.
+    
+    Paragraphs shorter than `min_chars` are always kept, so headings and short
+    lines that legitimately repeat are left alone.
+    
+    Args:
+        sources (Sequence[Tuple[str, str]]): (name, text) of each source, in order.
+        min_chars (int): Shortest paragraph that may be dropped.
+        index (Optional[NearDuplicateIndex]): Index to check against and add to.
+    
+    Returns:
+        List[List[Tuple[str, Optional[str]]]]: For each source, its paragraphs as
+            (text, None) when kept or (text, name of the source that has it) when dropped.
+    """
+    index = index or NearDuplicateIndex()
+    results = []
+    for name, text in sources:
+        passages = []
+        for passage in split_passages(text):
+            duplicate_of = None
+            if len(passage) >= min_chars:
+                signature = index.hasher.signature(passage)
+                if signature is not None:
+                    duplicate_of = index.find(signature)
+                    if duplicate_of is None:
+                        index.add(name, signature)
+            passages.append((passage, duplicate_of))
+        results.append(passages)
+    return results
@@ -1,15 +1,43 @@
-from typing import Tuple, Optional
+from concurrent.futures import Executor, ProcessPoolExecutor
+from typing import Dict, List, Tuple, Optional
 import os
-from unstructured.partition.auto import partition
-from unstructured.partition.doc import partition_doc
-from unstructured.partition.docx import partition_docx
-from unstructured.partition.pdf import partition_pdf
-from unstructured.partition.ppt import partition_ppt
-from unstructured.partition.pptx import partition_pptx
-from unstructured.partition.xlsx import partition_xlsx
-from unstructured.partition.html import partition_html
+import tempfile
+from pypdf import PdfReader, PdfWriter
+from .lazy_import import LazyCallable, import_timings
+from .spreadsheet_extractor import SpreadsheetExtraction, SpreadsheetExtractor
 from .token_manager import TokenManager
 
+# Unstructured's partitioners pull in heavy dependencies (onnxruntime, opencv, pdfminer, ...),
+# so each backend is only imported the first time a file of that format is extracted.
+partition = LazyCallable("unstructured.partition.auto", "partition")
+partition_doc = LazyCallable("unstructured.partition.doc", "partition_doc")
+partition_docx = LazyCallable("unstructured.partition.docx", "partition_docx")
+partition_pdf = LazyCallable("unstructured.partition.pdf", "partition_pdf")
+partition_ppt = LazyCallable("unstructured.partition.ppt", "partition_ppt")
+partition_pptx = LazyCallable("unstructured.partition.pptx", "partition_pptx")
+partition_html = LazyCallable("unstructured.partition.html", "partition_html")
+
+PARTITIONERS: Dict[str, LazyCallable] = {
+    '.pdf': partition_pdf,
+    '.docx': partition_docx,
+    '.doc': partition_doc,
+    '.pptx': partition_pptx,
+    '.ppt': partition_ppt,
+    'html': partition_html,
+    'auto': partition,
+}
+
+PDF_STRATEGIES = ("fast", "hi_res", "ocr_only")
+
+def _partition_pdf_pages(file_path: str, strategy: str, starting_page_number: int = 1) -> List[str]:
+    """
+    Partition a PDF (or a page range written to its own file) and return the element texts.
+    
+    Kept at module level so it can be pickled and run in a worker process.
+    """
+    elements = partition_pdf(file_path, strategy=strategy, starting_page_number=starting_page_number)
+    return [str(element) for element in elements]
+
 class DocumentExtractor:
     """
     A class for extracting text from various document types and counting tokens.
@@ -31,15 +59,66 @@ class DocumentExtractor:
         '.ppt': 'application/vnd.ms-powerpoint'
     }
     
-    def __init__(self, token_manager: Optional[TokenManager] = None):
+    PDF_PAGES_PER_CHUNK = 10
+    PDF_PARALLEL_MIN_PAGES = 20
+    PDF_TEXT_SAMPLE_PAGES = 5
+    PDF_MIN_TEXT_CHARS = 50
+    
+    def __init__(
+        self,
+        token_manager: Optional[TokenManager] = None,
+        max_workers: Optional[int] = None,
+        executor: Optional[Executor] = None
+    ):
         """
         Initialize the DocumentExtractor.
         
         Args:
             token_manager (Optional[TokenManager]): A TokenManager instance.
                 If None, a new instance will be created.
+            max_workers (Optional[int]): Size of the extraction worker pool.
+                Defaults to the number of CPUs.
+            executor (Optional[Executor]): Executor used for parallel page extraction.
+                If None, a process pool is created on first use.
         """
         self.token_manager = token_manager or TokenManager()
+        self.spreadsheet_extractor = SpreadsheetExtractor(token_manager=self.token_manager)
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self._executor = executor
+        self._owns_executor = executor is None
+    
+    def _get_executor(self) -> Executor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+        return self._executor
+    
+    def shutdown(self):
+        """
+        Shut down the extraction worker pool if this instance created it.
+        """
+        if self._executor is not None and self._owns_executor:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+    
+    def warm_up(self, formats: Optional[List[str]] = None) -> Dict[str, float]:
+        """
+        Import the partition backends ahead of the first extraction.
+        
+        Args:
+            formats (Optional[List[str]]): Keys of PARTITIONERS to load (e.g. ['.pdf', 'html']).
+                If None, every backend is loaded.
+        
+        Returns:
+            Dict[str, float]: Import time in seconds for each module loaded by this call.
+        """
+        loaded = {}
+        for key in formats or PARTITIONERS.keys():
+            partitioner = PARTITIONERS[key]
+            if partitioner.loaded:
+                continue
+            partitioner.load()
+            loaded[partitioner.module_name] = import_timings.get(partitioner.module_name, 0.0)
+        return loaded
     
     def is_supported_file(self, file_path: str) -> bool:
         """
@@ -67,15 +146,115 @@ class DocumentExtractor:
         _, ext = os.path.splitext(file_path.lower())
         return self.SUPPORTED_EXTENSIONS.get(ext)
     
-    def extract_from_file(self, file_path: str) -> Tuple[str, int]:
+    def choose_pdf_strategy(self, reader: PdfReader) -> str:
+        """
+        Pick a partition strategy for a PDF by checking whether its pages have a text layer.
+        
+        A sample of pages spread across the document is checked. If most of them
+        have extractable text the fast text-layer strategy is used, otherwise the
+        pages are scanned images and need hi_res/OCR.
+        
+        Args:
+            reader (PdfReader): Reader for the PDF.
+        
+        Returns:
+            str: "fast" or "hi_res".
+        """
+        page_count = len(reader.pages)
+        if page_count == 0:
+            return "fast"
+        
+        sample_size = min(self.PDF_TEXT_SAMPLE_PAGES, page_count)
+        step = page_count / sample_size
+        sample = sorted({int(i * step) for i in range(sample_size)})
+        
+        pages_with_text = 0
+        for page_number in sample:
+            try:
+                text = reader.pages[page_number].extract_text() or ""
+            except Exception:
+                text = ""
+            if len(text.strip()) >= self.PDF_MIN_TEXT_CHARS:
+                pages_with_text += 1
+        
+        return "fast" if pages_with_text * 2 >= len(sample) else "hi_res"
+    
+    def _split_pdf(self, reader: PdfReader, output_dir: str) -> List[Tuple[str, int]]:
+        """
+        Write the PDF out as consecutive page ranges of PDF_PAGES_PER_CHUNK pages.
+        
+        Returns:
+            List[Tuple[str, int]]: Path of each range and its 1-based starting page number.
+        """
+        chunks = []
+        page_count = len(reader.pages)
+        for start in range(0, page_count, self.PDF_PAGES_PER_CHUNK):
+            writer = PdfWriter()
+            for page_number in range(start, min(start + self.PDF_PAGES_PER_CHUNK, page_count)):
+                writer.add_page(reader.pages[page_number])
+            chunk_path = os.path.join(output_dir, f"pages_{start + 1}.pdf")
+            with open(chunk_path, "wb") as f:
+                writer.write(f)
+            chunks.append((chunk_path, start + 1))
+        return chunks
+    
+    def _extract_pdf(self, file_path: str, strategy: str = "auto") -> List[str]:
+        """
+        Extract element texts from a PDF.
+        
+        Large PDFs are split into page ranges which are partitioned in parallel on
+        the worker pool and merged back in page order.
+        
+        Args:
+            file_path (str): Path to the PDF.
+            strategy (str): "auto" to detect the strategy from the text layer,
+                or one of PDF_STRATEGIES.
+        
+        Returns:
+            List[str]: Element texts in document order.
+        """
+        if strategy != "auto" and strategy not in PDF_STRATEGIES:
+            raise ValueError(f"Unsupported PDF strategy: {strategy}. Supported strategies are: auto, {', '.join(PDF_STRATEGIES)}")
+        
+        reader = PdfReader(file_path)
+        if strategy == "auto":
+            strategy = self.choose_pdf_strategy(reader)
+        
+        if len(reader.pages) < self.PDF_PARALLEL_MIN_PAGES or self.max_workers < 2:
+            return _partition_pdf_pages(file_path, strategy)
+        
+        with tempfile.TemporaryDirectory() as temp_dir:
+            chunks = self._split_pdf(reader, temp_dir)
+            executor = self._get_executor()
+            futures = [
+                executor.submit(_partition_pdf_pages, chunk_path, strategy, starting_page_number)
+                for chunk_path, starting_page_number in chunks
+            ]
+            return [text for future in futures for text in future.result()]
+    
+    def extract_spreadsheet(self, file_path: str) -> SpreadsheetExtraction:
+        """
+        Extract text from an .xlsx or .xls workbook by streaming its rows.
+        
+        Args:
+            file_path (str): Path to the workbook.
+        
+        Returns:
+            SpreadsheetExtraction: Compact rendered text, token count and per-sheet token counts.
+        """
+        return self.spreadsheet_extractor.extract(file_path)
+    
+    def extract_text(self, file_path: str, pdf_strategy: str = "auto") -> str:
         """
         Extract text from a file using the appropriate Unstructured partition function.
         
         Args:
             file_path (str): Path to the file.
+            pdf_strategy (str): Partition strategy for PDFs. "auto" picks "fast" when
+                the pages have a text layer and "hi_res" otherwise.
         
         Returns:
-            Tuple[str, int]: Extracted text and token count.
+            str: Extracted text.
             
         Raises:
             ValueError: If the file type is not supported.
@@ -90,13 +269,13 @@ class DocumentExtractor:
             
             match ext:
                 case '.pdf':
-                    elements = partition_pdf(file_path)
+                    elements = self._extract_pdf(file_path, pdf_strategy)
                 case '.docx':
                     elements = partition_docx(file_path)
                 case '.doc':
                     elements = partition_doc(file_path)
                 case '.xlsx' | '.xls':
-                    elements = partition_xlsx(file_path)
+                    return self.extract_spreadsheet(file_path).text
                 case '.pptx':
                     elements = partition_pptx(file_path)
                 case '.ppt':
@@ -104,15 +283,31 @@ class DocumentExtractor:
                 case _:
                     elements = partition(file_path)
 
-            text = "\n\n".join([str(element) for element in elements])
-            
-            tokens = self.token_manager.count_tokens(text)
-            
-            return text, tokens
+            return "\n\n".join([str(element) for element in elements])
             
         except Exception as e:
             raise Exception(f"Error extracting text from {file_path}: {str(e)}")
     
+    def extract_from_file(self, file_path: str, pdf_strategy: str = "auto") -> Tuple[str, int]:
+        """
+        Extract text from a file and count its tokens.
+        
+        Args:
+            file_path (str): Path to the file.
+            pdf_strategy (str): Partition strategy for PDFs, see extract_text.
+        
+        Returns:
+            Tuple[str, int]: Extracted text and token count.
+            
+        Raises:
+            ValueError: If the file type is not supported.
+            Exception: If there's an error during text extraction.
+        """
+        text = self.extract_text(file_path, pdf_strategy)
+        tokens = self.token_manager.count_tokens(text)
+        
+        return text, tokens
+    
     def extract_from_website(self, url: str) -> Tuple[str, int]:
         """
         Extract text from a website.
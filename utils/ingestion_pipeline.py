@@ -0,0 +1,195 @@
+from db.agents import refresh_knowledge_prompt, update_agent_files
+from db.ingestions import update_ingestion, update_ingestion_file
+from fastapi import UploadFile
+from fastapi.concurrency import run_in_threadpool
+from models.agents import File as FileModel
+from models.ingestions import IngestionStatus
+from typing import List, Optional
+from .document_extractor import DocumentExtractor
+from .summarizer import DocumentSummarizer
+from .token_manager import TokenManager
+import asyncio
+import logging
+import os
+import shutil
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+class IngestionPipeline:
+    """
+    Runs file ingestion in the background as three stages connected by queues:
+    extraction (several workers), tokenization and persistence.
+    
+    Each file moves through the stages on its own, so a large file being extracted
+    doesn't hold back smaller files that are already tokenized. Progress, token
+    counts and errors are written to the ingestion record after every stage.
+    """
+    
+    def __init__(
+        self,
+        document_extractor: DocumentExtractor,
+        token_manager: TokenManager,
+        extract_workers: int = 2,
+        spool_root: Optional[str] = None,
+        document_summarizer: Optional[DocumentSummarizer] = None
+    ):
+        """
+        Initialize the IngestionPipeline.
+        
+        Args:
+            document_extractor (DocumentExtractor): Extractor used for the extraction stage.
+            token_manager (TokenManager): Token counter and limit used by the later stages.
+            extract_workers (int): Files extracted concurrently.
+            spool_root (Optional[str]): Directory uploads are spooled to.
+                Defaults to INGESTION_SPOOL_DIR or the system temp directory.
+            document_summarizer (Optional[DocumentSummarizer]): Summarizes oversized files
+                in summarize mode. If None, a new instance will be created when first needed.
+        """
+        self.document_extractor = document_extractor
+        self.token_manager = token_manager
+        self.extract_workers = max(1, extract_workers)
+        self.spool_root = spool_root or os.getenv("INGESTION_SPOOL_DIR") or None
+        self._document_summarizer = document_summarizer
+    
+    @property
+    def document_summarizer(self) -> DocumentSummarizer:
+        if self._document_summarizer is None:
+            self._document_summarizer = DocumentSummarizer(token_manager=self.token_manager)
+        return self._document_summarizer
+    
+    async def spool(self, files: List[UploadFile]) -> List[str]:
+        """
+        Copy uploaded files to a spool directory that outlives the request.
+        
+        Args:
+            files: Uploaded files
+        
+        Returns:
+            Paths of the spooled files, in upload order
+        """
+        if self.spool_root:
+            os.makedirs(self.spool_root, exist_ok=True)
+        spool_dir = tempfile.mkdtemp(prefix="ingestion-", dir=self.spool_root)
+        
+        paths = []
+        for index, file in enumerate(files):
+            path = os.path.join(spool_dir, f"{index}_{os.path.basename(file.filename)}")
+            await file.seek(0)
+            with open(path, "wb") as f:
+                await run_in_threadpool(shutil.copyfileobj, file.file, f)
+            paths.append(path)
+        return paths
+    
+    async def run(
+        self,
+        ingestion_id: str,
+        agent_id: str,
+        file_names: List[str],
+        spooled_paths: List[str],
+        initial_tokens: int = 0,
+        summarize: bool = False
+    ):
+        """
+        Extract, tokenize and persist spooled files, recording progress as it goes.
+        
+        Args:
+            ingestion_id: ID of the ingestion record to update
+            agent_id: ID of the agent the files are added to
+            file_names: Original names of the files
+            spooled_paths: Paths returned by spool
+            initial_tokens: Tokens the agent already uses
+            summarize: Store a map-reduce digest of files that are too large to use whole
+        """
+        extract_queue = asyncio.Queue()
+        token_queue = asyncio.Queue()
+        persist_queue = asyncio.Queue()
+        failures = []
+        current_tokens = initial_tokens
+        
+        for index, (name, path) in enumerate(zip(file_names, spooled_paths)):
+            extract_queue.put_nowait((index, name, path))
+        
+        async def fail(index: int, name: str, error: Exception):
+            failures.append(index)
+            logger.warning(f"Ingestion {ingestion_id}: {name} failed: {error}")
+            try:
+                await update_ingestion_file(ingestion_id, index, IngestionStatus.FAILED, error=str(error))
+            except Exception as e:
+                # A worker must keep draining its queue even when the record can't be updated
+                logger.error(f"Ingestion {ingestion_id}: failed to record the error of {name}: {str(e)}")
+        
+        async def extract_worker():
+            while not extract_queue.empty():
+                index, name, path = extract_queue.get_nowait()
+                try:
+                    await update_ingestion_file(ingestion_id, index, IngestionStatus.EXTRACTING)
+                    text = await run_in_threadpool(self.document_extractor.extract_text, path)
+                    await token_queue.put((index, name, text))
+                except Exception as e:
+                    await fail(index, name, e)
+        
+        async def tokenize_worker():
+            try:
+                while (item := await token_queue.get()) is not None:
+                    index, name, text = item
+                    try:
+                        await update_ingestion_file(ingestion_id, index, IngestionStatus.TOKENIZING)
+                        tokens = await run_in_threadpool(self.token_manager.count_tokens, text)
+                        await persist_queue.put((index, name, text, tokens))
+                    except Exception as e:
+                        await fail(index, name, e)
+            finally:
+                persist_queue.put_nowait(None)
+        
+        async def persist_worker():
+            nonlocal current_tokens
+            while (item := await persist_queue.get()) is not None:
+                index, name, text, tokens = item
+                try:
+                    if summarize and self.document_summarizer.should_summarize(tokens, self.token_manager.max_tokens - current_tokens):
+                        await update_ingestion_file(ingestion_id, index, IngestionStatus.SUMMARIZING)
+                        file = await self.document_summarizer.create_file(name, text, tokens)
+                        tokens = file.tokens
+                    else:
+                        file = FileModel(name=name, text=text, tokens=tokens)
+                    
+                    would_exceed, total_tokens = self.token_manager.check_token_limit(current_tokens, tokens)
+                    if would_exceed:
+                        raise ValueError(f"Token limit exceeded. Current: {current_tokens}, Additional: {tokens}, Total would be: {total_tokens}, Max: {self.token_manager.max_tokens}")
+                    
+                    await update_ingestion_file(ingestion_id, index, IngestionStatus.PERSISTING, tokens=tokens)
+                    await update_agent_files(agent_id, [file], refresh_prompt=False)
+                    current_tokens = total_tokens
+                    
+                    await update_ingestion_file(ingestion_id, index, IngestionStatus.DONE)
+                    await update_ingestion(ingestion_id, add_tokens=tokens)
+                except Exception as e:
+                    await fail(index, name, e)
+        
+        async def extract_stage():
+            # The sentinels are sent even if a stage fails, so the next stage never waits forever
+            try:
+                await asyncio.gather(*(extract_worker() for _ in range(self.extract_workers)))
+            finally:
+                token_queue.put_nowait(None)
+        
+        try:
+            await update_ingestion(ingestion_id, status=IngestionStatus.RUNNING)
+            await asyncio.gather(extract_stage(), tokenize_worker(), persist_worker())
+            if len(failures) < len(file_names):
+                await refresh_knowledge_prompt(agent_id)
+            
+            if not failures:
+                status = IngestionStatus.COMPLETED
+            elif len(failures) == len(file_names):
+                status = IngestionStatus.FAILED
+            else:
+                status = IngestionStatus.COMPLETED_WITH_ERRORS
+            await update_ingestion(ingestion_id, status=status)
+        except Exception as e:
+            logger.error(f"Ingestion {ingestion_id} failed: {str(e)}")
+            await update_ingestion(ingestion_id, status=IngestionStatus.FAILED)
+        finally:
+            if spooled_paths:
+                shutil.rmtree(os.path.dirname(spooled_paths[0]), ignore_errors=True)
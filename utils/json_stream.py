@@ -0,0 +1,45 @@
+from pydantic import BaseModel
+from typing import Any, Callable, Dict, Iterator, Optional, Sequence
+import orjson
+
+def iter_model_json(
+    model: BaseModel,
+    stream_fields: Sequence[str],
+    encode_item: Optional[Callable[[Any], Dict[str, Any]]] = None,
+    chunk_bytes: int = 64 * 1024
+) -> Iterator[bytes]:
+    """
+    Serialize a model to JSON in chunks, encoding its large list fields one item at a time.
+    
+    Fields other than `stream_fields` are dumped as FastAPI would dump them. Items of
+    the streamed fields are encoded with orjson as they are written, so only one item
+    plus a chunk of output is in memory, however large the whole document is.
+    
+    Args:
+        model (BaseModel): Model to serialize.
+        stream_fields (Sequence[str]): List fields to stream item by item.
+        encode_item (Optional[Callable]): Turns an item into a JSON-ready dict.
+            Defaults to the item's JSON-mode model_dump.
+        chunk_bytes (int): Output is buffered and yielded in chunks of about this size.
+    
+    Returns:
+        Iterator[bytes]: Chunks of the JSON document.
+    """
+    encode_item = encode_item or (lambda item: item.model_dump(mode="json", by_alias=True))
+    head = orjson.dumps(model.model_dump(mode="json", by_alias=True, exclude=set(stream_fields)))
+    
+    buffer = bytearray(head[:-1])
+    separator = b"," if len(head) > 2 else b""
+    for field in stream_fields:
+        buffer += separator + orjson.dumps(field) + b":["
+        separator = b","
+        for index, item in enumerate(getattr(model, field)):
+            if index:
+                buffer += b","
+            buffer += orjson.dumps(encode_item(item))
+            if len(buffer) >= chunk_bytes:
+                yield bytes(buffer)
+                buffer.clear()
+        buffer += b"]"
+    buffer += b"}"
+    yield bytes(buffer)
@@ -0,0 +1,233 @@
+from models.agents import File, KnowledgePrompt
+from typing import Iterable, List, Optional, Tuple
+from .dedup import deduplicate_passages
+from .metrics import metrics
+from .token_manager import TokenManager
+import hashlib
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+KNOWLEDGE_BASE_HEADER = """# KNOWLEDGE BASE\n\nWhen answering questions, first check if relevant information exists in these knowledge sources:\n1. Agent Files \n2. Agent Websites\n3. Only then use general search tools\n\nWhen using information from knowledge sources:\n- For Agent Files: Cite as [Agent KB: Filename]\n- For Agent Websites: Cite as [Agent KB: URL]\n- Clearly distinguish between knowledge base information and information from other sources
+        """
+FILES_HEADER = "\n## Agent Files Knowledge Base\n\nWhen you use any agent file, you MUST specify the file name instead of the url\n\n"
+WEBSITES_HEADER = "\n## Agent Websites Knowledge Base\n\nWhen you use any agent website, you MUST specify the url\n\n"
+
+KNOWLEDGE_TOC_HEADER = """# KNOWLEDGE BASE\n\nThis agent has its own knowledge sources, listed below with their size in tokens. Their content is not included here: read it with the lookup_agent_file tool, passing a file name or URL and either a query, to get its most relevant passages, or a part number, to read it in order.\n\nWhen answering questions:\n1. Look up the agent files and websites that may cover the question\n2. Only then use general search tools\n\nWhen using information from knowledge sources:\n- For Agent Files: Cite as [Agent KB: Filename]\n- For Agent Websites: Cite as [Agent KB: URL]\n- Clearly distinguish between knowledge base information and information from other sources\n"""
+
+REPEATED_PASSAGE_MARKER = "[Repeated passage omitted]"
+
+# Pipes in source names are escaped so they don't split the table of contents
+TOC_ESCAPED_PIPE = "\\|"
+
+_token_manager: Optional[TokenManager] = None
+
+def _get_token_manager() -> TokenManager:
+    global _token_manager
+    if _token_manager is None:
+        _token_manager = TokenManager()
+    return _token_manager
+
+def dedup_enabled() -> bool:
+    """
+    Whether near-duplicate passages are left out of knowledge prompts (KB_DEDUP, default true)
+    """
+    return os.getenv("KB_DEDUP", "true").lower() == "true"
+
+def duplicate_marker(source: str) -> str:
+    return f"[Duplicate passage omitted, see {source}]"
+
+def item_text(item: File, cache: bool = True, full_text: bool = False) -> str:
+    """
+    Text an item contributes to the knowledge prompt: its summary when it has one,
+    unless the full text is asked for.
+    """
+    if item.summary is not None and not full_text:
+        return item.summary.read_text(cache=cache)
+    return item.read_text(cache=cache)
+
+def deduplicated_texts(
+    files: Optional[Iterable[File]],
+    websites: Optional[Iterable[File]] = None,
+    cache: bool = True,
+    full_text: bool = False
+) -> Tuple[List[Tuple[str, File, str]], List[str], List[str]]:
+    """
+    Item texts with near-duplicate paragraphs replaced by a marker naming the source
+    that keeps them. Consecutive omitted paragraphs share one marker. Summarized
+    items contribute their summary unless `full_text` is set.
+    
+    Stored texts are left untouched, so removing the source that kept a passage
+    brings it back in the next prompt.
+    
+    Args:
+        files (Optional[Iterable[File]]): Agent files.
+        websites (Optional[Iterable[File]]): Agent websites.
+        cache (bool): Keep the decompressed texts on the items.
+        full_text (bool): Use the full text of summarized items.
+    
+    Returns:
+        Tuple[List[Tuple[str, File, str]], List[str], List[str]]: (section, item, text)
+            of every item in knowledge base order, the omitted paragraphs and the
+            markers that replaced them.
+    """
+    items = [(section, item) for section, group in (("files", files), ("websites", websites)) for item in group or []]
+    texts = [item_text(item, cache, full_text) for _, item in items]
+    if not dedup_enabled():
+        return [(section, item, text) for (section, item), text in zip(items, texts)], [], []
+    
+    results = deduplicate_passages([(item.name, text) for (_, item), text in zip(items, texts)])
+    deduplicated = []
+    omitted = []
+    markers = []
+    for (section, item), passages in zip(items, results):
+        kept = []
+        previous_omitted = False
+        for passage, duplicate_of in passages:
+            if duplicate_of is None:
+                kept.append(passage)
+                previous_omitted = False
+                continue
+            omitted.append(passage)
+            if not previous_omitted:
+                marker = REPEATED_PASSAGE_MARKER if duplicate_of == item.name else duplicate_marker(duplicate_of)
+                kept.append(marker)
+                markers.append(marker)
+            previous_omitted = True
+        deduplicated.append((section, item, "\n\n".join(kept)))
+    return deduplicated, omitted, markers
+
+def knowledge_version(files: Optional[Iterable[File]], websites: Optional[Iterable[File]] = None, full_text: bool = False) -> str:
+    """
+    Hash the files and websites a knowledge prompt is built from.
+    
+    Only stored (compressed) payloads are hashed, so checking whether a prompt is
+    current never decompresses anything. Toggling KB_DEDUP also changes the version.
+    
+    Args:
+        files (Optional[Iterable[File]]): Agent files.
+        websites (Optional[Iterable[File]]): Agent websites.
+        full_text (bool): The prompt uses the full text of summarized items.
+    
+    Returns:
+        str: Hex digest that changes whenever an item is added, removed, replaced or reordered.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(b"dedup" if dedup_enabled() else b"raw")
+    for section, items in (("files", files), ("websites", websites)):
+        digest.update(section.encode())
+        for item in items or []:
+            digest.update(item.name.encode("utf-8", "surrogatepass"))
+            digest.update(item.compression.encode())
+            digest.update(hashlib.blake2b(item.compressed_text, digest_size=16).digest())
+            if item.summary is not None and not full_text:
+                digest.update(hashlib.blake2b(item.summary.compressed_text, digest_size=16).digest())
+    return digest.hexdigest()
+
+def build_knowledge_prompt(files: Optional[Iterable[File]], websites: Optional[Iterable[File]] = None, full_text: bool = False) -> str:
+    """
+    Assemble the knowledge base section of the system prompt.
+    
+    Args:
+        files (Optional[Iterable[File]]): Agent files.
+        websites (Optional[Iterable[File]]): Agent websites.
+        full_text (bool): Use the full text of summarized items.
+    
+    Returns:
+        str: Knowledge base prompt with a section per file and website.
+    """
+    return _render(deduplicated_texts(files, websites, full_text=full_text)[0])
+
+def source_names(files: Iterable[File], websites: Iterable[File] = ()) -> List[Tuple[str, str, File]]:
+    """
+    Name, type ("file" or "website") and item of every source, as listed in the table
+    of contents. Repeated names are numbered, e.g. "report.pdf (2)", so each source
+    can be looked up by the name it is listed under.
+    """
+    names: List[Tuple[str, str, File]] = []
+    used = set()
+    for item_type, items in (("file", files), ("website", websites)):
+        for item in items:
+            name, copy = item.name, 1
+            while name in used:
+                copy += 1
+                name = f"{item.name} ({copy})"
+            used.add(name)
+            names.append((name, item_type, item))
+    return names
+
+def build_knowledge_toc(files: Optional[Iterable[File]], websites: Optional[Iterable[File]] = None) -> str:
+    """
+    Assemble a table of contents of the knowledge base, used instead of its text
+    when the model reads sources on demand with lookup_agent_file. Only names and
+    token counts are read, so nothing is decompressed.
+    
+    Args:
+        files (Optional[Iterable[File]]): Agent files.
+        websites (Optional[Iterable[File]]): Agent websites.
+    
+    Returns:
+        str: Table of contents, or an empty string if the agent has no sources.
+    """
+    files = list(files or [])
+    websites = list(websites or [])
+    if not files and not websites:
+        return ""
+    
+    parts: List[str] = [KNOWLEDGE_TOC_HEADER]
+    names = source_names(files, websites)
+    for title, item_type in (("Agent Files", "file"), ("Agent Websites", "website")):
+        listed = [(name, item) for name, source_type, item in names if source_type == item_type]
+        if not listed:
+            continue
+        parts.append(f"\n## {title}\n\n| Source | Tokens |\n|---|---|\n")
+        for name, item in listed:
+            tokens = item.summary.source_tokens if item.summary is not None else item.tokens
+            parts.append(f"| {name.replace('|', TOC_ESCAPED_PIPE)} | {tokens} |\n")
+    return "".join(parts)
+
+def _render(items: List[Tuple[str, File, str]]) -> str:
+    parts: List[str] = [KNOWLEDGE_BASE_HEADER]
+    section = None
+    for item_section, item, text in items:
+        if item_section != section:
+            section = item_section
+            parts.append(FILES_HEADER if section == "files" else WEBSITES_HEADER)
+        parts.append(f"### {item.name}\n{text}\n\n")
+    return "".join(parts)
+
+def create_knowledge_prompt(
+    files: Optional[Iterable[File]],
+    websites: Optional[Iterable[File]] = None,
+    token_manager: Optional[TokenManager] = None,
+    full_text: bool = False
+) -> KnowledgePrompt:
+    """
+    Build a knowledge prompt together with its version and token count, ready to store.
+    
+    Args:
+        files (Optional[Iterable[File]]): Agent files.
+        websites (Optional[Iterable[File]]): Agent websites.
+        token_manager (Optional[TokenManager]): Counts the prompt tokens.
+            If None, a shared instance is used.
+        full_text (bool): Use the full text of summarized items.
+    
+    Returns:
+        KnowledgePrompt: The compressed prompt, with the tokens saved by leaving out
+            near-duplicate passages.
+    """
+    files = list(files or [])
+    websites = list(websites or [])
+    token_manager = token_manager or _get_token_manager()
+    items, omitted, markers = deduplicated_texts(files, websites, full_text=full_text)
+    text = _render(items)
+    tokens = token_manager.count_tokens(text)
+
+    saved_tokens = 0
+    if omitted:
+        saved_tokens = max(0, sum(token_manager.count_tokens_batch(omitted)) - sum(token_manager.count_tokens_batch(markers)))
+        metrics.increment("kb_dedup.omitted_passages", len(omitted))
+        metrics.increment("kb_dedup.saved_tokens", saved_tokens)
+        logger.info(f"Left {len(omitted)} near-duplicate passages out of the knowledge prompt, saving {saved_tokens} tokens")
+    return KnowledgePrompt(version=knowledge_version(files, websites, full_text), tokens=tokens, saved_tokens=saved_tokens, text=text)
@@ -0,0 +1,66 @@
+from typing import Any, Callable, Dict, Optional
+import importlib
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+import_timings: Dict[str, float] = {}
+_import_lock = threading.Lock()
+
+def import_module_timed(module_name: str):
+    """
+    Import a module and record how long the first import took.
+    
+    Args:
+        module_name (str): Dotted module path.
+    
+    Returns:
+        The imported module.
+    """
+    with _import_lock:
+        if module_name in import_timings:
+            return importlib.import_module(module_name)
+        
+        start = time.perf_counter()
+        module = importlib.import_module(module_name)
+        elapsed = time.perf_counter() - start
+        import_timings[module_name] = elapsed
+        
+        logger.info(f"Imported {module_name} in {elapsed * 1000:.0f} ms")
+        return module
+
+class LazyCallable:
+    """
+    A stand-in for a function that imports its module on first call.
+    
+    Attributes
+        module_name (str): Module that defines the function
+        attribute (str): Name of the function in that module
+    """
+    
+    def __init__(self, module_name: str, attribute: str):
+        self.module_name = module_name
+        self.attribute = attribute
+        self._target: Optional[Callable[..., Any]] = None
+    
+    @property
+    def loaded(self) -> bool:
+        return self._target is not None
+    
+    def load(self) -> Callable[..., Any]:
+        """
+        Import the backing module if needed and return the real function.
+        """
+        if self._target is None:
+            module = import_module_timed(self.module_name)
+            self._target = getattr(module, self.attribute)
+        return self._target
+    
+    def __call__(self, *args, **kwargs):
+        return self.load()(*args, **kwargs)
+    
+    def __repr__(self) -> str:
+        state = "loaded" if self.loaded else "not loaded"
+        return f"<LazyCallable {self.module_name}.{self.attribute} ({state})>"
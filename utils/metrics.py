@@ -0,0 +1,49 @@
+from collections import defaultdict
+from typing import Dict
+import threading
+
+class Metrics:
+    """
+    A small in-process registry of counters and gauges.
+    
+    Metric names are dotted strings (e.g. "kb_text.decompress_seconds"). Counters only
+    go up, gauges hold the latest value. snapshot() returns everything as plain numbers
+    so it can be returned from an API route or logged.
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[str, float] = defaultdict(float)
+        self._gauges: Dict[str, object] = {}
+    
+    def increment(self, name: str, value: float = 1):
+        with self._lock:
+            self._counters[name] += value
+    
+    def set_gauge(self, name: str, value):
+        with self._lock:
+            self._gauges[name] = value
+    
+    def get(self, name: str, default=0):
+        with self._lock:
+            if name in self._counters:
+                return self._counters[name]
+            return self._gauges.get(name, default)
+    
+    def ratio(self, numerator: str, denominator: str) -> float:
+        with self._lock:
+            bottom = self._counters.get(denominator, 0)
+            return self._counters.get(numerator, 0) / bottom if bottom else 0.0
+    
+    def snapshot(self) -> Dict[str, object]:
+        with self._lock:
+            values: Dict[str, object] = dict(self._counters)
+            values.update(self._gauges)
+        return dict(sorted(values.items()))
+    
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._gauges.clear()
+
+metrics = Metrics()
@@ -0,0 +1,296 @@
+from functools import lru_cache
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Sequence
+from .metrics import metrics
+from .token_manager import TokenManager
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+import weakref
+
+logger = logging.getLogger(__name__)
+
+class RoutingRule(NamedTuple):
+    """
+    Attributes
+        route (str): Route taken when every threshold of the rule is met
+        min_prompt_tokens (int): Tokens of the prompt of the run's first model call
+        min_kb_tokens (int): Tokens of the agent's knowledge base
+        min_query_chars (int): Characters of the user's question
+    """
+    route: str
+    min_prompt_tokens: int = 0
+    min_kb_tokens: int = 0
+    min_query_chars: int = 0
+    
+    def matches(self, prompt_tokens: int, kb_tokens: int, query_chars: int) -> bool:
+        return (
+            prompt_tokens >= self.min_prompt_tokens
+            and kb_tokens >= self.min_kb_tokens
+            and query_chars >= self.min_query_chars
+        )
+
+class ModelRouter:
+    """
+    Picks a chat model per research run among named routes, e.g. "fast" and "strong".
+    
+    The route of a run is chosen at its first model call: the first rule whose
+    thresholds are all met wins, otherwise the default route is used. Optionally,
+    a separate route writes the final answer: when the run's model answers without
+    calling tools, the answer is written again by the synthesis route, without tools
+    bound. That costs one extra call per run; the discarded answer's tokens are counted
+    in the model_routing.synthesis.discarded_tokens metric.
+    
+    Models are created on first use and shared by all runs of the process. Each
+    route has its own concurrency limit; calls over the limit wait for a slot.
+    Async calls share the limit per event loop, and calls from worker threads
+    share a separate one.
+    """
+    
+    def __init__(
+        self,
+        models: Dict[str, Callable[[], BaseChatModel]],
+        default: Optional[str] = None,
+        rules: Sequence[RoutingRule] = (),
+        synthesis: Optional[str] = None,
+        max_concurrency: Optional[Dict[str, int]] = None,
+        token_manager: Optional[TokenManager] = None
+    ):
+        """
+        Initialize the ModelRouter.
+        
+        Args:
+            models (Dict[str, Callable[[], BaseChatModel]]): Factory of the model of each route.
+            default (Optional[str]): Route used when no rule matches. Defaults to the first route.
+            rules (Sequence[RoutingRule]): Rules, in order of precedence.
+            synthesis (Optional[str]): Route writing final answers. If None, the run's route does.
+            max_concurrency (Optional[Dict[str, int]]): Calls in flight per route. Defaults to 8.
+            token_manager (Optional[TokenManager]): Counts prompt tokens.
+                If None, a new instance will be created.
+        """
+        if not models:
+            raise ValueError("At least one model route is required")
+        default = default or next(iter(models))
+        for route in [default, synthesis, *(rule.route for rule in rules)]:
+            if route is not None and route not in models:
+                raise ValueError(f"Unknown model route: {route}. Configured routes are: {', '.join(models)}")
+        
+        self.factories = models
+        self.default = default
+        self.rules = list(rules)
+        self.synthesis = synthesis
+        self.token_manager = token_manager or TokenManager()
+        max_concurrency = max_concurrency or {}
+        self._limits = {route: max(1, max_concurrency.get(route, 8)) for route in models}
+        self._slots = {route: threading.BoundedSemaphore(limit) for route, limit in self._limits.items()}
+        # asyncio semaphores belong to one event loop, e.g. the server's
+        self._async_slots: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[str, asyncio.Semaphore]]" = weakref.WeakKeyDictionary()
+        self._in_flight = {route: 0 for route in models}
+        self._models: Dict[str, BaseChatModel] = {}
+        self._lock = threading.Lock()
+    
+    def model(self, route: str) -> BaseChatModel:
+        with self._lock:
+            if route not in self._models:
+                self._models[route] = self.factories[route]()
+            return self._models[route]
+    
+    def select(self, prompt_tokens: int = 0, kb_tokens: int = 0, query_chars: int = 0) -> str:
+        """
+        Route of a run.
+        """
+        for rule in self.rules:
+            if rule.matches(prompt_tokens, kb_tokens, query_chars):
+                return rule.route
+        return self.default
+    
+    def invoke(self, route: str, messages: List[BaseMessage], tools: Optional[Sequence[Any]] = None, **kwargs) -> AIMessage:
+        """
+        Call the model of a route within its concurrency limit, recording its latency.
+        
+        Args:
+            route (str): Route name.
+            messages (List[BaseMessage]): Prompt.
+            tools (Optional[Sequence[Any]]): Tools bound to the call.
+        
+        Returns:
+            AIMessage: The model's response.
+        """
+        model = self.model(route)
+        if tools:
+            model = model.bind_tools(tools, **kwargs)
+        
+        queued = time.perf_counter()
+        with self._slots[route]:
+            started = self._started(route)
+            try:
+                response = model.invoke(messages)
+            except Exception:
+                metrics.increment(f"model.{route}.errors")
+                raise
+            finally:
+                self._finished(route)
+        
+        self._record(route, queued, started)
+        return response
+    
+    async def ainvoke(self, route: str, messages: List[BaseMessage], tools: Optional[Sequence[Any]] = None, **kwargs) -> AIMessage:
+        """
+        Async version of invoke(). Waiting for a slot doesn't block the event loop,
+        and cancelling the caller cancels the model call.
+        """
+        model = self.model(route)
+        if tools:
+            model = model.bind_tools(tools, **kwargs)
+        
+        queued = time.perf_counter()
+        async with self._async_slot(route):
+            started = self._started(route)
+            try:
+                response = await model.ainvoke(messages)
+            except Exception:
+                metrics.increment(f"model.{route}.errors")
+                raise
+            finally:
+                self._finished(route)
+        
+        self._record(route, queued, started)
+        return response
+    
+    def _async_slot(self, route: str) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if loop not in self._async_slots:
+                self._async_slots[loop] = {name: asyncio.Semaphore(limit) for name, limit in self._limits.items()}
+            return self._async_slots[loop][route]
+    
+    def _started(self, route: str) -> float:
+        with self._lock:
+            self._in_flight[route] += 1
+            metrics.set_gauge(f"model.{route}.in_flight", self._in_flight[route])
+        return time.perf_counter()
+    
+    def _finished(self, route: str):
+        with self._lock:
+            self._in_flight[route] -= 1
+            metrics.set_gauge(f"model.{route}.in_flight", self._in_flight[route])
+    
+    def _record(self, route: str, queued: float, started: float):
+        metrics.increment(f"model.{route}.calls")
+        metrics.increment(f"model.{route}.wait_seconds", started - queued)
+        metrics.increment(f"model.{route}.seconds", time.perf_counter() - started)
+    
+    def chat_model(self, kb_tokens: int = 0) -> "RoutedChatModel":
+        """
+        Chat model for one research run.
+        
+        Args:
+            kb_tokens (int): Tokens of the agent's knowledge base.
+        """
+        return RoutedChatModel(router=self, kb_tokens=kb_tokens, decision={})
+
+class RoutedChatModel(BaseChatModel):
+    """
+    Chat model of one research run, delegating each call to a route of a ModelRouter.
+    The route is chosen at the first call and kept for the rest of the run.
+    """
+    
+    router: Any
+    kb_tokens: int = 0
+    tools: List[Any] = []
+    decision: Dict[str, str] = {}
+    
+    @property
+    def _llm_type(self) -> str:
+        return "routed"
+    
+    def bind_tools(self, tools, **kwargs) -> "RoutedChatModel":
+        # Copies share `decision`, so every call of the run uses the same route
+        return self.model_copy(update={"tools": list(tools)})
+    
+    def route(self, messages: List[BaseMessage]) -> str:
+        if "route" not in self.decision:
+            prompt_tokens = sum(self.router.token_manager.count_tokens_batch(str(message.content) for message in messages))
+            query = next((str(message.content) for message in messages if isinstance(message, HumanMessage)), "")
+            self.decision["route"] = self.router.select(prompt_tokens, self.kb_tokens, len(query))
+            metrics.increment(f"model_routing.{self.decision['route']}")
+            logger.info(f"Routed research to {self.decision['route']} ({prompt_tokens} prompt tokens, {self.kb_tokens} knowledge base tokens)")
+        return self.decision["route"]
+    
+    def synthesis_route(self, messages: List[BaseMessage]) -> str:
+        """
+        Route writing the run's final answer.
+        """
+        return self.router.synthesis or self.route(messages)
+    
+    def _resynthesize(self, route: str, response: AIMessage) -> Optional[str]:
+        """
+        Synthesis route that rewrites the answer of the run's model, if any.
+        """
+        synthesis = self.router.synthesis
+        if not (self.tools and synthesis and synthesis != route and not response.tool_calls):
+            return None
+        # The run's model is done with tools; its answer is discarded for the synthesis route's
+        metrics.increment(f"model_routing.synthesis.{synthesis}")
+        metrics.increment("model_routing.synthesis.discarded_tokens", self.router.token_manager.count_tokens(str(response.content)))
+        return synthesis
+    
+    def _generate(self, messages: List[BaseMessage], stop=None, run_manager=None, **kwargs) -> ChatResult:
+        route = self.route(messages)
+        response = self.router.invoke(route, messages, self.tools)
+        synthesis = self._resynthesize(route, response)
+        if synthesis:
+            # Without tools, the synthesis route can only answer
+            response = self.router.invoke(synthesis, messages)
+        return ChatResult(generations=[ChatGeneration(message=response)])
+    
+    async def _agenerate(self, messages: List[BaseMessage], stop=None, run_manager=None, **kwargs) -> ChatResult:
+        route = self.route(messages)
+        response = await self.router.ainvoke(route, messages, self.tools)
+        synthesis = self._resynthesize(route, response)
+        if synthesis:
+            response = await self.router.ainvoke(synthesis, messages)
+        return ChatResult(generations=[ChatGeneration(message=response)])
+    
+    async def asynthesize(self, messages: List[BaseMessage]) -> AIMessage:
+        """
+        Final answer written by the synthesis route, without tools.
+        """
+        return await self.router.ainvoke(self.synthesis_route(messages), messages)
+
+def _json_env(name: str, default):
+    value = os.getenv(name)
+    return json.loads(value) if value else default
+
+@lru_cache(maxsize=1)
+def get_model_router() -> Optional[ModelRouter]:
+    """
+    Router configured by MODEL_ROUTES, or None when model routing is off.
+    
+    MODEL_ROUTES maps routes to OpenAI models, e.g. {"fast": "gpt-4o-mini", "strong": "gpt-4o"}.
+    MODEL_ROUTING_RULES lists RoutingRule fields, e.g. [{"route": "strong", "min_kb_tokens": 50000}].
+    MODEL_DEFAULT_ROUTE and MODEL_SYNTHESIS_ROUTE name the default and synthesis routes, and
+    MODEL_CONCURRENCY maps routes to their concurrency limit.
+    """
+    routes = _json_env("MODEL_ROUTES", None)
+    if not routes:
+        return None
+    
+    from langchain_openai import ChatOpenAI
+    api_key = os.getenv("OPENAI_API_KEY")
+    
+    def factory(model_name: str):
+        return lambda: ChatOpenAI(model=model_name, temperature=0, api_key=api_key)
+    
+    return ModelRouter(
+        models={route: factory(model_name) for route, model_name in routes.items()},
+        default=os.getenv("MODEL_DEFAULT_ROUTE") or None,
+        rules=[RoutingRule(**rule) for rule in _json_env("MODEL_ROUTING_RULES", [])],
+        synthesis=os.getenv("MODEL_SYNTHESIS_ROUTE") or None,
+        max_concurrency=_json_env("MODEL_CONCURRENCY", {})
+    )
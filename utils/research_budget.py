@@ -0,0 +1,147 @@
+from langchain_core.tools import BaseTool, StructuredTool
+from typing import List, Optional
+from .metrics import metrics
+import os
+import threading
+import time
+
+DEADLINE = "deadline"
+STEPS = "steps"
+CANCELLED = "cancelled"
+
+WRAP_UP_PROMPT = (
+    "The research {reason} budget is used up. Do not call any more tools. Answer the question now "
+    "using only the information already gathered, and say briefly what you could not verify."
+)
+
+class ResearchBudget:
+    """
+    Wall-clock deadline and step limit of one research run.
+    
+    A step is one model turn that calls tools. Steps start while the budget lasts;
+    once `max_steps` steps have run, or less than `reserve_seconds` are left before
+    the deadline, tool calls are refused with a structured result telling the model
+    to answer with what it has. The reserve leaves time for that final answer.
+    
+    A run can also be cancelled, e.g. when the client disconnects; tool calls that
+    haven't started by then are refused.
+    """
+    
+    def __init__(
+        self,
+        deadline_seconds: Optional[float] = None,
+        max_steps: Optional[int] = None,
+        reserve_seconds: Optional[float] = None
+    ):
+        """
+        Initialize the ResearchBudget.
+        
+        Args:
+            deadline_seconds (Optional[float]): Seconds a run may take.
+                Defaults to RESEARCH_DEADLINE_SECONDS or 60.
+            max_steps (Optional[int]): Tool-calling steps a run may take.
+                Defaults to RESEARCH_MAX_STEPS or 6.
+            reserve_seconds (Optional[float]): Seconds kept for the final answer.
+                Defaults to RESEARCH_RESERVE_SECONDS or 10, at most half the deadline.
+        """
+        self.deadline_seconds = deadline_seconds or float(os.getenv("RESEARCH_DEADLINE_SECONDS", "60"))
+        self.max_steps = max_steps or int(os.getenv("RESEARCH_MAX_STEPS", "6"))
+        reserve = reserve_seconds if reserve_seconds is not None else float(os.getenv("RESEARCH_RESERVE_SECONDS", "10"))
+        self.reserve_seconds = min(reserve, self.deadline_seconds / 2)
+        self.started_at: Optional[float] = None
+        self.steps = 0
+        self.truncated: Optional[str] = None
+        self.cancelled = threading.Event()
+        self.tool_calls = 0
+        self.refused_calls = 0
+        self.running_calls = 0
+        self._step_allowed = True
+        self._lock = threading.Lock()
+    
+    def start(self):
+        self.started_at = time.monotonic()
+    
+    def remaining(self) -> float:
+        """
+        Seconds left before the deadline.
+        """
+        if self.started_at is None:
+            return self.deadline_seconds
+        return self.deadline_seconds - (time.monotonic() - self.started_at)
+    
+    def exhausted(self) -> Optional[str]:
+        """
+        Why no further step may start, or None while the budget lasts.
+        """
+        if self.cancelled.is_set():
+            return CANCELLED
+        if self.steps >= self.max_steps:
+            return STEPS
+        if self.remaining() <= self.reserve_seconds:
+            return DEADLINE
+        return None
+    
+    def begin_step(self) -> bool:
+        """
+        Record that the model asked for tools.
+        
+        Returns:
+            bool: Whether the step's tool calls may run.
+        """
+        reason = self.exhausted()
+        self._step_allowed = reason is None
+        if reason:
+            self.stop(reason)
+        else:
+            self.steps += 1
+        return self._step_allowed
+    
+    def stop(self, reason: str):
+        """
+        Record that the run was cut short.
+        """
+        with self._lock:
+            if self.truncated is not None:
+                return
+            self.truncated = reason
+        metrics.increment(f"research.truncated.{reason}")
+    
+    def cancel(self):
+        """
+        Cancel the run. Safe to call from any thread.
+        """
+        self.cancelled.set()
+        self.stop(CANCELLED)
+    
+    def wrap_up_prompt(self) -> str:
+        return WRAP_UP_PROMPT.format(reason="time" if self.truncated == DEADLINE else "step")
+    
+    def wrap(self, tool: BaseTool) -> BaseTool:
+        """
+        Copy of a tool that refuses calls of steps started after the budget ran out.
+        """
+        def run(**kwargs):
+            if self.cancelled.is_set():
+                with self._lock:
+                    self.refused_calls += 1
+                return {"status": "cancelled", "tool": tool.name, "message": "The research was cancelled."}
+            if not self._step_allowed:
+                return {"status": "budget_exhausted", "tool": tool.name, "message": self.wrap_up_prompt()}
+            with self._lock:
+                self.tool_calls += 1
+                self.running_calls += 1
+            try:
+                return tool.invoke(kwargs)
+            finally:
+                with self._lock:
+                    self.running_calls -= 1
+        
+        return StructuredTool.from_function(
+            func=run,
+            name=tool.name,
+            description=tool.description,
+            args_schema=tool.args_schema
+        )
+    
+    def wrap_tools(self, tools: List[BaseTool]) -> List[BaseTool]:
+        return [self.wrap(tool) for tool in tools]
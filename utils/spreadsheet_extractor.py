@@ -0,0 +1,229 @@
+from datetime import date, datetime, time
+from typing import Any, Iterable, Iterator, List, NamedTuple, Optional, Sequence, Tuple
+import logging
+import os
+from .lazy_import import import_module_timed
+from .token_manager import TokenManager
+
+logger = logging.getLogger(__name__)
+
+class SheetSummary(NamedTuple):
+    """
+    Attributes
+        name (str): Sheet name
+        rows (int): Data rows read from the sheet (header excluded)
+        tokens (int): Tokens used by the rendered sheet
+    """
+    name: str
+    rows: int
+    tokens: int
+
+class SpreadsheetExtraction(NamedTuple):
+    """
+    Attributes
+        text (str): Rendered text of every sheet
+        tokens (int): Tokens used by the whole text
+        sheets (list[SheetSummary]): Per-sheet row and token counts
+    """
+    text: str
+    tokens: int
+    sheets: List[SheetSummary]
+
+class SpreadsheetExtractor:
+    """
+    Extracts text from .xlsx and .xls workbooks without building the whole workbook in memory.
+    
+    Rows are streamed one at a time and rendered as compact delimited lines:
+    - The header row is written once. Column names are made unique and rows that
+      repeat the header further down the sheet are dropped.
+    - A cell equal to the cell above it is written as the DITTO marker.
+    - Runs of identical rows are collapsed into a single "repeated" line.
+    """
+    
+    SUPPORTED_EXTENSIONS = ('.xlsx', '.xls')
+    DITTO = '"'
+    
+    def __init__(
+        self,
+        token_manager: Optional[TokenManager] = None,
+        delimiter: str = " | ",
+        max_rows_per_sheet: Optional[int] = None
+    ):
+        """
+        Initialize the SpreadsheetExtractor.
+        
+        Args:
+            token_manager (Optional[TokenManager]): A TokenManager instance.
+                If None, a new instance will be created.
+            delimiter (str): Separator placed between cells.
+            max_rows_per_sheet (Optional[int]): Stop rendering a sheet after this many
+                data rows. None renders every row.
+        """
+        self.token_manager = token_manager or TokenManager()
+        self.delimiter = delimiter
+        self.max_rows_per_sheet = max_rows_per_sheet
+    
+    def _format_value(self, value: Any) -> str:
+        if value is None:
+            return ""
+        if isinstance(value, bool):
+            return "TRUE" if value else "FALSE"
+        if isinstance(value, float):
+            return str(int(value)) if value.is_integer() else f"{value:.10g}"
+        if isinstance(value, datetime):
+            return value.date().isoformat() if value.time() == time() else value.isoformat(sep=" ")
+        if isinstance(value, date):
+            return value.isoformat()
+        
+        text = " ".join(str(value).split())
+        separator = self.delimiter.strip()
+        return text.replace(separator, "/") if separator else text
+    
+    def _format_row(self, row: Sequence[Any]) -> List[str]:
+        cells = [self._format_value(value) for value in row]
+        while cells and not cells[-1]:
+            cells.pop()
+        return cells
+    
+    @staticmethod
+    def _dedup_header(header: List[str]) -> List[str]:
+        seen = {}
+        unique = []
+        for index, name in enumerate(header):
+            name = name or f"column_{index + 1}"
+            count = seen.get(name, 0) + 1
+            seen[name] = count
+            unique.append(name if count == 1 else f"{name}_{count}")
+        return unique
+    
+    def render_sheet(self, name: str, rows: Iterable[Sequence[Any]]) -> Tuple[str, int]:
+        """
+        Render the rows of one sheet in the compact delimited form.
+        
+        Args:
+            name (str): Sheet name.
+            rows (Iterable[Sequence[Any]]): Raw cell values, one sequence per row.
+        
+        Returns:
+            Tuple[str, int]: Rendered text and number of data rows read.
+        """
+        lines = []
+        raw_header = None
+        previous: List[str] = []
+        repeats = 0
+        data_rows = 0
+        omitted = 0
+        
+        def flush_repeats():
+            if repeats:
+                lines.append(f"(previous row repeated {repeats}x)")
+        
+        for row in rows:
+            cells = self._format_row(row)
+            if not cells:
+                continue
+            
+            if raw_header is None:
+                raw_header = cells
+                lines.append(self.delimiter.join(self._dedup_header(cells)))
+                continue
+            
+            if cells == raw_header:
+                continue
+            
+            if self.max_rows_per_sheet is not None and data_rows >= self.max_rows_per_sheet:
+                omitted += 1
+                continue
+            data_rows += 1
+            
+            if cells == previous:
+                repeats += 1
+                continue
+            flush_repeats()
+            repeats = 0
+            
+            compact = [
+                self.DITTO if value and index < len(previous) and previous[index] == value else value
+                for index, value in enumerate(cells)
+            ]
+            lines.append(self.delimiter.join(compact))
+            previous = cells
+        
+        flush_repeats()
+        if omitted:
+            lines.append(f"({omitted} more rows omitted)")
+        
+        heading = f"## Sheet: {name}"
+        if not lines:
+            return f"{heading}\n(empty)", 0
+        return heading + "\n" + "\n".join(lines), data_rows
+    
+    def _iter_xlsx(self, file_path: str) -> Iterator[Tuple[str, Iterable[Sequence[Any]]]]:
+        openpyxl = import_module_timed("openpyxl")
+        workbook = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
+        try:
+            for worksheet in workbook.worksheets:
+                yield worksheet.title, worksheet.iter_rows(values_only=True)
+        finally:
+            workbook.close()
+    
+    def _iter_xls(self, file_path: str) -> Iterator[Tuple[str, Iterable[Sequence[Any]]]]:
+        xlrd = import_module_timed("xlrd")
+        workbook = xlrd.open_workbook(file_path, on_demand=True)
+        
+        def sheet_rows(sheet):
+            for row in sheet.get_rows():
+                values = []
+                for cell in row:
+                    if cell.ctype == xlrd.XL_CELL_DATE:
+                        values.append(xlrd.xldate_as_datetime(cell.value, workbook.datemode))
+                    else:
+                        values.append(cell.value)
+                yield values
+        
+        try:
+            for index in range(workbook.nsheets):
+                sheet = workbook.sheet_by_index(index)
+                yield sheet.name, sheet_rows(sheet)
+                workbook.unload_sheet(index)
+        finally:
+            workbook.release_resources()
+    
+    def extract(self, file_path: str) -> SpreadsheetExtraction:
+        """
+        Extract text from a workbook, sheet by sheet.
+        
+        Args:
+            file_path (str): Path to the .xlsx or .xls file.
+        
+        Returns:
+            SpreadsheetExtraction: Rendered text, total tokens and per-sheet summaries.
+        
+        Raises:
+            ValueError: If the file type is not supported.
+        """
+        _, ext = os.path.splitext(file_path.lower())
+        if ext not in self.SUPPORTED_EXTENSIONS:
+            raise ValueError(f"Unsupported spreadsheet extension: {ext}. Supported types are: {', '.join(self.SUPPORTED_EXTENSIONS)}")
+        
+        sheets = self._iter_xlsx(file_path) if ext == '.xlsx' else self._iter_xls(file_path)
+        
+        names = []
+        row_counts = []
+        sheet_texts = []
+        for name, rows in sheets:
+            sheet_text, row_count = self.render_sheet(name, rows)
+            names.append(name)
+            row_counts.append(row_count)
+            sheet_texts.append(sheet_text)
+        
+        sheet_tokens = self.token_manager.count_tokens_batch(sheet_texts)
+        summaries = [SheetSummary(name, rows, tokens) for name, rows, tokens in zip(names, row_counts, sheet_tokens)]
+        
+        text = "\n\n".join(sheet_texts)
+        tokens = self.token_manager.count_tokens(text)
+        
+        for summary in summaries:
+            logger.info(f"Sheet '{summary.name}' of {os.path.basename(file_path)}: {summary.rows} rows, {summary.tokens} tokens")
+        
+        return SpreadsheetExtraction(text=text, tokens=tokens, sheets=summaries)
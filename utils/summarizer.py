@@ -0,0 +1,179 @@
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import HumanMessage
+from langchain_core.rate_limiters import InMemoryRateLimiter
+from models.agents import File, Summary
+from typing import List, Optional
+from .context_packer import split_spans
+from .metrics import metrics
+from .token_manager import TokenManager
+import asyncio
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+MAP_PROMPT = """Summarize part {part} of {parts} of the document "{name}".
+Keep names, figures, dates, definitions and conclusions. Leave out boilerplate and repetition.
+Reply with the summary only.
+
+{text}"""
+
+REDUCE_PROMPT = """Combine these summaries of consecutive parts of the document "{name}" into one digest of at most {max_words} words.
+Keep names, figures, dates, definitions and conclusions, in document order.
+Reply with the digest only.
+
+{text}"""
+
+SUMMARY_NOTE = "[Summary of a {source_tokens}-token document]\n"
+
+class DocumentSummarizer:
+    """
+    Map-reduce summarization of documents too large for the knowledge base.
+    
+    A document is split into chunks that are summarized concurrently (map), then
+    consecutive summaries are combined (reduce) until the digest fits
+    `digest_tokens`. Model calls share a rate limiter, so concurrent uploads can't
+    exceed the provider's request rate.
+    """
+    
+    def __init__(
+        self,
+        model: Optional[BaseChatModel] = None,
+        token_manager: Optional[TokenManager] = None,
+        chunk_tokens: int = 3000,
+        digest_tokens: Optional[int] = None,
+        min_tokens: Optional[int] = None,
+        max_concurrency: int = 4,
+        requests_per_second: Optional[float] = None,
+        max_reduce_rounds: int = 3
+    ):
+        """
+        Initialize the DocumentSummarizer.
+        
+        Args:
+            model (Optional[BaseChatModel]): Chat model writing the summaries.
+                If None, the model of LLMSetup is created on first use.
+            token_manager (Optional[TokenManager]): A TokenManager instance.
+                If None, a new instance will be created.
+            chunk_tokens (int): Approximate size of a summarized chunk.
+            digest_tokens (Optional[int]): Maximum size of a digest.
+                Defaults to SUMMARY_DIGEST_TOKENS or 2000.
+            min_tokens (Optional[int]): Documents of at least this size are summarized in
+                summarize mode. Smaller ones only when they would exceed the token limit.
+                Defaults to SUMMARIZE_MIN_TOKENS or 20000.
+            max_concurrency (int): Model calls in flight per document.
+            requests_per_second (Optional[float]): Model calls per second across all documents.
+                Defaults to SUMMARY_REQUESTS_PER_SECOND or 2.
+            max_reduce_rounds (int): Reduce rounds before an oversized digest is truncated.
+        """
+        self._model = model
+        self.token_manager = token_manager or TokenManager()
+        self.chunk_tokens = chunk_tokens
+        self.digest_tokens = digest_tokens or int(os.getenv("SUMMARY_DIGEST_TOKENS", "2000"))
+        self.min_tokens = min_tokens or int(os.getenv("SUMMARIZE_MIN_TOKENS", "20000"))
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_reduce_rounds = max_reduce_rounds
+        self.rate_limiter = InMemoryRateLimiter(
+            requests_per_second=requests_per_second or float(os.getenv("SUMMARY_REQUESTS_PER_SECOND", "2")),
+            check_every_n_seconds=0.05,
+            max_bucket_size=self.max_concurrency
+        )
+    
+    @property
+    def model(self) -> BaseChatModel:
+        if self._model is None:
+            from llm_setup import LLMSetup
+            self._model = LLMSetup().get_model()
+        return self._model
+    
+    def should_summarize(self, tokens: int, remaining_tokens: int) -> bool:
+        """
+        Whether a document of `tokens` tokens gets a digest when `remaining_tokens`
+        are left in the agent's budget.
+        """
+        return tokens >= self.min_tokens or tokens > remaining_tokens
+    
+    async def _complete(self, prompt: str, semaphore: asyncio.Semaphore) -> str:
+        async with semaphore:
+            await self.rate_limiter.aacquire()
+            response = await self.model.ainvoke([HumanMessage(content=prompt)])
+        metrics.increment("summaries.model_calls")
+        return str(response.content).strip()
+    
+    def _group(self, summaries: List[str]) -> List[List[str]]:
+        """
+        Group consecutive summaries so each group fits one reduce call.
+        """
+        groups: List[List[str]] = []
+        group_tokens = 0
+        for summary, tokens in zip(summaries, self.token_manager.count_tokens_batch(summaries)):
+            if not groups or group_tokens + tokens > self.chunk_tokens:
+                groups.append([])
+                group_tokens = 0
+            groups[-1].append(summary)
+            group_tokens += tokens
+        return groups
+    
+    def _truncate(self, text: str) -> str:
+        return self.token_manager.encoding.decode(self.token_manager.encoding.encode_ordinary(text)[:self.digest_tokens])
+    
+    async def summarize(self, name: str, text: str) -> str:
+        """
+        Reduce a document to a digest of at most `digest_tokens` tokens.
+        
+        Args:
+            name (str): Document name, given to the model for context.
+            text (str): Full text.
+        
+        Returns:
+            str: The digest.
+        """
+        started = time.perf_counter()
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        chunks = [text[start:end] for start, end in split_spans(text, self.chunk_tokens * 4)]
+        summaries = list(await asyncio.gather(*(
+            self._complete(MAP_PROMPT.format(part=part, parts=len(chunks), name=name, text=chunk), semaphore)
+            for part, chunk in enumerate(chunks, start=1)
+        )))
+        
+        max_words = self.digest_tokens * 3 // 4
+        for _ in range(self.max_reduce_rounds):
+            digest = "\n\n".join(summaries)
+            if self.token_manager.count_tokens(digest) <= self.digest_tokens:
+                break
+            summaries = list(await asyncio.gather(*(
+                self._complete(REDUCE_PROMPT.format(name=name, max_words=max_words, text="\n\n".join(group)), semaphore)
+                for group in self._group(summaries)
+            )))
+        else:
+            digest = "\n\n".join(summaries)
+            if self.token_manager.count_tokens(digest) > self.digest_tokens:
+                digest = self._truncate(digest)
+                logger.warning(f"Digest of {name} was truncated to {self.digest_tokens} tokens")
+        
+        metrics.increment("summaries.documents")
+        metrics.increment("summaries.seconds", time.perf_counter() - started)
+        return digest
+    
+    async def create_file(self, name: str, text: str, tokens: int) -> File:
+        """
+        Summarize a document into a File that keeps the full text next to its digest.
+        
+        Args:
+            name (str): File name.
+            text (str): Full text.
+            tokens (int): Tokens utilized by the full text.
+        
+        Returns:
+            File: File counted at the size of its digest.
+        """
+        digest = await self.summarize(name, text)
+        summary_text = SUMMARY_NOTE.format(source_tokens=tokens) + digest
+        summary_tokens = self.token_manager.count_tokens(summary_text)
+        return File(
+            name=name,
+            text=text,
+            tokens=summary_tokens,
+            summary=Summary(text=summary_text, tokens=summary_tokens, source_tokens=tokens)
+        )
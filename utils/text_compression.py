@@ -0,0 +1,141 @@
+from typing import Iterable, Optional, Tuple
+import logging
+import os
+import time
+import zlib
+from .metrics import metrics
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+CODEC_NONE = "none"
+CODEC_ZLIB = "zlib"
+CODEC_ZSTD = "zstd"
+
+class TextCompressor:
+    """
+    Compresses knowledge base text for storage and decompresses it when it is read.
+    
+    zstd is used when the zstandard package is installed, with an optional trained
+    dictionary for better ratios on short texts. zlib is the fallback. Compressed
+    payloads carry their codec, and zstd frames carry their dictionary ID, so
+    changing settings never makes stored text unreadable.
+    
+    Compression ratio and read cost are recorded in utils.metrics under "kb_text.*".
+    """
+    
+    def __init__(self, codec: Optional[str] = None, level: int = 3, dictionary_path: Optional[str] = None):
+        """
+        Initialize the TextCompressor.
+        
+        Args:
+            codec (Optional[str]): "zstd", "zlib" or "none". Defaults to KB_TEXT_CODEC,
+                or zstd when available.
+            level (int): Compression level.
+            dictionary_path (Optional[str]): Trained zstd dictionary to compress with.
+                Defaults to KB_ZSTD_DICT_PATH.
+        """
+        default_codec = CODEC_ZSTD if zstandard else CODEC_ZLIB
+        self.codec = (codec or os.getenv("KB_TEXT_CODEC") or default_codec).lower()
+        if self.codec == CODEC_ZSTD and zstandard is None:
+            logger.warning("zstandard is not installed, compressing knowledge base text with zlib")
+            self.codec = CODEC_ZLIB
+        if self.codec not in (CODEC_NONE, CODEC_ZLIB, CODEC_ZSTD):
+            raise ValueError(f"Unsupported text codec: {self.codec}")
+        
+        self.level = level
+        self.dictionary = None
+        dictionary_path = dictionary_path or os.getenv("KB_ZSTD_DICT_PATH")
+        if dictionary_path and zstandard is not None:
+            with open(dictionary_path, "rb") as f:
+                self.dictionary = zstandard.ZstdCompressionDict(f.read())
+    
+    def compress(self, text: str) -> Tuple[str, bytes]:
+        """
+        Compress a text.
+        
+        Args:
+            text (str): Text to compress.
+        
+        Returns:
+            Tuple[str, bytes]: Codec used and the compressed payload.
+        """
+        start = time.perf_counter()
+        raw = text.encode("utf-8")
+        
+        if self.codec == CODEC_ZSTD:
+            compressor = zstandard.ZstdCompressor(level=self.level, dict_data=self.dictionary)
+            payload = compressor.compress(raw)
+        elif self.codec == CODEC_ZLIB:
+            payload = zlib.compress(raw, self.level)
+        else:
+            payload = raw
+        
+        metrics.increment("kb_text.raw_bytes", len(raw))
+        metrics.increment("kb_text.stored_bytes", len(payload))
+        metrics.increment("kb_text.compress_seconds", time.perf_counter() - start)
+        return self.codec, payload
+    
+    def decompress(self, codec: str, payload: bytes) -> str:
+        """
+        Decompress a payload produced by compress.
+        
+        Args:
+            codec (str): Codec returned by compress.
+            payload (bytes): Compressed payload.
+        
+        Returns:
+            str: The original text.
+        """
+        start = time.perf_counter()
+        
+        if codec == CODEC_ZSTD:
+            if zstandard is None:
+                raise ValueError("zstandard is required to read zstd-compressed text")
+            dict_id = zstandard.get_frame_parameters(payload).dict_id
+            if dict_id and (self.dictionary is None or self.dictionary.dict_id() != dict_id):
+                raise ValueError(f"Text was compressed with zstd dictionary {dict_id}, which is not loaded")
+            decompressor = zstandard.ZstdDecompressor(dict_data=self.dictionary if dict_id else None)
+            raw = decompressor.decompress(payload)
+        elif codec == CODEC_ZLIB:
+            raw = zlib.decompress(payload)
+        elif codec == CODEC_NONE:
+            raw = payload
+        else:
+            raise ValueError(f"Unsupported text codec: {codec}")
+        
+        metrics.increment("kb_text.decompressions")
+        metrics.increment("kb_text.decompress_seconds", time.perf_counter() - start)
+        return raw.decode("utf-8")
+
+def train_dictionary(samples: Iterable[str], dict_size: int = 112640) -> bytes:
+    """
+    Train a zstd dictionary on sample knowledge base texts.
+    
+    Args:
+        samples (Iterable[str]): Representative extracted texts.
+        dict_size (int): Maximum dictionary size in bytes.
+    
+    Returns:
+        bytes: Dictionary data, to be written to the file KB_ZSTD_DICT_PATH points to.
+    """
+    if zstandard is None:
+        raise ValueError("zstandard is required to train a dictionary")
+    return zstandard.train_dictionary(dict_size, [sample.encode("utf-8") for sample in samples]).as_bytes()
+
+def compression_stats() -> dict:
+    """
+    Compression ratio and read cost of knowledge base text since startup.
+    """
+    decompressions = metrics.get("kb_text.decompressions")
+    return {
+        "compression_ratio": metrics.ratio("kb_text.raw_bytes", "kb_text.stored_bytes"),
+        "decompressions": decompressions,
+        "avg_decompress_ms": metrics.get("kb_text.decompress_seconds") * 1000 / decompressions if decompressions else 0.0,
+    }
+
+text_compressor = TextCompressor()
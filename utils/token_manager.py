@@ -1,4 +1,7 @@
-from typing import Tuple
+from collections import OrderedDict
+from typing import Iterable, List, Tuple
+import hashlib
+import threading
 import tiktoken
 
 class TokenManager:
@@ -6,7 +9,14 @@ class TokenManager:
     A class to manage token counting and token limits for large language models.
     """
     
-    def __init__(self, max_tokens: int = 120000, encoding_name: str = "cl100k_base"):
+    def __init__(
+        self,
+        max_tokens: int = 120000,
+        encoding_name: str = "cl100k_base",
+        num_threads: int = 8,
+        cache_size: int = 4096,
+        segment_chars: int = 200000
+    ):
         """
         Initialize the TokenManager.
         
@@ -14,9 +24,99 @@ class TokenManager:
             max_tokens (int): Maximum number of tokens allowed. Default is 120,000.
             encoding_name (str): The name of the tiktoken encoding to use.
                 Default is "cl100k_base" which is used for GPT-4 models.
+            num_threads (int): Number of threads tiktoken may use for batch encoding.
+            cache_size (int): Number of token counts kept in the LRU cache. 0 disables caching.
+            segment_chars (int): Texts longer than this are counted in segments so that
+                only a bounded number of token lists is alive at any time.
         """
         self.max_tokens = max_tokens
         self.encoding = tiktoken.get_encoding(encoding_name)
+        self.num_threads = max(1, num_threads)
+        self.cache_size = cache_size
+        self.segment_chars = segment_chars
+        
+        self._cache: "OrderedDict[bytes, int]" = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self.cache_hits = 0
+        self.cache_misses = 0
+    
+    @staticmethod
+    def _text_key(text: str) -> bytes:
+        """
+        Hash a text into a compact cache key so the cache never holds the text itself.
+        """
+        return hashlib.blake2b(text.encode("utf-8", "surrogatepass"), digest_size=16).digest()
+    
+    def _cache_get(self, key: bytes):
+        with self._cache_lock:
+            count = self._cache.get(key)
+            if count is None:
+                self.cache_misses += 1
+                return None
+            self._cache.move_to_end(key)
+            self.cache_hits += 1
+            return count
+    
+    def _cache_put(self, key: bytes, count: int):
+        if self.cache_size <= 0:
+            return
+        with self._cache_lock:
+            self._cache[key] = count
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+    
+    def clear_cache(self):
+        """
+        Drop all cached token counts.
+        """
+        with self._cache_lock:
+            self._cache.clear()
+            self.cache_hits = 0
+            self.cache_misses = 0
+    
+    def _split_segments(self, text: str) -> List[str]:
+        """
+        Split a long text into segments of roughly `segment_chars` characters.
+        
+        Segments are only cut between a newline and a letter. tiktoken never merges
+        those two characters into one pre-token, so the sum of the segment counts
+        equals the count of the whole text.
+        """
+        if len(text) <= self.segment_chars:
+            return [text]
+        
+        segments = []
+        start = 0
+        while len(text) - start > self.segment_chars:
+            cut = text.find("\n", start + self.segment_chars)
+            while cut != -1 and not text[cut + 1:cut + 2].isalpha():
+                cut = text.find("\n", cut + 1)
+            if cut == -1:
+                break
+            segments.append(text[start:cut + 1])
+            start = cut + 1
+        segments.append(text[start:])
+        return segments
+    
+    def _encode_lengths(self, texts: List[str]) -> List[int]:
+        """
+        Count tokens for a list of texts with tiktoken's threaded batch encoder.
+        
+        Texts are encoded in groups of `num_threads` and only the lengths are kept,
+        so at most one group of token lists is alive at a time.
+        """
+        lengths = []
+        for i in range(0, len(texts), self.num_threads):
+            group = texts[i:i + self.num_threads]
+            if len(group) == 1:
+                lengths.append(len(self.encoding.encode_ordinary(group[0])))
+                continue
+            lengths.extend(len(tokens) for tokens in self.encoding.encode_ordinary_batch(group, num_threads=self.num_threads))
+        return lengths
+    
+    def _count_uncached(self, text: str) -> int:
+        return sum(self._encode_lengths(self._split_segments(text)))
     
     def count_tokens(self, text: str) -> int:
         """
@@ -28,7 +128,64 @@ class TokenManager:
         Returns:
             int: Number of tokens.
         """
-        return len(self.encoding.encode(text))
+        if not text:
+            return 0
+        
+        key = self._text_key(text)
+        count = self._cache_get(key)
+        if count is None:
+            count = self._count_uncached(text)
+            self._cache_put(key, count)
+        return count
+    
+    def count_tokens_batch(self, texts: Iterable[str]) -> List[int]:
+        """
+        Count the number of tokens for several texts at once.
+        
+        Cached texts are answered from the LRU cache, duplicates within the batch are
+        encoded once and the remaining texts are encoded in parallel using
+        `num_threads` threads.
+        
+        Args:
+            texts (Iterable[str]): The texts to tokenize.
+        
+        Returns:
+            List[int]: Number of tokens for each text, in input order.
+        """
+        texts = list(texts)
+        counts: List[int] = [0] * len(texts)
+        pending = {}
+        
+        for i, text in enumerate(texts):
+            if not text:
+                continue
+            key = self._text_key(text)
+            if key in pending:
+                pending[key][1].append(i)
+                continue
+            count = self._cache_get(key)
+            if count is None:
+                pending[key] = (text, [i])
+            else:
+                counts[i] = count
+        
+        segments = []
+        owners = []
+        for key, (text, _) in pending.items():
+            for segment in self._split_segments(text):
+                segments.append(segment)
+                owners.append(key)
+        
+        totals = dict.fromkeys(pending, 0)
+        for key, length in zip(owners, self._encode_lengths(segments)):
+            totals[key] += length
+        
+        for key, (_, indexes) in pending.items():
+            self._cache_put(key, totals[key])
+            for i in indexes:
+                counts[i] = totals[key]
+        
+        return counts
     
     def check_token_limit(self, current_tokens: int, additional_tokens: int) -> Tuple[bool, int]:
         """
@@ -37,7 +194,7 @@ class TokenManager:
         Args:
             current_tokens (int): Current number of tokens.
             additional_tokens (int): Number of additional tokens to add.
-            
+        
         Returns:
             Tuple[bool, int]: A tuple containing:
                 - bool: True if adding would exceed the limit, False otherwise.
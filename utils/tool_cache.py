@@ -0,0 +1,221 @@
+from concurrent.futures import Executor, Future
+from langchain_core.tools import BaseTool, StructuredTool
+from typing import Any, Dict, List, Tuple
+from .metrics import metrics
+from .tool_resilience import is_retryable
+import json
+import logging
+import re
+import threading
+
+logger = logging.getLogger(__name__)
+
+_TRAILING_PUNCTUATION = re.compile(r"[\s.?!]+$")
+
+def normalize_argument(value: Any) -> Any:
+    """
+    Normalize a tool argument so trivially different calls share a key: strings are
+    lowercased, with repeated whitespace collapsed and trailing sentence punctuation
+    removed. Other punctuation is kept, since "C++" and "C" are different queries.
+    """
+    if isinstance(value, str):
+        return _TRAILING_PUNCTUATION.sub("", " ".join(value.casefold().split()))
+    if isinstance(value, dict):
+        return {key: normalize_argument(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [normalize_argument(item) for item in value]
+    return value
+
+class _Entry:
+    """
+    A cached call: its result, once known, whether the model has already seen it and
+    whether it was started by a prefetch.
+    """
+    
+    def __init__(self):
+        self.future: Future = Future()
+        self.delivered = False
+        self.prefetched = False
+
+class ToolCallCache:
+    """
+    Memoizes tool calls within one research run.
+    
+    Calls are keyed on the tool name and its normalized arguments, with defaults
+    filled in. A repeated call returns the earlier result without a network round
+    trip. If the model has already seen that result, a short reference to the
+    earlier call is returned instead, so the result isn't added to the prompt
+    twice. Identical calls made in parallel wait for the first one. Failures (error,
+    timeout and unavailable results) and rate-limited calls are not cached, so they
+    can be retried.
+    """
+    
+    def __init__(self, reference_repeats: bool = True):
+        """
+        Initialize the ToolCallCache.
+        
+        Args:
+            reference_repeats (bool): Answer repeats of a result the model has seen with a
+                short reference instead of the full result.
+        """
+        self.reference_repeats = reference_repeats
+        self.duplicates_avoided = 0
+        self.prefetch_hits = 0
+        self._entries: Dict[str, _Entry] = {}
+        self._lock = threading.Lock()
+    
+    def key(self, tool: BaseTool, args: Dict[str, Any]) -> str:
+        """
+        Cache key of a call: the tool name and its normalized arguments.
+        """
+        try:
+            args = tool.args_schema.model_validate(args).model_dump()
+        except Exception:
+            pass
+        return json.dumps([tool.name, normalize_argument(args)], sort_keys=True, default=str)
+    
+    def _claim(self, key: str) -> Tuple[_Entry, bool]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                return entry, False
+            entry = self._entries[key] = _Entry()
+            return entry, True
+    
+    def put(self, key: str, result: Any, delivered: bool = False):
+        """
+        Store a result obtained outside the model's tool calls, e.g. a prefetch.
+        
+        Args:
+            key (str): Key returned by key().
+            result (Any): Tool result.
+            delivered (bool): The model has already seen the result.
+        """
+        entry, created = self._claim(key)
+        if created:
+            entry.delivered = delivered
+            entry.future.set_result(result)
+    
+    def prefetch(self, tool: BaseTool, args: Dict[str, Any], executor: Executor) -> bool:
+        """
+        Start a call in the background, so an identical call from the model gets its result.
+        A failed prefetch is dropped from the cache and the model's call runs the tool itself.
+        
+        Args:
+            tool (BaseTool): The tool to run.
+            args (Dict[str, Any]): Arguments the model is expected to choose.
+            executor (Executor): Runs the call.
+        
+        Returns:
+            bool: Whether the call was started; False if it is already cached.
+        """
+        key = self.key(tool, args)
+        entry, created = self._claim(key)
+        if not created:
+            return False
+        entry.prefetched = True
+        
+        def run():
+            try:
+                result = tool.invoke(args)
+            except Exception as e:
+                with self._lock:
+                    self._entries.pop(key, None)
+                entry.future.set_exception(e)
+                return
+            if is_retryable(result):
+                with self._lock:
+                    self._entries.pop(key, None)
+            entry.future.set_result(result)
+        
+        executor.submit(run)
+        return True
+    
+    def unused_prefetches(self) -> int:
+        """
+        Prefetched calls the model never asked for.
+        """
+        with self._lock:
+            return sum(1 for entry in self._entries.values() if entry.prefetched and not entry.delivered)
+    
+    def call(self, tool: BaseTool, args: Dict[str, Any]) -> Any:
+        """
+        Run a tool call, or answer it from an earlier identical call.
+        
+        Args:
+            tool (BaseTool): The tool to run.
+            args (Dict[str, Any]): Arguments chosen by the model.
+        
+        Returns:
+            Any: The tool result, or a reference to the earlier call that returned it.
+        """
+        key = self.key(tool, args)
+        entry, created = self._claim(key)
+        
+        if created:
+            metrics.increment("tool_cache.misses")
+            try:
+                result = tool.invoke(args)
+            except Exception as e:
+                with self._lock:
+                    self._entries.pop(key, None)
+                entry.future.set_exception(e)
+                raise
+            if is_retryable(result):
+                with self._lock:
+                    self._entries.pop(key, None)
+            entry.delivered = True
+            entry.future.set_result(result)
+            return result
+        
+        try:
+            result = entry.future.result()
+        except Exception:
+            if not entry.prefetched:
+                raise
+            return self.call(tool, args)
+        if entry.prefetched and self._entries.get(key) is not entry:
+            # The prefetch failed and was dropped; the model's call gets a fresh attempt
+            return self.call(tool, args)
+        
+        with self._lock:
+            delivered = entry.delivered
+            entry.delivered = True
+            if entry.prefetched and not delivered:
+                self.prefetch_hits += 1
+            else:
+                self.duplicates_avoided += 1
+        if entry.prefetched and not delivered:
+            metrics.increment("tool_prefetch.hits")
+            metrics.increment(f"tool_prefetch.hits.{tool.name}")
+            logger.info(f"Answered a {tool.name} call from a prefetch")
+            return result
+        metrics.increment("tool_cache.hits")
+        metrics.increment(f"tool_cache.hits.{tool.name}")
+        logger.info(f"Answered a repeated {tool.name} call from the run's tool cache")
+        
+        if delivered and self.reference_repeats:
+            return {
+                "status": "duplicate",
+                "tool": tool.name,
+                "arguments": args,
+                "message": "This call was already made with the same arguments during this research. Use its earlier result instead of calling the tool again."
+            }
+        return result
+    
+    def wrap(self, tool: BaseTool) -> BaseTool:
+        """
+        Copy of a tool whose calls go through the cache.
+        """
+        def run(**kwargs):
+            return self.call(tool, kwargs)
+        
+        return StructuredTool.from_function(
+            func=run,
+            name=tool.name,
+            description=tool.description,
+            args_schema=tool.args_schema
+        )
+    
+    def wrap_tools(self, tools: List[BaseTool]) -> List[BaseTool]:
+        return [self.wrap(tool) for tool in tools]
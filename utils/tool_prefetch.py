@@ -0,0 +1,132 @@
+from concurrent.futures import ThreadPoolExecutor
+from langchain_core.tools import BaseTool
+from typing import Dict, List, Optional, Sequence, Tuple
+from .metrics import metrics
+from .tool_cache import ToolCallCache
+import logging
+import os
+import re
+
+logger = logging.getLogger(__name__)
+
+# Argument each prefetchable tool takes its search term in
+PREFETCH_ARGUMENTS = {
+    "search_wikipedia": "topic",
+    "search_web_with_duckduckgo": "query",
+    "search_duckduckgo_news": "query",
+}
+
+# Capitalized words that start questions and instructions rather than name an entity
+SENTENCE_STARTERS = {
+    "a", "an", "and", "are", "can", "compare", "could", "describe", "did", "do", "does", "explain",
+    "find", "give", "how", "i", "if", "in", "is", "list", "me", "my", "of", "on", "please", "research",
+    "should", "show", "summarize", "tell", "the", "what", "when", "where", "which", "who", "whom",
+    "whose", "why", "will", "would", "write", "you",
+}
+CONNECTORS = {"of", "for", "de", "&"}
+
+_QUOTED = re.compile(r"[\"“]([^\"”]{2,80})[\"”]")
+_WORD = re.compile(r"[\w&][\w&.'-]*", re.UNICODE)
+
+def _is_name(word: str) -> bool:
+    return word[0].isupper() or any(character.isdigit() for character in word)
+
+def _close_run(run: List[str], terms: List[str]):
+    while run and run[-1].lower() in CONNECTORS | {"the"}:
+        run.pop()
+    if run:
+        terms.append(" ".join(run))
+
+def extract_search_terms(text: str, max_terms: int = 2) -> List[str]:
+    """
+    Guess the entities a question is about: quoted phrases first, then runs of
+    capitalized words such as "Jensen Huang" or "Bank of America".
+    
+    Args:
+        text (str): The user's question.
+        max_terms (int): Maximum number of terms.
+    
+    Returns:
+        List[str]: Terms in order of appearance, without duplicates.
+    """
+    terms = [match.group(1).strip() for match in _QUOTED.finditer(text)]
+    
+    for sentence in re.split(r"(?<=[.!?])\s+|\n+", _QUOTED.sub(" ", text)):
+        run: List[str] = []
+        for position, word in enumerate(_WORD.findall(sentence)):
+            word = re.sub(r"'s$", "", word).rstrip(".'")
+            if not word:
+                continue
+            if _is_name(word) and not (position == 0 and word.lower() in SENTENCE_STARTERS):
+                run.append(word)
+                continue
+            if run and (word.lower() in CONNECTORS or word.lower() == "the" and run[-1].lower() == "of"):
+                run.append(word)
+                continue
+            _close_run(run, terms)
+            run = []
+        _close_run(run, terms)
+    
+    unique = []
+    for term in terms:
+        if not term.isdigit() and term.lower() not in SENTENCE_STARTERS and term.lower() not in (existing.lower() for existing in unique):
+            unique.append(term)
+    return unique[:max_terms]
+
+class ToolPrefetcher:
+    """
+    Speculatively starts the searches a research run is likely to begin with.
+    
+    The first model call of a run nearly always asks for Wikipedia and web searches
+    on the entities in the question. Those calls are started in the background as
+    the run begins, into the run's tool cache, so when the model asks for one of them
+    its result is already there or on its way.
+    """
+    
+    def __init__(self, tool_names: Optional[Sequence[str]] = None, max_terms: int = 2, max_workers: int = 8):
+        """
+        Initialize the ToolPrefetcher.
+        
+        Args:
+            tool_names (Optional[Sequence[str]]): Tools called for every term.
+                Defaults to PREFETCH_TOOLS or search_wikipedia and search_web_with_duckduckgo.
+            max_terms (int): Search terms taken from a question.
+            max_workers (int): Prefetched calls that may run at once across all runs.
+        """
+        if tool_names is None:
+            tool_names = os.getenv("PREFETCH_TOOLS", "search_wikipedia,search_web_with_duckduckgo").split(",")
+        self.tool_names = [name.strip() for name in tool_names if name.strip() in PREFETCH_ARGUMENTS]
+        self.max_terms = max_terms
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="prefetch")
+    
+    def plan(self, question: str) -> List[Tuple[str, Dict[str, str]]]:
+        """
+        Tool calls to prefetch for a question, as (tool name, arguments).
+        """
+        return [
+            (name, {PREFETCH_ARGUMENTS[name]: term})
+            for term in extract_search_terms(question, self.max_terms)
+            for name in self.tool_names
+        ]
+    
+    def start(self, question: str, tools: Sequence[BaseTool], cache: ToolCallCache) -> int:
+        """
+        Start the prefetched calls of a question.
+        
+        Args:
+            question (str): The user's question.
+            tools (Sequence[BaseTool]): The run's tools, without the cache.
+            cache (ToolCallCache): The run's tool cache.
+        
+        Returns:
+            int: Number of calls started.
+        """
+        tools_by_name = {tool.name: tool for tool in tools}
+        started = 0
+        for name, args in self.plan(question):
+            if name in tools_by_name and cache.prefetch(tools_by_name[name], args, self._executor):
+                started += 1
+        if started:
+            metrics.increment("tool_prefetch.started", started)
+            logger.info(f"Prefetching {started} tool calls")
+        return started
@@ -0,0 +1,347 @@
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from langchain_core.tools import BaseTool, StructuredTool
+from typing import Any, Deque, Dict, List, NamedTuple, Optional
+from .metrics import metrics
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+class ToolPolicy(NamedTuple):
+    """
+    Attributes
+        timeout (float): Seconds a call may take before it is abandoned
+        hedge (bool): Send a second request when the first is slower than usual
+        hedge_percentile (float): Latency percentile after which the second request is sent
+        max_in_flight (int): Calls of the tool that may run at once, counting abandoned calls
+            that haven't returned yet
+    """
+    timeout: float
+    hedge: bool = True
+    hedge_percentile: float = 0.9
+    max_in_flight: int = 8
+
+DEFAULT_TIMEOUT = float(os.getenv("TOOL_TIMEOUT_SECONDS", "10"))
+
+# Wikipedia searches are hedged. DuckDuckGo searches are not, since a hedge would take another
+# slot of their shared rate limit, and tools that read the agent's own knowledge are local
+TOOL_POLICIES: Dict[str, ToolPolicy] = {
+    "search_wikipedia": ToolPolicy(timeout=DEFAULT_TIMEOUT),
+    "search_web_with_duckduckgo": ToolPolicy(timeout=DEFAULT_TIMEOUT, hedge=False),
+    "search_duckduckgo_news": ToolPolicy(timeout=DEFAULT_TIMEOUT, hedge=False),
+    "search_agent_knowledge": ToolPolicy(timeout=DEFAULT_TIMEOUT, hedge=False),
+    "lookup_agent_file": ToolPolicy(timeout=DEFAULT_TIMEOUT, hedge=False),
+}
+
+def is_failure(result: Any) -> bool:
+    """
+    Whether a tool result means the service failed, as opposed to finding nothing.
+    """
+    return isinstance(result, dict) and result.get("status") in ("error", "timeout", "unavailable")
+
+def is_rate_limited(result: Any) -> bool:
+    """
+    Whether a tool call was turned away by our own rate limiter, without reaching the service.
+    """
+    return isinstance(result, dict) and result.get("status") == "rate_limited"
+
+def is_retryable(result: Any) -> bool:
+    """
+    Whether the same call may give another result later, so it shouldn't be reused.
+    """
+    return is_failure(result) or is_rate_limited(result)
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive failures so calls fail fast instead of
+    waiting on a service that is down or throttling. After `reset_seconds` one trial
+    call is let through (half open): success closes the breaker, failure opens it again.
+    """
+    
+    def __init__(self, name: str, failure_threshold: int = 5, reset_seconds: float = 30.0):
+        """
+        Initialize the CircuitBreaker.
+        
+        Args:
+            name (str): Name of the tool, used for its metrics.
+            failure_threshold (int): Consecutive failures that open the breaker.
+            reset_seconds (float): Seconds the breaker stays open before a trial call.
+        """
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+        self._set_state(CLOSED)
+    
+    def _set_state(self, state: str):
+        self.state = state
+        metrics.set_gauge(f"tool_breaker.{self.name}.state", state)
+    
+    def retry_in(self) -> float:
+        """
+        Seconds until the breaker lets a trial call through.
+        """
+        if self.opened_at is None:
+            return 0.0
+        return max(0.0, self.opened_at + self.reset_seconds - time.monotonic())
+    
+    def allow(self) -> bool:
+        """
+        Whether a call may go ahead now.
+        """
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and self.retry_in() > 0:
+                return False
+            if self._trial_running:
+                return False
+            self._set_state(HALF_OPEN)
+            self._trial_running = True
+            return True
+    
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial_running = False
+            if self.state != CLOSED:
+                logger.info(f"Circuit breaker of {self.name} closed")
+                self._set_state(CLOSED)
+    
+    def release(self):
+        """
+        Record a call that says nothing about the service, e.g. one our own rate limiter
+        turned away. A trial call is released so the next call can be the trial.
+        """
+        with self._lock:
+            self._trial_running = False
+    
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial_running = False
+            if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != OPEN:
+                    logger.warning(f"Circuit breaker of {self.name} opened after {self.failures} failures")
+                    metrics.increment(f"tool_breaker.{self.name}.opened")
+                self.opened_at = time.monotonic()
+                self._set_state(OPEN)
+
+class LatencyTracker:
+    """
+    Latencies of the most recent successful calls of one tool.
+    """
+    
+    def __init__(self, window: int = 100, min_samples: int = 10):
+        self.min_samples = min_samples
+        self._latencies: Deque[float] = deque(maxlen=window)
+        self._lock = threading.Lock()
+    
+    def record(self, seconds: float):
+        with self._lock:
+            self._latencies.append(seconds)
+    
+    def percentile(self, percentile: float) -> Optional[float]:
+        """
+        Latency at a percentile (0 to 1), or None until enough calls were recorded.
+        """
+        with self._lock:
+            if len(self._latencies) < self.min_samples:
+                return None
+            latencies = sorted(self._latencies)
+        return latencies[min(len(latencies) - 1, int(percentile * len(latencies)))]
+
+class ToolResilience:
+    """
+    Deadlines, hedged requests and circuit breakers for tool calls.
+    
+    Every call runs on a worker thread of its tool and is abandoned at the tool's
+    deadline. When a call of a hedged tool is slower than the tool's usual latency
+    percentile, an identical second request is sent and whichever answers first is
+    used. Timeouts and error results count as failures for the tool's circuit breaker;
+    while it is open, calls return a structured "unavailable" result immediately so
+    the agent can use another tool.
+    
+    Abandoned calls keep their worker until they return. Each tool has its own workers,
+    so a hanging service can't hold up the others, and once `max_in_flight` calls of a
+    tool are running no hedge is sent and new calls are answered "unavailable" at once
+    instead of queueing behind calls that may never return.
+    
+    Breakers and latencies are per process, shared by all research runs.
+    """
+    
+    def __init__(
+        self,
+        policies: Optional[Dict[str, ToolPolicy]] = None,
+        failure_threshold: int = 5,
+        reset_seconds: float = 30.0
+    ):
+        """
+        Initialize the ToolResilience.
+        
+        Args:
+            policies (Optional[Dict[str, ToolPolicy]]): Policy per tool name. Defaults to TOOL_POLICIES.
+                Tools without a policy get a DEFAULT_TIMEOUT deadline and are hedged.
+            failure_threshold (int): Consecutive failures that open a tool's breaker.
+            reset_seconds (float): Seconds a breaker stays open before a trial call.
+        """
+        self.policies = policies if policies is not None else TOOL_POLICIES
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.breakers: Dict[str, CircuitBreaker] = {}
+        self.latencies: Dict[str, LatencyTracker] = {}
+        self._executors: Dict[str, ThreadPoolExecutor] = {}
+        self._in_flight: Dict[str, int] = {}
+        self._lock = threading.Lock()
+    
+    def policy(self, name: str) -> ToolPolicy:
+        return self.policies.get(name) or ToolPolicy(timeout=DEFAULT_TIMEOUT)
+    
+    def breaker(self, name: str) -> CircuitBreaker:
+        with self._lock:
+            if name not in self.breakers:
+                self.breakers[name] = CircuitBreaker(name, self.failure_threshold, self.reset_seconds)
+            return self.breakers[name]
+    
+    def latency(self, name: str) -> LatencyTracker:
+        with self._lock:
+            return self.latencies.setdefault(name, LatencyTracker())
+    
+    def in_flight(self, name: str) -> int:
+        """
+        Calls of a tool currently running, including abandoned ones.
+        """
+        with self._lock:
+            return self._in_flight.get(name, 0)
+    
+    def _set_in_flight(self, name: str, change: int):
+        with self._lock:
+            self._in_flight[name] = self._in_flight.get(name, 0) + change
+            metrics.set_gauge(f"tool.{name}.in_flight", self._in_flight[name])
+    
+    def _submit(self, tool: BaseTool, args: Dict[str, Any], policy: ToolPolicy) -> Future:
+        with self._lock:
+            if tool.name not in self._executors:
+                self._executors[tool.name] = ThreadPoolExecutor(max_workers=policy.max_in_flight, thread_name_prefix=f"tool-{tool.name}")
+            executor = self._executors[tool.name]
+        self._set_in_flight(tool.name, 1)
+        return executor.submit(self._timed, tool, args)
+    
+    def _timed(self, tool: BaseTool, args: Dict[str, Any]):
+        start = time.perf_counter()
+        try:
+            result = tool.invoke(args)
+        finally:
+            self._set_in_flight(tool.name, -1)
+        return result, time.perf_counter() - start
+    
+    def call(self, tool: BaseTool, args: Dict[str, Any]) -> Any:
+        """
+        Run a tool call within its deadline.
+        
+        Args:
+            tool (BaseTool): The tool to run.
+            args (Dict[str, Any]): Arguments chosen by the model.
+        
+        Returns:
+            Any: The tool result, or a structured "timeout" or "unavailable" result.
+        """
+        name = tool.name
+        policy = self.policy(name)
+        breaker = self.breaker(name)
+        if self.in_flight(name) >= policy.max_in_flight:
+            metrics.increment(f"tool.{name}.saturated")
+            return {
+                "status": "unavailable",
+                "tool": name,
+                "message": f"{name} is busy with earlier calls that haven't returned. Use another tool or answer with the information already gathered."
+            }
+        if not breaker.allow():
+            metrics.increment(f"tool_breaker.{name}.rejected")
+            return {
+                "status": "unavailable",
+                "tool": name,
+                "retry_after_seconds": round(breaker.retry_in(), 1),
+                "message": f"{name} is temporarily unavailable after repeated failures. Use another tool or answer with the information already gathered."
+            }
+        
+        deadline = time.monotonic() + policy.timeout
+        futures: List[Future] = [self._submit(tool, args, policy)]
+        hedge_after = self.latency(name).percentile(policy.hedge_percentile) if policy.hedge else None
+        
+        if hedge_after is not None and hedge_after < policy.timeout:
+            done, _ = wait(futures, timeout=hedge_after)
+            # No hedge while the tool's workers are taken, e.g. by calls to a hanging service
+            if not done and self.in_flight(name) < policy.max_in_flight:
+                metrics.increment(f"tool.{name}.hedged")
+                futures.append(self._submit(tool, args, policy))
+        
+        answered = None
+        error = None
+        pending = set(futures)
+        while pending and answered is None:
+            done, pending = wait(pending, timeout=max(0.0, deadline - time.monotonic()), return_when=FIRST_COMPLETED)
+            if not done:
+                break
+            for future in done:
+                if future.exception() is None:
+                    answered = future
+                    break
+                error = future.exception()
+        
+        if answered is None:
+            breaker.record_failure()
+            if error is not None and not pending:
+                metrics.increment(f"tool.{name}.errors")
+                return {"status": "error", "tool": name, "message": f"Error running {name}: {str(error)}"}
+            metrics.increment(f"tool.{name}.timeouts")
+            logger.warning(f"{name} did not respond within {policy.timeout}s")
+            return {
+                "status": "timeout",
+                "tool": name,
+                "message": f"{name} did not respond within {policy.timeout:g} seconds. Try again with a different query or use another tool."
+            }
+        
+        result, seconds = answered.result()
+        if answered is not futures[0]:
+            metrics.increment(f"tool.{name}.hedge_won")
+        if is_failure(result):
+            breaker.record_failure()
+        elif is_rate_limited(result):
+            # Queued locally, the service wasn't reached
+            metrics.increment(f"tool.{name}.rate_limited")
+            breaker.release()
+        else:
+            breaker.record_success()
+            self.latency(name).record(seconds)
+        return result
+    
+    def wrap(self, tool: BaseTool) -> BaseTool:
+        """
+        Copy of a tool whose calls go through the resilience layer.
+        """
+        def run(**kwargs):
+            return self.call(tool, kwargs)
+        
+        return StructuredTool.from_function(
+            func=run,
+            name=tool.name,
+            description=tool.description,
+            args_schema=tool.args_schema
+        )
+    
+    def wrap_tools(self, tools: List[BaseTool]) -> List[BaseTool]:
+        return [self.wrap(tool) for tool in tools]
+
+tool_resilience = ToolResilience()
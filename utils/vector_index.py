@@ -0,0 +1,283 @@
+from models.agents import AgentDB, File
+from typing import Dict, List, NamedTuple, Optional, Protocol, Sequence
+from .context_packer import split_spans
+from .dedup import tokenize_terms
+import hashlib
+import json
+import logging
+import numpy as np
+import os
+import shutil
+import threading
+import zlib
+
+logger = logging.getLogger(__name__)
+
+METADATA_DTYPE = np.dtype([
+    ("key", "U48"),
+    ("item_id", "U24"),
+    ("section", "U8"),
+    ("start", "i8"),
+    ("end", "i8"),
+    ("live", "?"),
+])
+
+class Embedder(Protocol):
+    """
+    Turns texts into L2-normalized float32 vectors of a fixed dimension.
+    """
+    name: str
+    dim: int
+    
+    def embed(self, texts: Sequence[str]) -> np.ndarray:
+        ...
+
+class HashingEmbedder:
+    """
+    Local embedder based on the hashing trick: unigrams and bigrams are hashed into
+    `dim` signed buckets, weighted with sublinear term frequency and L2-normalized.
+    It needs no model download or network access.
+    """
+    
+    name = "hashing"
+    
+    def __init__(self, dim: int = 1024):
+        """
+        Initialize the HashingEmbedder.
+        
+        Args:
+            dim (int): Vector dimension.
+        """
+        self.dim = dim
+    
+    def embed(self, texts: Sequence[str]) -> np.ndarray:
+        """
+        Embed texts.
+        
+        Args:
+            texts (Sequence[str]): Texts to embed.
+        
+        Returns:
+            np.ndarray: float32 matrix with one L2-normalized row per text.
+        """
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            terms = tokenize_terms(text)
+            features = terms + [f"{first} {second}" for first, second in zip(terms, terms[1:])]
+            if not features:
+                continue
+            hashes = np.fromiter((zlib.crc32(feature.encode("utf-8")) for feature in features), dtype=np.uint32, count=len(features))
+            signs = np.where(hashes >> 31, -1.0, 1.0).astype(np.float32)
+            np.add.at(vectors[row], hashes % self.dim, signs)
+        
+        vectors = np.sign(vectors) * np.log1p(np.abs(vectors))
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.where(norms == 0, 1, norms)
+
+EMBEDDERS = {
+    HashingEmbedder.name: HashingEmbedder,
+}
+
+class SearchHit(NamedTuple):
+    """
+    Attributes
+        item_id (str): ID of the file or website
+        section (str): "files" or "websites"
+        start (int): Offset of the chunk in the item text
+        end (int): End offset of the chunk in the item text
+        score (float): Cosine similarity to the query
+    """
+    item_id: str
+    section: str
+    start: int
+    end: int
+    score: float
+
+def item_key(item: File) -> str:
+    """
+    Key of a stored item version. It changes when the item is replaced.
+    """
+    return f"{item.id}:{hashlib.blake2b(item.compressed_text, digest_size=8).hexdigest()}"
+
+class VectorIndexStore:
+    """
+    Per-agent embedding indexes on local disk.
+    
+    Each agent has a directory holding a raw float32 matrix (vectors.f32), read as a
+    NumPy memmap, and a metadata array (meta.npy) with one row per chunk. Rows are
+    only appended: new items are embedded and added incrementally, and removed or
+    replaced items are marked dead and dropped when the index is compacted.
+    """
+    
+    def __init__(self, root: Optional[str] = None, embedder: Optional[Embedder] = None, chunk_tokens: int = 200):
+        """
+        Initialize the VectorIndexStore.
+        
+        Args:
+            root (Optional[str]): Directory of the indexes. Defaults to VECTOR_INDEX_DIR.
+                Indexing is disabled when neither is set.
+            embedder (Optional[Embedder]): Defaults to the VECTOR_EMBEDDER embedder, "hashing".
+            chunk_tokens (int): Approximate size of an indexed chunk.
+        """
+        self.root = root or os.getenv("VECTOR_INDEX_DIR") or None
+        self.embedder = embedder or EMBEDDERS[os.getenv("VECTOR_EMBEDDER", HashingEmbedder.name)]()
+        self.chunk_tokens = chunk_tokens
+        self._locks: Dict[str, threading.Lock] = {}
+        self._locks_lock = threading.Lock()
+    
+    @property
+    def enabled(self) -> bool:
+        return self.root is not None
+    
+    def _lock(self, agent_id: str) -> threading.Lock:
+        with self._locks_lock:
+            return self._locks.setdefault(agent_id, threading.Lock())
+    
+    def _paths(self, agent_id: str) -> Dict[str, str]:
+        directory = os.path.join(self.root, agent_id)
+        return {
+            "dir": directory,
+            "vectors": os.path.join(directory, "vectors.f32"),
+            "meta": os.path.join(directory, "meta.npy"),
+            "info": os.path.join(directory, "index.json"),
+        }
+    
+    def _load_metadata(self, agent_id: str) -> np.ndarray:
+        paths = self._paths(agent_id)
+        if not os.path.exists(paths["meta"]) or not os.path.exists(paths["info"]):
+            return np.zeros(0, dtype=METADATA_DTYPE)
+        
+        with open(paths["info"]) as f:
+            info = json.load(f)
+        if info.get("embedder") != self.embedder.name or info.get("dim") != self.embedder.dim:
+            logger.info(f"Vector index of agent {agent_id} was built with another embedder, rebuilding it")
+            self.drop(agent_id)
+            return np.zeros(0, dtype=METADATA_DTYPE)
+        
+        metadata = np.load(paths["meta"])
+        expected = len(metadata) * self.embedder.dim * 4
+        if os.path.getsize(paths["vectors"]) != expected:
+            # Vectors appended by a write that never recorded its metadata
+            with open(paths["vectors"], "r+b") as f:
+                f.truncate(expected)
+        return metadata
+    
+    def _save_metadata(self, agent_id: str, metadata: np.ndarray):
+        paths = self._paths(agent_id)
+        with open(paths["meta"] + ".tmp", "wb") as f:
+            np.save(f, metadata)
+        os.replace(paths["meta"] + ".tmp", paths["meta"])
+        if not os.path.exists(paths["info"]):
+            with open(paths["info"], "w") as f:
+                json.dump({"embedder": self.embedder.name, "dim": self.embedder.dim}, f)
+    
+    def _vectors(self, agent_id: str, rows: int) -> np.ndarray:
+        return np.memmap(self._paths(agent_id)["vectors"], dtype=np.float32, mode="r", shape=(rows, self.embedder.dim))
+    
+    def _embed_items(self, items: List[tuple]) -> tuple:
+        rows = []
+        texts = []
+        for section, item in items:
+            text = item.read_text(cache=False)
+            for start, end in split_spans(text, self.chunk_tokens * 4):
+                rows.append((item_key(item), item.id, section, start, end, True))
+                texts.append(text[start:end])
+        return np.array(rows, dtype=METADATA_DTYPE), self.embedder.embed(texts)
+    
+    def sync(self, agent: AgentDB) -> int:
+        """
+        Bring an agent's index in line with its files and websites. Only items that
+        are new or were replaced since the last sync are embedded.
+        
+        Args:
+            agent (AgentDB): Agent loaded with its files and websites.
+        
+        Returns:
+            int: Number of chunks added.
+        """
+        if not self.enabled:
+            return 0
+        agent_id = str(agent.id)
+        
+        with self._lock(agent_id):
+            metadata = self._load_metadata(agent_id)
+            current = {
+                item_key(item): (section, item)
+                for section, items in (("files", agent.files), ("websites", agent.websites))
+                for item in items
+                if item.id
+            }
+            
+            indexed = set(metadata["key"][metadata["live"]])
+            stale = metadata["live"] & ~np.isin(metadata["key"], list(current))
+            new_items = [current[key] for key in current if key not in indexed]
+            if not new_items and not stale.any():
+                return 0
+            
+            metadata["live"][stale] = False
+            new_metadata, new_vectors = self._embed_items(new_items)
+            
+            os.makedirs(self._paths(agent_id)["dir"], exist_ok=True)
+            with open(self._paths(agent_id)["vectors"], "ab") as f:
+                f.write(np.ascontiguousarray(new_vectors, dtype=np.float32).tobytes())
+            metadata = np.concatenate([metadata, new_metadata])
+            self._save_metadata(agent_id, metadata)
+            
+            if (~metadata["live"]).sum() > metadata["live"].sum():
+                self._compact(agent_id, metadata)
+            return len(new_metadata)
+    
+    def _compact(self, agent_id: str, metadata: np.ndarray):
+        """
+        Rewrite the index without dead rows.
+        """
+        paths = self._paths(agent_id)
+        live = metadata["live"]
+        vectors = np.array(self._vectors(agent_id, len(metadata))[live])
+        with open(paths["vectors"] + ".tmp", "wb") as f:
+            f.write(vectors.tobytes())
+        # Write the shorter metadata first: a crash in between leaves vectors to truncate, never missing ones
+        self._save_metadata(agent_id, metadata[live])
+        os.replace(paths["vectors"] + ".tmp", paths["vectors"])
+    
+    def search(self, agent_id: str, query: str, k: int = 5) -> List[SearchHit]:
+        """
+        Find the chunks most similar to a query with one matrix-vector product
+        over the whole memory-mapped index.
+        
+        Args:
+            agent_id (str): ID of the agent.
+            query (str): Search query.
+            k (int): Number of chunks to return.
+        
+        Returns:
+            List[SearchHit]: Best chunks first. Chunks with no similarity are left out.
+        """
+        if not self.enabled:
+            return []
+        query_vector = self.embedder.embed([query])[0]
+        # The vectors are read under the lock too, so a concurrent sync can't rewrite them mid-product
+        with self._lock(agent_id):
+            metadata = self._load_metadata(agent_id)
+            if not len(metadata):
+                return []
+            scores = self._vectors(agent_id, len(metadata)) @ query_vector
+        scores[~metadata["live"]] = -np.inf
+        
+        k = max(1, min(k, len(scores)))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [
+            SearchHit(str(metadata["item_id"][i]), str(metadata["section"][i]), int(metadata["start"][i]), int(metadata["end"][i]), float(scores[i]))
+            for i in top
+            if scores[i] > 0
+        ]
+    
+    def drop(self, agent_id: str):
+        """
+        Delete an agent's index.
+        """
+        if self.enabled:
+            shutil.rmtree(self._paths(agent_id)["dir"], ignore_errors=True)
+
+vector_index_store = VectorIndexStore()
@@ -0,0 +1,366 @@
+from array import array
+from typing import Dict, Iterable, Iterator, List, Optional
+from .dedup import tokenize_terms
+from .metrics import metrics
+import gzip
+import json
+import logging
+import math
+import mmap
+import numpy as np
+import os
+import tempfile
+import threading
+import xml.etree.ElementTree as ElementTree
+
+logger = logging.getLogger(__name__)
+
+INDEX_VERSION = 1
+TITLE_PREFIX = "Wikipedia: "
+
+def normalize_title(title: str) -> str:
+    """
+    Title as it is looked up: case-folded, with underscores and repeated whitespace collapsed
+    """
+    return " ".join(title.replace("_", " ").casefold().split())
+
+def _open_text(path: str):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8")
+    return open(path, "r", encoding="utf-8")
+
+def iter_abstracts(path: str) -> Iterator[Dict[str, str]]:
+    """
+    Stream the articles of an abstracts dump.
+    
+    Supports the Wikimedia abstracts dump (enwiki-latest-abstract.xml, optionally gzipped)
+    and JSON lines with "title", "url" and "abstract" fields. Articles without an
+    abstract are skipped.
+    
+    Args:
+        path (str): Path of the dump.
+    
+    Yields:
+        Dict[str, str]: Article with "title", "url" and "abstract".
+    """
+    if ".xml" in os.path.basename(path):
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, "rb") as f:
+            for _, element in ElementTree.iterparse(f, events=("end",)):
+                if element.tag != "doc":
+                    continue
+                title = (element.findtext("title") or "").strip()
+                if title.startswith(TITLE_PREFIX):
+                    title = title[len(TITLE_PREFIX):]
+                abstract = (element.findtext("abstract") or "").strip()
+                if title and abstract:
+                    yield {"title": title, "url": (element.findtext("url") or "").strip(), "abstract": abstract}
+                element.clear()
+        return
+    
+    with _open_text(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            article = json.loads(line)
+            abstract = (article.get("abstract") or article.get("summary") or "").strip()
+            if article.get("title") and abstract:
+                yield {"title": article["title"], "url": article.get("url", ""), "abstract": abstract}
+
+def _write_strings(path: str, strings: Iterable[bytes]):
+    """
+    Write strings to `path`.bin back to back, with their offsets (one more than the strings) to `path`.npy.
+    """
+    offsets = array("q", [0])
+    with open(f"{path}.bin", "wb") as f:
+        for value in strings:
+            f.write(value)
+            offsets.append(offsets[-1] + len(value))
+    np.save(f"{path}.npy", np.frombuffer(offsets, dtype=np.int64))
+
+class _PostingRuns:
+    """
+    Postings of the articles read so far, spilled to numpy files in `path` every
+    `chunk_postings` postings, so only one chunk is held in memory.
+    """
+    
+    def __init__(self, path: str, chunk_postings: int):
+        self.path = path
+        self.chunk_postings = chunk_postings
+        self.term_ids: Dict[str, int] = {}
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.runs = 0
+        self._reset()
+    
+    def _reset(self):
+        self._terms = array("i")
+        self._doc_ids = array("i")
+        self._in_title = array("b")
+    
+    def add(self, doc_id: int, terms: Iterable[str], title_terms: Iterable[str]):
+        title_terms = set(title_terms)
+        for term in terms:
+            self._terms.append(self.term_ids.setdefault(term, len(self.term_ids)))
+            self._doc_ids.append(doc_id)
+            self._in_title.append(term in title_terms)
+        if len(self._terms) >= self.chunk_postings:
+            self.flush()
+    
+    def flush(self):
+        if not self._terms:
+            return
+        terms = np.frombuffer(self._terms, dtype=np.int32)
+        counts = np.bincount(terms, minlength=len(self.term_ids))
+        counts[:len(self.counts)] += self.counts
+        self.counts = counts
+        np.save(os.path.join(self.path, f"{self.runs}.terms.npy"), terms)
+        np.save(os.path.join(self.path, f"{self.runs}.doc_ids.npy"), np.frombuffer(self._doc_ids, dtype=np.int32))
+        np.save(os.path.join(self.path, f"{self.runs}.in_title.npy"), np.frombuffer(self._in_title, dtype=np.bool_))
+        self.runs += 1
+        self._reset()
+    
+    def load(self, run: int):
+        return tuple(np.load(os.path.join(self.path, f"{run}.{name}.npy")) for name in ("terms", "doc_ids", "in_title"))
+
+def build_wikipedia_index(dump_path: str, index_path: str, max_document_frequency: float = 0.1, chunk_postings: int = 1 << 22) -> int:
+    """
+    Build an offline index from an abstracts dump.
+    
+    The index directory holds the articles, their sorted normalized titles and an
+    inverted index from terms to articles. Every table is a flat file of values plus
+    an offsets array, so the reader can memory-map them instead of loading them.
+    Postings are spilled to disk in chunks while the dump is read, then merged into
+    the memory-mapped inverted index, so the build holds the vocabulary and titles
+    in memory but not the postings.
+    
+    Args:
+        dump_path (str): Path of the dump, see iter_abstracts.
+        index_path (str): Directory the index is written to.
+        max_document_frequency (float): Terms found in a larger share of the articles
+            are not indexed, like stop words.
+        chunk_postings (int): Postings held in memory before they are spilled to disk.
+    
+    Returns:
+        int: Number of indexed articles.
+    """
+    os.makedirs(index_path, exist_ok=True)
+    titles: List[str] = []
+    
+    with tempfile.TemporaryDirectory(dir=index_path) as runs_path:
+        runs = _PostingRuns(runs_path, chunk_postings)
+        
+        def articles():
+            for doc_id, article in enumerate(iter_abstracts(dump_path)):
+                titles.append(normalize_title(article["title"]))
+                title_terms = tokenize_terms(article["title"])
+                runs.add(doc_id, set(title_terms) | set(tokenize_terms(article["abstract"])), title_terms)
+                yield json.dumps(article, ensure_ascii=False).encode("utf-8")
+        
+        _write_strings(os.path.join(index_path, "articles"), articles())
+        runs.flush()
+        
+        title_order = sorted(range(len(titles)), key=lambda doc_id: titles[doc_id])
+        _write_strings(os.path.join(index_path, "titles"), (titles[doc_id].encode("utf-8") for doc_id in title_order))
+        np.save(os.path.join(index_path, "title_ids.npy"), np.asarray(title_order, dtype=np.int32))
+        
+        max_postings = max(1, int(max_document_frequency * len(titles)))
+        terms = sorted(term for term, term_id in runs.term_ids.items() if runs.counts[term_id] <= max_postings)
+        _write_strings(os.path.join(index_path, "terms"), (term.encode("utf-8") for term in terms))
+        term_ids = np.fromiter((runs.term_ids[term] for term in terms), dtype=np.int64, count=len(terms))
+        # Position of each term in the index, -1 for terms that are not indexed
+        positions = np.full(len(runs.term_ids), -1, dtype=np.int64)
+        positions[term_ids] = np.arange(len(terms))
+        offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        np.cumsum(runs.counts[term_ids], out=offsets[1:])
+        
+        doc_ids = np.lib.format.open_memmap(os.path.join(index_path, "postings.npy"), mode="w+", dtype=np.int32, shape=(int(offsets[-1]),))
+        in_title = np.lib.format.open_memmap(os.path.join(index_path, "posting_in_title.npy"), mode="w+", dtype=np.bool_, shape=(int(offsets[-1]),))
+        # Runs are in article order, so appending each run to its terms' postings keeps them sorted
+        cursors = offsets[:-1].copy()
+        for run in range(runs.runs):
+            run_terms, run_doc_ids, run_in_title = runs.load(run)
+            run_positions = positions[run_terms]
+            kept = np.flatnonzero(run_positions >= 0)
+            order = kept[np.argsort(run_positions[kept], kind="stable")]
+            grouped = run_positions[order]
+            unique, starts, counts = np.unique(grouped, return_index=True, return_counts=True)
+            destinations = cursors[grouped] + np.arange(len(grouped)) - np.repeat(starts, counts)
+            doc_ids[destinations] = run_doc_ids[order]
+            in_title[destinations] = run_in_title[order]
+            cursors[unique] += counts
+        doc_ids.flush()
+        in_title.flush()
+        del doc_ids, in_title
+        np.save(os.path.join(index_path, "posting_offsets.npy"), offsets)
+    
+    with open(os.path.join(index_path, "meta.json"), "w") as f:
+        json.dump({"version": INDEX_VERSION, "articles": len(titles), "terms": len(terms)}, f)
+    logger.info(f"Indexed {len(titles)} Wikipedia articles and {len(terms)} terms in {index_path}")
+    return len(titles)
+
+class _StringTable:
+    """
+    Memory-mapped strings stored by _write_strings.
+    """
+    
+    def __init__(self, path: str):
+        self.offsets = np.load(f"{path}.npy", mmap_mode="r")
+        with open(f"{path}.bin", "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else b""
+    
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+    
+    def __getitem__(self, i: int) -> str:
+        return self.data[int(self.offsets[i]):int(self.offsets[i + 1])].decode("utf-8")
+    
+    def find(self, value: str) -> int:
+        """
+        Position of a value in a sorted table, or -1.
+        """
+        low, high = 0, len(self)
+        while low < high:
+            middle = (low + high) // 2
+            if self[middle] < value:
+                low = middle + 1
+            else:
+                high = middle
+        return low if low < len(self) and self[low] == value else -1
+
+class WikipediaIndex:
+    """
+    Offline Wikipedia lookups over an index written by build_wikipedia_index.
+    
+    The index is opened on first use and memory-mapped, so only the pages a lookup
+    touches are read from disk: a title lookup is a binary search over the sorted
+    titles, and a search reads the postings of the query terms.
+    """
+    
+    def __init__(self, path: str, title_weight: float = 2.0):
+        """
+        Initialize the WikipediaIndex.
+        
+        Args:
+            path (str): Index directory.
+            title_weight (float): Score multiplier of query terms found in an article's title.
+        """
+        self.path = path
+        self.title_weight = title_weight
+        self._tables = None
+        self._lock = threading.Lock()
+    
+    def _open(self):
+        with self._lock:
+            if self._tables is None:
+                with open(os.path.join(self.path, "meta.json")) as f:
+                    meta = json.load(f)
+                if meta.get("version") != INDEX_VERSION:
+                    raise ValueError(f"Unsupported Wikipedia index version {meta.get('version')} in {self.path}")
+                self._tables = {
+                    "articles": _StringTable(os.path.join(self.path, "articles")),
+                    "titles": _StringTable(os.path.join(self.path, "titles")),
+                    "terms": _StringTable(os.path.join(self.path, "terms")),
+                    "title_ids": np.load(os.path.join(self.path, "title_ids.npy"), mmap_mode="r"),
+                    "postings": np.load(os.path.join(self.path, "postings.npy"), mmap_mode="r"),
+                    "posting_in_title": np.load(os.path.join(self.path, "posting_in_title.npy"), mmap_mode="r"),
+                    "posting_offsets": np.load(os.path.join(self.path, "posting_offsets.npy"), mmap_mode="r"),
+                }
+                logger.info(f"Opened the Wikipedia index in {self.path} ({meta['articles']} articles)")
+            return self._tables
+    
+    def __len__(self) -> int:
+        return len(self._open()["articles"])
+    
+    def article(self, doc_id: int) -> Dict[str, str]:
+        return json.loads(self._open()["articles"][doc_id])
+    
+    def get(self, title: str) -> Optional[Dict[str, str]]:
+        """
+        Article with exactly this title, ignoring case and underscores.
+        """
+        tables = self._open()
+        position = tables["titles"].find(normalize_title(title))
+        if position < 0:
+            return None
+        return self.article(int(tables["title_ids"][position]))
+    
+    def search(self, query: str, limit: int = 5) -> List[Dict[str, str]]:
+        """
+        Articles matching the most query terms, weighted by inverse document frequency.
+        
+        Args:
+            query (str): Search query.
+            limit (int): Maximum number of articles.
+        
+        Returns:
+            List[Dict[str, str]]: Best matches first.
+        """
+        tables = self._open()
+        total = len(tables["articles"])
+        doc_ids = []
+        weights = []
+        for term in set(tokenize_terms(query)):
+            position = tables["terms"].find(term)
+            if position < 0:
+                continue
+            start, end = int(tables["posting_offsets"][position]), int(tables["posting_offsets"][position + 1])
+            idf = math.log(1 + total / (end - start))
+            # Postings can hold a tenth of the corpus, so they are scored as arrays, never item by item
+            doc_ids.append(tables["postings"][start:end])
+            weights.append(np.where(tables["posting_in_title"][start:end], idf * self.title_weight, idf))
+        if not doc_ids:
+            return []
+        
+        matched, positions = np.unique(np.concatenate(doc_ids), return_inverse=True)
+        scores = np.bincount(positions, weights=np.concatenate(weights))
+        limit = min(limit, len(matched))
+        if limit <= 0:
+            return []
+        # Candidates scoring at least the limit-th best score, ties broken by lower article ID
+        threshold = np.partition(scores, len(scores) - limit)[len(scores) - limit]
+        candidates = np.flatnonzero(scores >= threshold)
+        best = candidates[np.lexsort((candidates, -scores[candidates]))][:limit]
+        return [self.article(int(matched[i])) for i in best]
+    
+    def lookup(self, topic: str) -> Optional[dict]:
+        """
+        Answer a search_wikipedia call from the index.
+        
+        The article titled `topic` is returned if there is one, otherwise the best
+        search match whose title contains every term of the topic.
+        
+        Args:
+            topic (str): Topic asked for by the model.
+        
+        Returns:
+            Optional[dict]: Result shaped like the live search_wikipedia result, or None on a miss.
+        """
+        article = self.get(topic)
+        if article is None:
+            terms = set(tokenize_terms(topic))
+            article = next((
+                match for match in self.search(topic, limit=3)
+                if terms and terms <= set(tokenize_terms(match["title"]))
+            ), None)
+        if article is None:
+            metrics.increment("wikipedia.offline.misses")
+            return None
+        metrics.increment("wikipedia.offline.hits")
+        return {
+            "title": article["title"],
+            "url": article["url"],
+            "summary": article["abstract"],
+            "status": "success"
+        }
+
+def create_wikipedia_index(backend: Optional[str] = None, path: Optional[str] = None) -> Optional[WikipediaIndex]:
+    """
+    Offline index selected by WIKIPEDIA_BACKEND: "live" (default, no index) or "offline",
+    reading the index in WIKIPEDIA_INDEX_PATH (default "data/wikipedia").
+    """
+    backend = (backend or os.getenv("WIKIPEDIA_BACKEND", "live")).lower()
+    if backend == "live":
+        return None
+    if backend == "offline":
+        return WikipediaIndex(path or os.getenv("WIKIPEDIA_INDEX_PATH", "data/wikipedia"))
+    raise ValueError(f"Unsupported Wikipedia backend: {backend}. Supported backends are: live, offline")